@@ -10,8 +10,10 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 from datetime import timedelta
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -46,12 +48,19 @@ INSTALLED_APPS = [
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         # 'rest_framework.authentication.SessionAuthentication',  # Optional for session-based authentication
-        'rest_framework_simplejwt.authentication.JWTAuthentication',  # For JWT token-based authentication
+        'users.authentication.CachedClaimsJWTAuthentication',  # For JWT token-based authentication, without a user query
     ],  
+    # JSON encoded with orjson when it is installed (see users/renderers.py)
+    'DEFAULT_RENDERER_CLASSES': [
+        'users.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
 
 MIDDLEWARE = [
+    'users.middleware.RequestMetricsMiddleware',
+    'users.middleware.DatabaseRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -85,11 +94,113 @@ WSGI_APPLICATION = 'TrueDetector.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
+# Connection profile of the SQLite databases, applied on connect. In WAL mode readers work on a
+# snapshot and are never blocked by a writer; writers wait for each other up to `timeout` seconds,
+# and IMMEDIATE transactions take the write lock when they begin, so that a transaction never fails
+# upgrading a read lock. synchronous=NORMAL only syncs at checkpoints, which is safe in WAL mode.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64000,  # KiB
+    'temp_store': 'MEMORY',
+}
+
+SQLITE_OPTIONS = {
+    'timeout': 20,
+    'transaction_mode': 'IMMEDIATE',
+    'init_command': '; '.join(f'PRAGMA {pragma} = {value}' for pragma, value in SQLITE_PRAGMAS.items()),
+}
+
+# DATABASE_ENGINE=postgresql switches to a PostgreSQL server (DATABASE_NAME, DATABASE_USER,
+# DATABASE_PASSWORD, DATABASE_HOST, DATABASE_PORT) with a connection pool of DATABASE_POOL_MIN_SIZE
+# to DATABASE_POOL_MAX_SIZE connections per process (requires psycopg[pool], installed by
+# requirements-postgresql.txt). Otherwise connections are persistent for DATABASE_CONN_MAX_AGE
+# seconds and checked before reuse.
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'sqlite')
+DATABASE_CONN_MAX_AGE = int(os.environ.get('DATABASE_CONN_MAX_AGE', 60))
+
+if DATABASE_ENGINE == 'postgresql':
+    from psycopg_pool import ConnectionPool
+
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DATABASE_NAME', 'truedetector'),
+            'USER': os.environ.get('DATABASE_USER', ''),
+            'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
+            'HOST': os.environ.get('DATABASE_HOST', ''),
+            'PORT': os.environ.get('DATABASE_PORT', ''),
+            # pooled connections are returned to the pool at the end of each request
+            'CONN_MAX_AGE': 0,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.environ.get('DATABASE_POOL_MIN_SIZE', 2)),
+                    'max_size': int(os.environ.get('DATABASE_POOL_MAX_SIZE', 10)),
+                    'timeout': 10,
+                    # connections are checked when taken from the pool
+                    'check': ConnectionPool.check_connection,
+                },
+            },
+        }
+    }
+elif DATABASE_ENGINE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            # SQLITE_PATH lets tools such as the benchmark suite work on a separate database file
+            'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': SQLITE_OPTIONS,
+        }
+    }
+else:
+    raise ImproperlyConfigured(f"Unsupported DATABASE_ENGINE '{DATABASE_ENGINE}', use 'sqlite' or 'postgresql'.")
+
+# Read replicas, as a comma-separated list of SQLite files holding copies of the primary database
+# (refreshed with `python manage.py sync_replicas`). Tests read from the primary.
+for index, path in enumerate(filter(None, os.environ.get('SQLITE_REPLICA_PATHS', '').split(',')), start=1):
+    DATABASES[f'replica{index}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': path.strip(),
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': SQLITE_OPTIONS,
+        'TEST': {'MIRROR': 'default'},
+    }
+
+# Directory shards, as a comma-separated list of SQLite files (local stand-in for shard databases,
+# created with `python manage.py migrate --database shard<N>`), see DIRECTORY_SHARDS
+for index, path in enumerate(filter(None, os.environ.get('SQLITE_SHARD_PATHS', '').split(',')), start=1):
+    DATABASES[f'shard{index}'] = {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': path.strip(),
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': SQLITE_OPTIONS,
     }
+
+DATABASE_ROUTERS = ['users.sharding.DirectoryShardRouter', 'users.routers.PrimaryReplicaRouter']
+
+# Search and lookup reads of a request go to one of REPLICAS (aliases of DATABASES), writes to the
+# primary. A user reads from the primary for STICKY_SECONDS after their own writes; the marks are kept
+# in the STICKY_CACHE alias, which must be a shared cache when running several workers.
+DATABASE_ROUTING = {
+    'REPLICAS': [alias for alias in DATABASES if alias.startswith('replica')],
+    'STICKY_SECONDS': 10,
+    'STICKY_CACHE': 'default',
+}
+
+# PhoneNumber rows and their name index entries are partitioned by number prefix across SHARDS
+# (aliases of DATABASES, append new shards at the end: a shard's position sets the range of its row
+# ids), see users/sharding.py. An empty list keeps them on the default database. Name searches run
+# on the shards in parallel on SEARCH_WORKERS threads per process (0 runs them one after the other),
+# and workers reload the prefix assignments every MAP_CHECK_INTERVAL seconds.
+DIRECTORY_SHARDS = {
+    'SHARDS': [alias for alias in DATABASES if alias.startswith('shard')],
+    'SEARCH_WORKERS': 4,
+    'MAP_CHECK_INTERVAL': 5,
 }
 
 
@@ -136,6 +247,16 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 AUTH_USER_MODEL = 'users.CustomUser'  
 
+# Password login by phone number in any written format (see users/authentication.py)
+AUTHENTICATION_BACKENDS = ['users.authentication.PhoneNumberBackend']
+
+# Phone numbers are canonicalized to E.164 (see users/numbers.py). Numbers of NATIONAL_NUMBER_LENGTH
+# digits without a country code belong to DEFAULT_COUNTRY_CODE.
+PHONE_NUMBERS = {
+    'DEFAULT_COUNTRY_CODE': '91',
+    'NATIONAL_NUMBER_LENGTH': 10,
+}
+
 # How long the access token is valid
 ACCESS_TOKEN_LIFETIME = timedelta(minutes=15)
 
@@ -143,4 +264,116 @@ ACCESS_TOKEN_LIFETIME = timedelta(minutes=15)
 REFRESH_TOKEN_LIFETIME = timedelta(days=7)
 
 # Store token validity in settings
-AUTH_TOKEN_VALIDITY = ACCESS_TOKEN_LIFETIME
\ No newline at end of file
+AUTH_TOKEN_VALIDITY = ACCESS_TOKEN_LIFETIME
+
+# The default cache is per process. "revocations" is kept in a table of the default database
+# (created by migrate), so that every worker process sees the same entries.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'revocations': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'auth_revocations',
+    },
+}
+
+# Cache alias holding the revoked access tokens (see users/authentication.py). It must be shared by
+# all worker processes (e.g. Redis instead of the database table): with a per-process cache a
+# revocation only reaches the worker that made it. Every process remembers what it read for
+# LOCAL_TTL seconds (at most LOCAL_MAX_ENTRIES keys), which bounds how long a token revoked by
+# another worker is still accepted; 0 reads the shared cache on every request.
+AUTH_REVOCATION = {
+    'CACHE': 'revocations',
+    'LOCAL_TTL': 5,
+    'LOCAL_MAX_ENTRIES': 100000,
+}
+
+# Maximum (and default) page size of the cursor-paginated search endpoints
+SEARCH_MAX_PAGE_SIZE = 50
+
+# Spam reports are buffered in process and written in batches every SPAM_FLUSH_INTERVAL seconds,
+# or as soon as SPAM_FLUSH_BATCH_SIZE reports are pending. An interval of 0 writes synchronously.
+SPAM_FLUSH_INTERVAL = 2.0
+SPAM_FLUSH_BATCH_SIZE = 500
+
+# Read-through cache for number and name lookups. BACKEND is the alias of a shared cache in CACHES
+# (e.g. Redis); when empty, every process keeps its own LRU of at most MAX_ENTRIES entries.
+# Entries expire after TTL seconds, a TTL of 0 disables the cache. The lookups pinned for the hot
+# numbers (see HOT_NUMBERS) are recomputed by the publishing thread and dropped once PIN_MAX_AGE
+# seconds old (capped at TTL), should it stop recomputing them.
+LOOKUP_CACHE = {
+    'BACKEND': None,
+    'MAX_ENTRIES': 10000,
+    'TTL': 30,
+    'PIN_MAX_AGE': 30,
+}
+
+# Time-decayed spam score of the number lookups: the weight of a report halves every HALF_LIFE_DAYS,
+# and SATURATION recent reporters give a score of 50 (out of 100)
+SPAM_SCORE = {
+    'HALF_LIFE_DAYS': 30,
+    'SATURATION': 10,
+}
+
+# Memory-mapped snapshot of the spam scores (see users/spam_snapshot.py), written by
+# `python manage.py export_spam_snapshot`. When PATH is set, number lookups with ?fields=spam are
+# answered from it without a database query; workers check every CHECK_INTERVAL seconds whether
+# the file was replaced.
+SPAM_SNAPSHOT = {
+    'PATH': os.environ.get('SPAM_SNAPSHOT_PATH'),
+    'CHECK_INTERVAL': 5,
+}
+
+# Spam change feed for offline call screening (see users/spam_feed.py): deltas return at most
+# PAGE_SIZE changes, and every process rebuilds the compressed baseline at most every
+# BASELINE_MAX_AGE seconds
+SPAM_FEED = {
+    'PAGE_SIZE': 10000,
+    'BASELINE_MAX_AGE': 300,
+}
+
+# Heavy-hitter tracking of the looked up and reported numbers (see users/heavy_hitters.py). Every
+# process keeps the TOP_K numbers of two SKETCH_WIDTH x SKETCH_DEPTH Count-Min sketches, with counts
+# halving every HALF_LIFE seconds, and publishes them every PUBLISH_INTERVAL seconds (0 disables the
+# publishing thread); rows older than STALE_AFTER seconds are ignored. After publishing, a process
+# pins in its lookup cache the lookups of the PIN_COUNT hottest numbers with a heat (decayed lookups
+# plus reports) of at least PIN_MIN_COUNT.
+HOT_NUMBERS = {
+    'ENABLED': True,
+    'TOP_K': 100,
+    'SKETCH_WIDTH': 2048,
+    'SKETCH_DEPTH': 4,
+    'HALF_LIFE': 300,
+    'PUBLISH_INTERVAL': 5,
+    'STALE_AFTER': 30,
+    'PIN_COUNT': 50,
+    'PIN_MIN_COUNT': 10,
+}
+
+# Contact uploads are written in transactions of CONTACT_IMPORT_CHUNK_SIZE rows,
+# rows beyond CONTACT_IMPORT_MAX_ROWS in a single upload are ignored
+CONTACT_IMPORT_CHUNK_SIZE = 1000
+CONTACT_IMPORT_MAX_ROWS = 50000
+
+# Maximum number of numbers accepted by one batch lookup request
+BATCH_LOOKUP_MAX_NUMBERS = 5000
+
+# Per-owner Bloom filters in front of the reverse contact index used for the email visibility check.
+# Filters of at most MAX_OWNERS owners are kept per process and rebuilt after TTL seconds.
+CONTACT_BLOOM_FILTERS = {
+    'ENABLED': True,
+    'MAX_OWNERS': 10000,
+    'TTL': 30,
+    'ERROR_RATE': 0.01,
+}
+
+# Per-route request metrics exposed in Prometheus format on /metrics/. Requests slower than
+# SLOW_REQUEST_THRESHOLD seconds are logged (None disables the log), with their SQL statements
+# when LOG_SLOW_REQUEST_SQL is set. When TOKEN is set, scrapers must send "Authorization: Bearer <TOKEN>",
+# otherwise the endpoint is restricted to staff users.
+REQUEST_METRICS = {
+    'SLOW_REQUEST_THRESHOLD': None,
+    'LOG_SLOW_REQUEST_SQL': True,
+    'TOKEN': os.environ.get('METRICS_TOKEN'),
+}
@@ -17,13 +17,25 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
-from users import views
+from users import async_views, views
      
 urlpatterns = [
+    path('admin/', admin.site.urls),
     path('login/', views.loginUser, name="login"),
     path('logout/', views.logoutUser),
     path('signup/', views.signUpUser),
+    path('contacts/import/', views.import_contacts_view, name="import_contacts"),
     path('markSpam/<str:query>/', views.mark_as_spam,name="mark_as_spam"),
     path('search/name/<str:query>/', views.search_person_by_name, name="search_person_by_name"),
     path('search/number/<str:query>/', views.search_person_by_number, name="search_person_by_number"),
+    path('search/numbers/', views.search_people_by_numbers, name="search_people_by_numbers"),
+    path('spam/feed/', views.spam_changes, name="spam_changes"),
+    path('spam/feed/baseline/', views.spam_baseline, name="spam_baseline"),
+    # async versions of the read endpoints, for ASGI deployments (see README)
+    path('async/search/name/<str:query>/', async_views.search_person_by_name, name="async_search_person_by_name"),
+    path('async/search/number/<str:query>/', async_views.search_person_by_number, name="async_search_person_by_number"),
+    path('async/search/numbers/', async_views.search_people_by_numbers, name="async_search_people_by_numbers"),
+    path('stats/cache/', views.lookup_cache_stats, name="lookup_cache_stats"),
+    path('stats/hot-numbers/', views.hot_numbers_stats, name="hot_numbers_stats"),
+    path('metrics/', views.metrics, name="metrics"),
 ]
@@ -0,0 +1,63 @@
+"""
+Compare two benchmark result files written by `python -m benchmarks.run load --output`.
+
+    python -m benchmarks.compare baseline.json candidate.json --threshold 10
+
+A scenario regresses when its p95 latency grows, its throughput drops, or its queries per request grow
+by more than the threshold (in percent). The exit status is 1 when any scenario regressed.
+"""
+import argparse
+import json
+import sys
+
+# metric -> True when higher is better
+METRICS = {
+    'throughput_rps': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+    'queries_per_request': False,
+}
+GATED_METRICS = ('throughput_rps', 'p95_ms', 'queries_per_request')
+
+
+def change(before, after):
+    if before in (None, 0) or after is None:
+        return None
+    return (after - before) / before * 100
+
+
+def compare(baseline, candidate, threshold):
+    regressions = []
+    for name, after in candidate['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            print(f'{name}: no baseline')
+            continue
+        for metric, higher_is_better in METRICS.items():
+            delta = change(before.get(metric), after.get(metric))
+            if delta is None:
+                continue
+            worse = -delta if higher_is_better else delta
+            flag = ''
+            if metric in GATED_METRICS and worse > threshold:
+                flag = '  REGRESSION'
+                regressions.append((name, metric, delta))
+            print(f'{name:>14} {metric:>20}: {before[metric]:10.2f} -> {after[metric]:10.2f} ({delta:+6.1f}%){flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Allowed degradation in percent')
+    args = parser.parse_args()
+
+    with open(args.baseline) as baseline, open(args.candidate) as candidate:
+        regressions = compare(json.load(baseline), json.load(candidate), args.threshold)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
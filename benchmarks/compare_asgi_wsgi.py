@@ -0,0 +1,90 @@
+"""
+Compare the WSGI (DRF) and ASGI (async) number lookup endpoints under concurrent load.
+
+Start both servers against the same database, then run the script:
+
+    gunicorn TrueDetector.wsgi -b 127.0.0.1:8000 -w 1 --threads 8
+    uvicorn TrueDetector.asgi:application --port 8001 --workers 1
+    python benchmarks/compare_asgi_wsgi.py --phone 1234567890 --password secret \\
+        --wsgi-url http://127.0.0.1:8000 --asgi-url http://127.0.0.1:8001
+
+Both servers are driven with the same number of concurrent clients, every client looking up numbers
+of the directory in a loop; throughput and latency percentiles are printed per server.
+"""
+import argparse
+import json
+import statistics
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def login(base_url, phone, password):
+    request = urllib.request.Request(
+        f'{base_url}/login/',
+        data=json.dumps({'phone_number': phone, 'password': password}).encode(),
+        headers={'Content-Type': 'application/json'},
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)['access_token']
+
+
+def timed_get(url, token):
+    request = urllib.request.Request(url, headers={'Authorization': f'Bearer {token}'})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(base_url, path, token, numbers, requests, concurrency):
+    urls = [f'{base_url}{path}{numbers[i % len(numbers)]}/' for i in range(requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(lambda url: timed_get(url, token), urls))
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'throughput_rps': requests / elapsed,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--wsgi-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--asgi-url', default='http://127.0.0.1:8001')
+    parser.add_argument('--phone', required=True, help='Phone number of an existing user to log in with')
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--numbers', nargs='*', help='Numbers to look up (defaults to the login number)')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    token = login(args.wsgi_url, args.phone, args.password)
+    numbers = args.numbers or [args.phone]
+    results = {
+        'wsgi': run(args.wsgi_url, '/search/number/', token, numbers, args.requests, args.concurrency),
+        'asgi': run(args.asgi_url, '/async/search/number/', token, numbers, args.requests, args.concurrency),
+    }
+
+    for mode, result in results.items():
+        print(f"{mode}: {result['throughput_rps']:.0f} req/s, p50 {result['p50_ms']:.1f} ms, "
+              f"p95 {result['p95_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms")
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
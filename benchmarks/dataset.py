@@ -0,0 +1,43 @@
+"""
+Deterministic benchmark dataset.
+
+Every user gets the same password (hashed once) so that load clients can log in as any of them.
+Names follow a skewed distribution so that common prefixes match many rows, like a real directory.
+The rows themselves come from users/generator.py, see `python manage.py populate_test_data`.
+"""
+import random
+from users import generator
+from users.generator import FIRST_NAMES, LAST_NAMES
+from users.models import CustomUser, NumberDirectory
+
+PASSWORD = 'benchmark-password'
+
+
+def clear():
+    generator.clear()
+
+
+def seed(users=1000, contacts_per_user=10, spam_reports_per_user=0.5, seed=42, chunk_size=1000, workers=None, log=print):
+    # The dataset of users/generator.py: bulk loads, then the derived tables in one pass each
+    generator.generate(users=users, contacts_per_user=contacts_per_user, spam_reports_per_user=spam_reports_per_user,
+                       password=PASSWORD, seed=seed, chunk_size=chunk_size, workers=workers, log=log)
+
+
+def sample_numbers(count, seed=42):
+    # Numbers present in the directory, for the lookup scenarios
+    rng = random.Random(seed)
+    numbers = list(NumberDirectory.objects.values_list('number', flat=True)[:count * 10])
+    return rng.sample(numbers, min(count, len(numbers)))
+
+
+def sample_users(count, seed=42):
+    # Generated users only, the others do not have the benchmark password
+    rng = random.Random(seed)
+    users = CustomUser.objects.filter(phone_number__gte=generator.user_number(0), phone_number__lt=str(generator.OTHER_NUMBER_BASE))
+    numbers = list(users.values_list('phone_number', flat=True)[:count * 10])
+    return rng.sample(numbers, min(count, len(numbers)))
+
+
+def name_queries():
+    # Prefixes of various selectivity: common first names, rare last names, two-letter prefixes
+    return [name[:length] for name in FIRST_NAMES + LAST_NAMES for length in (2, 4, len(name))]
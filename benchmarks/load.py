@@ -0,0 +1,146 @@
+"""
+Concurrent load driver.
+
+Clients either call the Django application in-process (the default, which also counts SQL queries per
+request) or a running server over HTTP. Each scenario runs `requests` requests spread over
+`concurrency` client threads, every thread logged in as a different seeded user.
+"""
+import json
+import random
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.dataset import PASSWORD
+
+
+class InProcessClient:
+    # Drives the WSGI application through Django's test client in the calling thread
+
+    def __init__(self):
+        from django.test import Client
+        self.client = Client()
+        self.headers = {}
+
+    def request(self, method, path, body=None):
+        from django.db import connection
+        queries = []
+
+        def count(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            if method == 'GET':
+                response = self.client.get(path, headers=self.headers)
+            else:
+                response = self.client.post(path, data=json.dumps(body or {}), content_type='application/json', headers=self.headers)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response.status_code, response.content if not response.streaming else b'', len(queries)
+
+    def authenticate(self, token):
+        self.headers = {'Authorization': f'Bearer {token}'}
+
+    def close(self):
+        from django.db import connection
+        connection.close()
+
+
+class HttpClient:
+    # Drives a running server; query counts are not visible from the outside
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.headers = {}
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body or {}).encode() if method != 'GET' else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                         headers={'Content-Type': 'application/json', **self.headers})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.read(), None
+        except urllib.error.HTTPError as error:
+            return error.code, error.read(), None
+
+    def authenticate(self, token):
+        self.headers = {'Authorization': f'Bearer {token}'}
+
+    def close(self):
+        pass
+
+
+def login(client, phone_number):
+    status, content, queries = client.request('POST', '/login/', {'phone_number': phone_number, 'password': PASSWORD})
+    if status != 200:
+        raise RuntimeError(f'Login of {phone_number} failed with status {status}')
+    client.authenticate(json.loads(content)['access_token'])
+
+
+# scenario name -> function(rng, data) returning (method, path, body)
+SCENARIOS = {
+    'login': lambda rng, data: ('POST', '/login/', {'phone_number': rng.choice(data['users']), 'password': PASSWORD}),
+    'mark_spam': lambda rng, data: ('POST', f"/markSpam/{rng.choice(data['numbers'])}/", None),
+    'search_name': lambda rng, data: ('GET', f"/search/name/{rng.choice(data['names'])}/", None),
+    'search_number': lambda rng, data: ('GET', f"/search/number/{rng.choice(data['numbers'])}/", None),
+    # large result sets: every match of a name query, streamed as NDJSON
+    'export_name': lambda rng, data: ('GET', f"/search/name/{rng.choice(data['names'])}/?stream=ndjson", None),
+}
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies, query_counts, errors, elapsed):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'elapsed_s': elapsed,
+        'throughput_rps': len(latencies) / elapsed if elapsed else None,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'queries_per_request': statistics.mean(query_counts) if query_counts else None,
+    }
+
+
+def run_scenario(name, make_client, data, requests, concurrency, seed=42):
+    build_request = SCENARIOS[name]
+    per_client = max(1, requests // concurrency)
+    latencies, query_counts = [], []
+    errors = 0
+    lock = threading.Lock()
+
+    def worker(index):
+        nonlocal errors
+        rng = random.Random(seed * 1000 + index)
+        client = make_client()
+        try:
+            login(client, data['users'][index % len(data['users'])])
+            local_latencies, local_queries, local_errors = [], [], 0
+            for _ in range(per_client):
+                method, path, body = build_request(rng, data)
+                start = time.perf_counter()
+                status, content, queries = client.request(method, path, body)
+                local_latencies.append(time.perf_counter() - start)
+                if queries is not None:
+                    local_queries.append(queries)
+                if status >= 400:
+                    local_errors += 1
+            with lock:
+                latencies.extend(local_latencies)
+                query_counts.extend(local_queries)
+                errors += local_errors
+        finally:
+            client.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return summarize(latencies, query_counts, errors, time.perf_counter() - start)
@@ -0,0 +1,129 @@
+"""
+Endpoint benchmark suite.
+
+    # seed a separate database file (the path is read by TrueDetector/settings.py)
+    SQLITE_PATH=bench.sqlite3 python -m benchmarks.run seed --users 100000 --contacts-per-user 10
+
+    # drive the endpoints in-process (counts SQL queries) or against a running server with --url
+    SQLITE_PATH=bench.sqlite3 python -m benchmarks.run load --concurrency 16 --requests 5000 --output results.json
+
+    # compare two result files, exits with status 1 on regressions
+    python -m benchmarks.compare baseline.json results.json --threshold 10
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'TrueDetector.settings')
+    import django
+    django.setup()
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def seed_command(args):
+    from django.core.management import call_command
+    from benchmarks import dataset
+
+    call_command('migrate', verbosity=0)
+    if not args.append:
+        dataset.clear()
+    start = time.perf_counter()
+    dataset.seed(users=args.users, contacts_per_user=args.contacts_per_user, spam_reports_per_user=args.spam_reports_per_user,
+                 seed=args.seed, chunk_size=args.chunk_size, workers=args.workers)
+    print(f'Seeded in {time.perf_counter() - start:.1f} s')
+
+
+def load_command(args):
+    from django.conf import settings
+    from benchmarks import dataset
+    from benchmarks.load import HttpClient, InProcessClient, run_scenario
+
+    if args.url:
+        make_client = lambda: HttpClient(args.url)
+    else:
+        # the test client needs the test server host, and DEBUG query logging would skew the numbers
+        settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, 'testserver']
+        settings.DEBUG = False
+        make_client = InProcessClient
+
+    data = {
+        'users': dataset.sample_users(max(args.concurrency, 100), seed=args.seed),
+        'numbers': dataset.sample_numbers(args.sample_size, seed=args.seed),
+        'names': dataset.name_queries(),
+    }
+    if not data['users'] or not data['numbers']:
+        sys.exit('The database has no benchmark data, run the seed command first.')
+
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'target': args.url or 'in-process',
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'seed': args.seed,
+        },
+        'scenarios': {},
+    }
+    for name in args.scenarios:
+        result = run_scenario(name, make_client, data, args.requests, args.concurrency, seed=args.seed)
+        results['scenarios'][name] = result
+        queries = result['queries_per_request']
+        print(f"{name:>14}: {result['throughput_rps']:8.1f} req/s  p50 {result['p50_ms']:7.1f} ms  "
+              f"p95 {result['p95_ms']:7.1f} ms  p99 {result['p99_ms']:7.1f} ms  "
+              f"queries/req {'-' if queries is None else f'{queries:.2f}'}  errors {result['errors']}")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+        print(f'Results written to {args.output}')
+
+
+def main():
+    setup_django()
+    from benchmarks.load import SCENARIOS
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subcommands = parser.add_subparsers(dest='command', required=True)
+
+    seed = subcommands.add_parser('seed', help='Create the benchmark dataset')
+    seed.add_argument('--users', type=int, default=1000)
+    seed.add_argument('--contacts-per-user', type=int, default=10, help='Average contact list size')
+    seed.add_argument('--spam-reports-per-user', type=float, default=0.5)
+    seed.add_argument('--chunk-size', type=int, default=1000)
+    seed.add_argument('--workers', type=int, default=None, help='Generator processes (default: one per CPU)')
+    seed.add_argument('--seed', type=int, default=42)
+    seed.add_argument('--append', action='store_true', help='Keep the existing rows and generate the missing users only')
+    seed.set_defaults(handler=seed_command)
+
+    load = subcommands.add_parser('load', help='Run the endpoint scenarios')
+    load.add_argument('--url', help='Base URL of a running server (default: in-process)')
+    load.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=['login', 'mark_spam', 'search_name', 'search_number'])
+    load.add_argument('--requests', type=int, default=2000, help='Requests per scenario')
+    load.add_argument('--concurrency', type=int, default=8)
+    load.add_argument('--sample-size', type=int, default=1000, help='Distinct numbers looked up')
+    load.add_argument('--seed', type=int, default=42)
+    load.add_argument('--output', help='Write the results as JSON to this file')
+    load.set_defaults(handler=load_command)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
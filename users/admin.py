@@ -1,17 +1,217 @@
-from django.contrib import admin
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Max, Min, Q
+from django.utils.functional import cached_property
+from .bulk_actions import delete_phone_numbers, delete_spam_actions, delete_user_contacts, reset_spam_likelihood
 from .models import CustomUser, PhoneNumber, SpamAction, UserContact
+from .name_index import filter_names
+from .numbers import number_key, prefix_ranges
+from .sharding import shard_for_key, sharded, shards
 
-class PhoneNumberAdmin(admin.ModelAdmin):
+# Changelists of filtered lists count at most this many rows (later pages are not reachable)
+FILTERED_COUNT_LIMIT = 10000
+
+
+def estimated_count(model, using):
+    # Row count of a whole table without scanning it: the planner statistics on PostgreSQL, the
+    # span of the primary keys elsewhere (an upper bound once rows were deleted; shards allocate
+    # ids from their own range)
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [connection.ops.quote_name(model._meta.db_table)])
+            row = cursor.fetchone()
+        # -1 until the table was first analyzed
+        if row is not None and row[0] >= 0:
+            return int(row[0])
+    span = model.objects.using(using).aggregate(first=Min('pk'), last=Max('pk'))
+    return span['last'] - span['first'] + 1 if span['last'] is not None else 0
+
+
+class EstimatedCountPaginator(Paginator):
+    # No exact COUNT(*) on every page load: unfiltered lists use the estimated table size, filtered
+    # ones count up to FILTERED_COUNT_LIMIT rows
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.has_filters():
+            return estimated_count(queryset.model, queryset.db)
+        return queryset.order_by()[:FILTERED_COUNT_LIMIT].count()
+
+
+class ProjectedChangeList(ChangeList):
+    # Loads only the list_only fields of the listed rows
+
+    def get_queryset(self, request, exclude_parameters=None):
+        queryset = super().get_queryset(request, exclude_parameters)
+        if self.model_admin.list_only is not None:
+            queryset = queryset.only(*self.model_admin.list_only)
+        return queryset
+
+
+class NumberPrefixFilter(admin.SimpleListFilter):
+    # Numbers whose E.164 digits start with a prefix, as number_key range scans. The default
+    # country code and its first digits are offered, any prefix can be passed as ?number_prefix=
+    title = "number prefix"
+    parameter_name = "number_prefix"
+
+    def lookups(self, request, model_admin):
+        code = settings.PHONE_NUMBERS['DEFAULT_COUNTRY_CODE']
+        return [(code, f"+{code}")] + [(f"{code}{digit}", f"+{code} {digit}") for digit in range(1, 10)]
+
+    def queryset(self, request, queryset):
+        prefix = (self.value() or '').lstrip('+')
+        if not prefix:
+            return queryset
+        if not prefix.isdigit() or prefix.startswith('0'):
+            return queryset.none()
+        ranges = Q()
+        for low, high in prefix_ranges(prefix):
+            ranges |= Q(number_key__gte=low, number_key__lt=high)
+        return queryset.filter(ranges)
+
+
+class ShardFilter(admin.SimpleListFilter):
+    # Shard listed by a changelist of a sharded directory (see users/sharding.py), the first one by
+    # default; searches for a phone number go to the shard of the number
+    title = "shard"
+    parameter_name = "shard"
+
+    def lookups(self, request, model_admin):
+        return [(shard, shard) for shard in shards()] if sharded() else []
+
+    def queryset(self, request, queryset):
+        if not sharded():
+            return queryset
+        return queryset.using(self.value() if self.value() in shards() else shards()[0])
+
+
+class ScalableModelAdmin(admin.ModelAdmin):
+    # Admin for tables with millions of rows: estimated counts, no sorting on unindexed columns,
+    # projected list queries, searches on indexes only and set-based bulk actions instead of
+    # Django's delete_selected (which loads, logs and deletes the selected rows one by one)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    show_facets = admin.ShowFacets.NEVER
+    ordering = ["-id"]
+    sortable_by = []
+    list_filter = [NumberPrefixFilter]
+    search_help_text = "Search by phone number, in any format."
+    # model fields loaded for the changelist rows (None for all of them)
+    list_only = None
+    # replace delete_selected by the set-based delete action of the admin
+    set_based_delete = True
+
+    def get_changelist(self, request, **kwargs):
+        return ProjectedChangeList
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        if self.set_based_delete:
+            actions.pop("delete_selected", None)
+        return actions
+
+    def get_search_results(self, request, queryset, search_term):
+        key = number_key(search_term)
+        if key is not None:
+            return queryset.filter(number_key=key), False
+        return self.search_text(queryset, search_term.strip()), False
+
+    def search_text(self, queryset, text):
+        # Search for terms that are not phone numbers
+        return queryset.none() if text else queryset
+
+
+class PhoneNumberAdmin(ScalableModelAdmin):
     list_display = ["name", "number", "spam_likelihood"]
+    list_only = ["name", "number", "spam_likelihood"]
+    list_filter = [ShardFilter, NumberPrefixFilter]
+    search_fields = ["number_key", "name"]
+    search_help_text = "Search by phone number (any format) or by part of the name."
+    actions = ["reset_spam_likelihood", "delete_set"]
+
+    def get_object(self, request, object_id, from_field=None):
+        # ids are unique across the shards, the row is looked for on each of them
+        if not sharded():
+            return super().get_object(request, object_id, from_field)
+        for shard in shards():
+            try:
+                return self.get_queryset(request).using(shard).get(pk=object_id)
+            except (PhoneNumber.DoesNotExist, ValidationError, ValueError):
+                continue
+        return None
+
+    def get_search_results(self, request, queryset, search_term):
+        queryset, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        key = number_key(search_term)
+        if key is not None and sharded():
+            queryset = queryset.using(shard_for_key(key))
+        return queryset, may_have_duplicates
+
+    def search_text(self, queryset, text):
+        # through the name search index instead of a LIKE scan
+        return filter_names(queryset, text)
 
-class CustomUserAdmin(admin.ModelAdmin):
+    @admin.action(permissions=["change"], description="Reset the spam likelihood of the selected phone numbers")
+    def reset_spam_likelihood(self, request, queryset):
+        count = reset_spam_likelihood(queryset)
+        self.message_user(request, f"Spam likelihood reset on {count} phone numbers.", messages.SUCCESS)
+
+    @admin.action(permissions=["delete"], description="Delete the selected phone numbers (set-based, no confirmation)")
+    def delete_set(self, request, queryset):
+        count = delete_phone_numbers(queryset)
+        self.message_user(request, f"Deleted {count} phone numbers.", messages.SUCCESS)
+
+
+class CustomUserAdmin(ScalableModelAdmin):
     list_display = ["name", "email", "phone_number", "is_superuser"]
+    list_only = ["name", "email", "phone_number", "is_superuser"]
+    search_fields = ["number_key"]
+    list_filter = [NumberPrefixFilter, "is_superuser"]
+    # deleting users cascades to their contacts and reports, kept on Django's delete with confirmation
+    set_based_delete = False
+
 
-class UserContactAdmin(admin.ModelAdmin):
-    list_display = ["user", "contact_name", "phone_number"] 
+class UserContactAdmin(ScalableModelAdmin):
+    list_display = ["user", "contact_name", "phone_number"]
+    list_select_related = ["user"]
+    list_only = ["user", "user__phone_number", "contact_name", "phone_number"]
+    raw_id_fields = ["user"]
+    search_fields = ["number_key"]
+    search_help_text = "Search by phone number (any format) of the contact or of its owner."
+    actions = ["delete_set"]
 
-class SpamActionAdmin(admin.ModelAdmin):
+    def get_search_results(self, request, queryset, search_term):
+        key = number_key(search_term)
+        if key is not None:
+            owners = CustomUser.objects.filter(number_key=key).values("pk")
+            return queryset.filter(Q(number_key=key) | Q(user__in=owners)), False
+        return super().get_search_results(request, queryset, search_term)
+
+    @admin.action(permissions=["delete"], description="Delete the selected contacts (set-based, no confirmation)")
+    def delete_set(self, request, queryset):
+        count = delete_user_contacts(queryset)
+        self.message_user(request, f"Deleted {count} contacts.", messages.SUCCESS)
+
+
+class SpamActionAdmin(ScalableModelAdmin):
     list_display = ["user", "phone_number", "is_marked_as_spam"]
+    list_select_related = ["user"]
+    list_only = ["user", "user__phone_number", "phone_number", "is_marked_as_spam"]
+    list_filter = [NumberPrefixFilter, "is_marked_as_spam"]
+    raw_id_fields = ["user"]
+    search_fields = ["number_key"]
+    actions = ["delete_set"]
+
+    @admin.action(permissions=["delete"], description="Withdraw the selected spam reports (set-based, no confirmation)")
+    def delete_set(self, request, queryset):
+        count = delete_spam_actions(queryset)
+        self.message_user(request, f"Withdrew {count} spam reports; spam scores follow at the next recompute.", messages.SUCCESS)
 
 admin.site.register(CustomUser, CustomUserAdmin)
 admin.site.register(PhoneNumber, PhoneNumberAdmin)
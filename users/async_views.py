@@ -0,0 +1,170 @@
+# Async versions of the read endpoints for ASGI deployments.
+#
+# DRF's @api_view does not support coroutine views, so these are plain Django async views that
+# authenticate the JWT themselves and use the async ORM API. Under ASGI an in-flight lookup waiting
+# on the database no longer holds a worker thread, so one process can serve many concurrent lookups.
+import json
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from users.authentication import CachedClaimsJWTAuthentication
+from users.cache import lookup_cache
+from users.directory import aiter_saved_entries, alookup_number, alookup_numbers, asaved_entries
+from users.heavy_hitters import hot_numbers
+from users.membership import membership_index
+from users.name_index import afuzzy_search_names, aiter_name_matches, asearch_names, decode_name_cursor
+from users.numbers import number_key
+from users.spam_snapshot import spam_snapshot
+from users.pagination import InvalidCursor, encode_cursor, get_page_size, stream_ndjson_async, wants_stream
+from users.renderers import json_response
+from users.results import InvalidFields, format_results, parse_fields, result_formatter, row_numbers
+from users.views import (format_number_lookup, format_saved_entries, format_spam_lookup, saved_entries_page, spam_signals,
+                         wants_saved_entries)
+
+
+async def authenticate_request(request):
+    # Returns the user of a valid "Authorization: Bearer <token>" header, or None
+    try:
+        result = await sync_to_async(CachedClaimsJWTAuthentication().authenticate)(request)
+    except (AuthenticationFailed, InvalidToken, TokenError):
+        return None
+    return result[0] if result else None
+
+
+def not_authenticated():
+    return json_response({"error": "User not authenticated, please login."}, status=status.HTTP_401_UNAUTHORIZED)
+
+
+@require_GET
+async def search_person_by_name(request, query):
+    if await authenticate_request(request) is None:
+        return not_authenticated()
+
+    try:
+        fields = parse_fields(request.GET.get('fields'))
+
+        if request.GET.get('match') == 'fuzzy':
+            page_size = get_page_size(request.GET)
+            if page_size == settings.SEARCH_MAX_PAGE_SIZE:
+                rows = await lookup_cache.aget_names(query, lambda: afuzzy_search_names(query), row_numbers, mode='fuzzy')
+            else:
+                rows = await afuzzy_search_names(query, page_size)
+            return json_response({'results': format_results(rows, fields), 'next': None}, status=status.HTTP_200_OK)
+
+        if wants_stream(request):
+            format_result = result_formatter(fields)
+
+            async def export():
+                async for position, row in aiter_name_matches(query):
+                    yield format_result(row)
+            return stream_ndjson_async(export())
+
+        page_size = get_page_size(request.GET)
+        after = decode_name_cursor(request.GET.get('cursor'))
+
+        async def find_people_by_name():
+            rows, next_position = await asearch_names(query, page_size, after)
+            return rows, encode_cursor(next_position)
+
+        if after is None and page_size == settings.SEARCH_MAX_PAGE_SIZE:
+            rows, next_cursor = await lookup_cache.aget_names(query, find_people_by_name, lambda page: row_numbers(page[0]))
+        else:
+            rows, next_cursor = await find_people_by_name()
+        return json_response({'results': format_results(rows, fields), 'next': next_cursor}, status=status.HTTP_200_OK)
+
+    except (InvalidCursor, InvalidFields) as e:
+        return json_response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    except Exception as e:
+        return json_response({'error': f'An unexpected error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@require_GET
+async def search_person_by_number(request, query):
+    user = await authenticate_request(request)
+    if user is None:
+        return not_authenticated()
+
+    try:
+        key = number_key(query)
+        if key is None:
+            return json_response({'error': 'Invalid phone number format'}, status=400)
+        hot_numbers.record_lookup(key)
+
+        if request.GET.get('fields') == 'spam':
+            signals = spam_snapshot.lookup(key)
+            if signals is None:
+                signals = spam_signals(await lookup_cache.aget_number(key, lambda: alookup_number(key)))
+            return json_response(format_spam_lookup(key, *signals))
+
+        if wants_stream(request):
+            format_result = result_formatter(parse_fields(request.GET.get('fields')))
+
+            async def export():
+                async for row in aiter_saved_entries(key):
+                    yield format_result(row)
+            return stream_ndjson_async(export())
+
+        if wants_saved_entries(request.GET):
+            fields = parse_fields(request.GET.get('fields'))
+            page_size, after_id = saved_entries_page(request.GET)
+            return json_response(format_saved_entries(await asaved_entries(key, after_id, page_size), page_size, fields))
+
+        entry = await lookup_cache.aget_number(key, lambda: alookup_number(key))
+
+        # check if the request.user exists in the registered person's contact list
+        is_contact = False
+        if entry is not None and entry['user'] is not None:
+            is_contact = await membership_index.ahas_saved(entry['user']['id'], number_key(user.phone_number))
+
+        return json_response(format_number_lookup(entry, is_contact))
+
+    except (InvalidCursor, InvalidFields) as e:
+        return json_response({'error': str(e)}, status=400)
+
+    except Exception as e:
+        return json_response({'error': f'An unexpected error occurred: {str(e)}'}, status=500)
+
+
+@csrf_exempt
+@require_POST
+async def search_people_by_numbers(request):
+    user = await authenticate_request(request)
+    if user is None:
+        return not_authenticated()
+
+    try:
+        payload = json.loads(request.body or b'{}')
+    except ValueError:
+        payload = None
+    numbers = payload.get("numbers") if isinstance(payload, dict) else None
+    if not isinstance(numbers, list) or not numbers:
+        return json_response({"error": "A non-empty list of numbers is required."}, status=status.HTTP_400_BAD_REQUEST)
+    if len(numbers) > settings.BATCH_LOOKUP_MAX_NUMBERS:
+        return json_response({"error": f"At most {settings.BATCH_LOOKUP_MAX_NUMBERS} numbers can be looked up at once."}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        numbers = [str(number) for number in numbers]
+        keys = {number: number_key(number) for number in numbers}
+        entries = await lookup_cache.aget_numbers({key for key in keys.values() if key is not None}, alookup_numbers)
+
+        registered_ids = {entry['user']['id'] for entry in entries.values() if entry is not None and entry['user'] is not None}
+        contact_owner_ids = await membership_index.aowners_with_number(registered_ids, number_key(user.phone_number))
+
+        lookups = []
+        for number in numbers:
+            if keys[number] is None:
+                lookups.append({'number': number, 'error': 'Invalid phone number format'})
+                continue
+            entry = entries.get(keys[number])
+            is_contact = entry is not None and entry['user'] is not None and entry['user']['id'] in contact_owner_ids
+            lookups.append({'number': number, **format_number_lookup(entry, is_contact)})
+
+        return json_response({'lookups': lookups}, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        return json_response({'error': f'An unexpected error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
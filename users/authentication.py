@@ -0,0 +1,173 @@
+import logging
+import time
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.functional import cached_property
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from users.cache import LocalLRUBackend
+from users.models import CustomUser
+from users.numbers import number_key
+from users.routers import user_authenticated
+
+logger = logging.getLogger(__name__)
+
+# User fields copied into the tokens at login, enough for the views to run without the user row
+USER_CLAIMS = ('phone_number', 'name', 'is_staff', 'is_superuser')
+
+# Issue time with sub-second precision ("iat" is in whole seconds), compared with revocation times
+ISSUED_AT_CLAIM = 'issued_at'
+
+
+def issue_tokens(user):
+    # Refresh token for a user, with the user claims (the access token inherits them)
+    refresh = RefreshToken.for_user(user)
+    for claim in USER_CLAIMS:
+        refresh[claim] = getattr(user, claim)
+    refresh[ISSUED_AT_CLAIM] = time.time()
+    return refresh
+
+
+class TokenRevocations:
+    # Tokens that must no longer be accepted although their signature and expiry are valid.
+    #
+    # Entries live in the AUTH_REVOCATION['CACHE'] cache alias and only for as long as an access
+    # token can be valid: every token of a user issued before the user was revoked (deactivated,
+    # deleted, password or flags changed), and single tokens by jti (logout). That cache is shared by
+    # every worker; each process keeps what it read from it for AUTH_REVOCATION['LOCAL_TTL'] seconds,
+    # so that the requests of an active user do not read the shared cache (a table of the default
+    # database unless configured otherwise) every time. A revocation made by another worker is thus
+    # honoured within LOCAL_TTL seconds, one made by this process right away.
+
+    def __init__(self):
+        self._local = None
+        self._warned = False
+
+    @property
+    def cache(self):
+        return caches[settings.AUTH_REVOCATION['CACHE']]
+
+    @property
+    def local(self):
+        if self._local is None:
+            self._local = LocalLRUBackend(settings.AUTH_REVOCATION['LOCAL_MAX_ENTRIES'])
+        return self._local
+
+    @property
+    def lifetime(self):
+        return int(settings.AUTH_TOKEN_VALIDITY.total_seconds()) + 1
+
+    def user_key(self, user_id):
+        return f'auth:revoked-user:{user_id}'
+
+    def token_key(self, jti):
+        return f'auth:revoked-token:{jti}'
+
+    def _check_shared(self):
+        if not self._warned and isinstance(self.cache, (LocMemCache, DummyCache)):
+            self._warned = True
+            logger.warning("AUTH_REVOCATION['CACHE'] is a per-process cache: revoked tokens are still "
+                           "accepted by the other worker processes.")
+
+    def _remember(self, key, value):
+        # values are wrapped, so that "not revoked" (None) is remembered too
+        ttl = settings.AUTH_REVOCATION['LOCAL_TTL']
+        if ttl > 0:
+            self.local.set(key, (value,), ttl)
+
+    def revoke_user(self, user_id):
+        revoked_at = time.time()
+        self.cache.set(self.user_key(user_id), revoked_at, self.lifetime)
+        self._remember(self.user_key(user_id), revoked_at)
+
+    def revoke_token(self, token):
+        remaining = int(token['exp'] - time.time()) + 1
+        if remaining > 0:
+            self.cache.set(self.token_key(token[api_settings.JTI_CLAIM]), True, remaining)
+            self._remember(self.token_key(token[api_settings.JTI_CLAIM]), True)
+
+    def _get(self, keys):
+        # Values of revocation keys, read from the shared cache when not known locally
+        self._check_shared()
+        revoked, missing = {}, []
+        for key in keys:
+            item = self.local.get(key)
+            if item is None:
+                missing.append(key)
+            else:
+                revoked[key] = item[0]
+        if missing:
+            found = self.cache.get_many(missing)
+            for key in missing:
+                revoked[key] = found.get(key)
+                self._remember(key, revoked[key])
+        return revoked
+
+    def is_revoked(self, token):
+        user_key = self.user_key(token[api_settings.USER_ID_CLAIM])
+        token_key = self.token_key(token.get(api_settings.JTI_CLAIM))
+        revoked = self._get([user_key, token_key])
+        if revoked[token_key]:
+            return True
+        revoked_at = revoked[user_key]
+        # tokens without the precise claim count as issued at the start of their "iat" second
+        return revoked_at is not None and token.get(ISSUED_AT_CLAIM, token.get('iat', 0)) <= revoked_at
+
+    def clear(self):
+        # Forget what was read from the shared cache
+        if self._local is not None:
+            self._local.clear()
+
+
+token_revocations = TokenRevocations()
+
+
+class ClaimsUser(TokenUser):
+    # Token user with an integer id like CustomUser.pk (the user id claim is a string), so that
+    # request.user.pk can be compared with ids read from the database
+
+    @cached_property
+    def id(self):
+        return int(self.token[api_settings.USER_ID_CLAIM])
+
+
+class CachedClaimsJWTAuthentication(JWTAuthentication):
+    # JWT authentication without a user query: tokens issued by issue_tokens() carry the user
+    # claims, so request.user is built from the token (ClaimsUser) once the revocation cache has
+    # been checked. Tokens without the claims fall back to the user row.
+
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_CLAIM not in validated_token:
+            return super().get_user(validated_token)
+        # a user that just wrote reads from the primary database
+        user_authenticated(validated_token[api_settings.USER_ID_CLAIM])
+        if token_revocations.is_revoked(validated_token):
+            raise AuthenticationFailed('Token has been revoked.', code='token_revoked')
+        if any(claim not in validated_token for claim in USER_CLAIMS):
+            return super().get_user(validated_token)
+        return ClaimsUser(validated_token)
+
+
+class PhoneNumberBackend(ModelBackend):
+    # Password login with the phone number in any written format, matched on its number key
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(CustomUser.USERNAME_FIELD)
+        key = number_key(username)
+        if key is None or password is None:
+            return None
+        user = CustomUser._default_manager.filter(number_key=key).order_by('pk').first()
+        if user is None:
+            # hash anyway, so that unknown numbers take as long as wrong passwords
+            CustomUser().set_password(password)
+            return None
+        if user.check_password(password) and self.user_can_authenticate(user):
+            return user
+        return None
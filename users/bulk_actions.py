@@ -0,0 +1,83 @@
+from collections import Counter
+from django.db import transaction
+from users.directory import refresh_numbers
+from users.membership import remove_memberships
+from users.models import NameIndexEntry, PhoneNumber, SpamAction, UserContact
+from users.name_counts import remove_names
+from users.sharding import delete_rows, queryset_shard
+from users.spam import spam_reports
+from users.spam_feed import record_changes
+
+# Set-based writes behind the admin bulk actions.
+#
+# The selected rows are processed in keyset batches of BATCH_SIZE. Every batch is changed with one
+# statement, and the derived tables (name index and frequencies, contact memberships, directory,
+# spam change feed) are maintained once per batch from the values read up front, instead of
+# through the model signals of every single row. Each batch is its own transaction (one on the
+# shard of the selected PhoneNumber rows, see users/sharding.py, and one on the default database).
+
+BATCH_SIZE = 500
+
+
+def batches(queryset, *fields):
+    # (id, *fields) rows of a queryset, BATCH_SIZE at a time in id order. Keyset pagination, so that
+    # changing or deleting the rows of a batch does not move the next one.
+    rows = queryset.order_by('id').values_list('id', *fields)
+    last_id = None
+    while True:
+        batch = list((rows if last_id is None else rows.filter(id__gt=last_id))[:BATCH_SIZE])
+        if batch:
+            yield batch
+        if len(batch) < BATCH_SIZE:
+            return
+        last_id = batch[-1][0]
+
+
+def reset_spam_likelihood(queryset):
+    # Clear the spam likelihood of PhoneNumber rows (e.g. spam flags imported by mistake)
+    shard = queryset_shard(queryset)
+    updated = 0
+    for batch in batches(queryset.exclude(spam_likelihood=0), 'number_key'):
+        keys = {key for row_id, key in batch}
+        with transaction.atomic(), transaction.atomic(using=shard, savepoint=False):
+            updated += PhoneNumber.objects.using(shard).filter(id__in=[row_id for row_id, key in batch]).update(spam_likelihood=0)
+            refresh_numbers(keys)
+            record_changes(keys)
+    return updated
+
+
+def delete_phone_numbers(queryset):
+    shard = queryset_shard(queryset)
+    deleted = 0
+    for batch in batches(queryset, 'number_key', 'name'):
+        ids = [row_id for row_id, key, name in batch]
+        keys = {key for row_id, key, name in batch}
+        with transaction.atomic(), transaction.atomic(using=shard, savepoint=False):
+            NameIndexEntry.objects.using(shard).filter(phone_number_id__in=ids).delete()
+            deleted += delete_rows(PhoneNumber, ids, using=shard)
+            remove_names(Counter((key, name) for row_id, key, name in batch))
+            refresh_numbers(keys)
+            record_changes(keys)
+    return deleted
+
+
+def delete_spam_actions(queryset):
+    # Withdraw spam reports. The report counts of the directory follow right away, the decayed spam
+    # scores with the next recompute_spam_scores, as for any deleted report.
+    deleted = 0
+    for batch in batches(queryset, 'user_id', 'number_key'):
+        with transaction.atomic():
+            deleted += delete_rows(SpamAction, [row_id for row_id, user_id, key in batch])
+            refresh_numbers({key for row_id, user_id, key in batch})
+        for row_id, user_id, key in batch:
+            spam_reports.forget(user_id, key)
+    return deleted
+
+
+def delete_user_contacts(queryset):
+    deleted = 0
+    for batch in batches(queryset, 'user_id', 'number_key'):
+        with transaction.atomic():
+            deleted += delete_rows(UserContact, [row_id for row_id, user_id, key in batch])
+            remove_memberships(Counter((user_id, key) for row_id, user_id, key in batch))
+    return deleted
@@ -0,0 +1,441 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+
+
+class LocalLRUBackend:
+    # Bounded in-process store: least recently used entries are evicted first, expired ones on access
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        # counters and change marks live outside the LRU so that they are never evicted (marks only expire)
+        self._counters = {}
+        self._marks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def mark(self, keys, value, ttl):
+        with self._lock:
+            if len(self._marks) > self.max_entries:
+                now = time.monotonic()
+                self._marks = {key: item for key, item in self._marks.items() if item[0] > now}
+            expires_at = time.monotonic() + ttl
+            for key in keys:
+                self._marks[key] = (expires_at, value)
+
+    def get_marks(self, keys):
+        now = time.monotonic()
+        marks = self._marks
+        return {key: item[1] for key, item in ((key, marks.get(key)) for key in keys) if item is not None and item[0] > now}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._marks = {}
+
+    # the in-process store never blocks, so the async API is the sync one
+
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, value, ttl):
+        self.set(key, value, ttl)
+
+    async def aget_counter(self, key):
+        return self.get_counter(key)
+
+    async def aget_marks(self, keys):
+        return self.get_marks(keys)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedCacheBackend:
+    # Adapter over a Django CACHES alias (e.g. Redis or Memcached) shared by all worker processes
+
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl):
+        self.cache.set(key, value, ttl)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def get_counter(self, key):
+        return self.cache.get(key) or 0
+
+    def incr(self, key):
+        # generation counters never expire
+        self.cache.add(key, 0, None)
+        return self.cache.incr(key)
+
+    def mark(self, keys, value, ttl):
+        self.cache.set_many(dict.fromkeys(keys, value), ttl)
+
+    def get_marks(self, keys):
+        return self.cache.get_many(keys)
+
+    def clear(self):
+        self.cache.clear()
+
+    async def aget(self, key):
+        return await self.cache.aget(key)
+
+    async def aset(self, key, value, ttl):
+        await self.cache.aset(key, value, ttl)
+
+    async def aget_counter(self, key):
+        return await self.cache.aget(key) or 0
+
+    async def aget_marks(self, keys):
+        return await self.cache.aget_many(keys)
+
+
+class LookupCache:
+    # Read-through cache in front of the number and name lookups.
+    #
+    # Number entries are invalidated one by one whenever the directory row of the number is refreshed.
+    # An invalidated number is also marked as changed (with its wall clock time, for the TTL), and a
+    # name search result is stored with the number keys of its rows: it is dropped when one of them
+    # changed after it was computed, so a report only invalidates the results showing the number.
+    # Rows that start matching a query (new or renamed names) cannot be traced that way; they bump a
+    # generation counter that is part of every name key (invalidate_names()). The TTL bounds
+    # staleness across processes that do not share a backend.
+    #
+    # The lookups of the hottest numbers (see users/heavy_hitters.py) are pinned in the process:
+    # kept outside the backend, so neither evicted nor expired, and recomputed in batch by
+    # pin_numbers(). An invalidated pinned number keeps its value until the next pin_numbers(), so
+    # that a surge of reports and lookups on one number does not turn into a query per lookup.
+    # Pinned values older than LOOKUP_CACHE['PIN_MAX_AGE'] seconds (at most the TTL, which bounds the
+    # staleness of every lookup) are dropped, in case they stop being recomputed.
+
+    NAMES_GENERATION_KEY = 'lookup:names:generation'
+
+    def __init__(self, backend=None, ttl=None):
+        self._backend = backend
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # number key -> (monotonic time computed, value)
+        self._pinned = {}
+        # pinned numbers invalidated since the last pin_numbers()
+        self._stale = set()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            config = settings.LOOKUP_CACHE
+            if config.get('BACKEND'):
+                self._backend = SharedCacheBackend(config['BACKEND'])
+            else:
+                self._backend = LocalLRUBackend(config['MAX_ENTRIES'])
+        return self._backend
+
+    @property
+    def ttl(self):
+        return settings.LOOKUP_CACHE['TTL'] if self._ttl is None else self._ttl
+
+    @property
+    def pin_max_age(self):
+        return min(settings.LOOKUP_CACHE['PIN_MAX_AGE'], self.ttl)
+
+    def get_or_set(self, key, compute):
+        # Values are stored wrapped in a tuple so that None results (unknown numbers) are cached too
+        if self.ttl <= 0:
+            return compute()
+
+        cached = self.backend.get(key)
+        if cached is not None:
+            with self._lock:
+                self.hits += 1
+            return cached[0]
+
+        with self._lock:
+            self.misses += 1
+        value = compute()
+        self.backend.set(key, (value,), self.ttl)
+        return value
+
+    def get_many(self, keys, compute_many):
+        # Batch variant of get_or_set: compute_many receives the missing keys and returns a dict
+        if self.ttl <= 0:
+            return compute_many(list(keys))
+
+        values = {}
+        missing = []
+        for key in keys:
+            cached = self.backend.get(key)
+            if cached is None:
+                missing.append(key)
+            else:
+                values[key] = cached[0]
+
+        with self._lock:
+            self.hits += len(values)
+            self.misses += len(missing)
+        if missing:
+            computed = compute_many(missing)
+            for key in missing:
+                values[key] = computed.get(key)
+                self.backend.set(key, (values[key],), self.ttl)
+        return values
+
+    async def aget_or_set(self, key, acompute):
+        # Async variant of get_or_set for the ASGI views, acompute is a coroutine function
+        if self.ttl <= 0:
+            return await acompute()
+
+        cached = await self.backend.aget(key)
+        if cached is not None:
+            with self._lock:
+                self.hits += 1
+            return cached[0]
+
+        with self._lock:
+            self.misses += 1
+        value = await acompute()
+        await self.backend.aset(key, (value,), self.ttl)
+        return value
+
+    async def aget_many(self, keys, acompute_many):
+        if self.ttl <= 0:
+            return await acompute_many(list(keys))
+
+        values = {}
+        missing = []
+        for key in keys:
+            cached = await self.backend.aget(key)
+            if cached is None:
+                missing.append(key)
+            else:
+                values[key] = cached[0]
+
+        with self._lock:
+            self.hits += len(values)
+            self.misses += len(missing)
+        if missing:
+            computed = await acompute_many(missing)
+            for key in missing:
+                values[key] = computed.get(key)
+                await self.backend.aset(key, (values[key],), self.ttl)
+        return values
+
+    def number_key(self, number):
+        return f'lookup:number:{number}'
+
+    def names_digest(self, query, mode):
+        # queries are hashed so that any user input is a valid key for shared backends
+        return hashlib.md5((f'{mode}\0{query}' if mode else query).encode()).hexdigest()
+
+    def changed_key(self, number):
+        return f'lookup:changed:{number}'
+
+    def names_key(self, query, mode=None):
+        generation = self.backend.get_counter(self.NAMES_GENERATION_KEY)
+        return f'lookup:names:{generation}:{self.names_digest(query, mode)}'
+
+    async def anames_key(self, query, mode=None):
+        generation = await self.backend.aget_counter(self.NAMES_GENERATION_KEY)
+        return f'lookup:names:{generation}:{self.names_digest(query, mode)}'
+
+    def get_pinned(self, numbers):
+        # {number: value} of the pinned numbers among `numbers`
+        pinned = self._pinned
+        oldest = time.monotonic() - self.pin_max_age
+        values = {}
+        expired = False
+        for number in numbers:
+            item = pinned.get(number)
+            if item is None:
+                continue
+            if item[0] <= oldest:
+                expired = True
+            else:
+                values[number] = item[1]
+        if expired:
+            self.drop_expired_pins()
+        if values:
+            with self._lock:
+                self.hits += len(values)
+        return values
+
+    def drop_expired_pins(self):
+        # the dict is replaced, never changed in place, so that readers need no lock
+        oldest = time.monotonic() - self.pin_max_age
+        with self._lock:
+            self._pinned = {number: item for number, item in self._pinned.items() if item[0] > oldest}
+
+    def pin_numbers(self, numbers, compute_many):
+        # Pin the lookups of `numbers` and unpin the others. The values of new, invalidated and
+        # TTL-old pinned numbers are computed with one compute_many call; returns how many.
+        if self.ttl <= 0:
+            self._pinned = {}
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            stale, self._stale = self._stale, set()
+        wanted = set(numbers)
+        pinned = {number: item for number, item in self._pinned.items() if number in wanted}
+        refresh = [number for number in numbers
+                   if number not in pinned or number in stale or now - pinned[number][0] >= self.pin_max_age]
+        if refresh:
+            computed = compute_many(refresh)
+            pinned.update((number, (now, computed.get(number))) for number in refresh)
+        self._pinned = pinned
+        return len(refresh)
+
+    def get_number(self, number, compute):
+        pinned = self.get_pinned([number])
+        if pinned:
+            return pinned[number]
+        return self.get_or_set(self.number_key(number), compute)
+
+    def get_numbers(self, numbers, compute_many):
+        # Look up many numbers at once; compute_many receives the numbers missing from the cache
+        values = self.get_pinned(numbers)
+        keys = {self.number_key(number): number for number in numbers if number not in values}
+        cached = self.get_many(keys, lambda missing: {
+            self.number_key(number): value
+            for number, value in compute_many([keys[key] for key in missing]).items()
+        })
+        values.update((keys[key], value) for key, value in cached.items())
+        return values
+
+    def names_fresh(self, cached, marks):
+        # Whether none of the numbers of a cached name search result changed since it was computed
+        value, numbers, computed_at = cached
+        return all(marks.get(self.changed_key(number), 0) < computed_at for number in numbers)
+
+    def get_names(self, query, compute, numbers, mode=None):
+        # numbers(value) gives the number keys of the rows of a result; mode tells apart the results
+        # of other search modes (e.g. "fuzzy") for the same query
+        if self.ttl <= 0:
+            return compute()
+
+        key = self.names_key(query, mode)
+        cached = self.backend.get(key)
+        if cached is not None and self.names_fresh(cached, self.backend.get_marks([self.changed_key(number) for number in cached[1]])):
+            with self._lock:
+                self.hits += 1
+            return cached[0]
+
+        with self._lock:
+            self.misses += 1
+        # taken before the rows are read, so that a change committed meanwhile drops the result
+        computed_at = time.time()
+        value = compute()
+        self.backend.set(key, (value, list(numbers(value)), computed_at), self.ttl)
+        return value
+
+    async def aget_number(self, number, acompute):
+        pinned = self.get_pinned([number])
+        if pinned:
+            return pinned[number]
+        return await self.aget_or_set(self.number_key(number), acompute)
+
+    async def aget_numbers(self, numbers, acompute_many):
+        values = self.get_pinned(numbers)
+        keys = {self.number_key(number): number for number in numbers if number not in values}
+
+        async def acompute_missing(missing):
+            computed = await acompute_many([keys[key] for key in missing])
+            return {self.number_key(number): value for number, value in computed.items()}
+
+        cached = await self.aget_many(keys, acompute_missing)
+        values.update((keys[key], value) for key, value in cached.items())
+        return values
+
+    async def aget_names(self, query, acompute, numbers, mode=None):
+        if self.ttl <= 0:
+            return await acompute()
+
+        key = await self.anames_key(query, mode)
+        cached = await self.backend.aget(key)
+        if cached is not None and self.names_fresh(cached, await self.backend.aget_marks([self.changed_key(number) for number in cached[1]])):
+            with self._lock:
+                self.hits += 1
+            return cached[0]
+
+        with self._lock:
+            self.misses += 1
+        computed_at = time.time()
+        value = await acompute()
+        await self.backend.aset(key, (value, list(numbers(value)), computed_at), self.ttl)
+        return value
+
+    def invalidate_number(self, number):
+        if number in self._pinned:
+            with self._lock:
+                self._stale.add(number)
+        self.backend.delete(self.number_key(number))
+        if self.ttl > 0:
+            self.backend.mark([self.changed_key(number)], time.time(), self.ttl)
+
+    def invalidate_names(self):
+        # Drop every name search result, for rows that may match other queries than before
+        self.backend.incr(self.NAMES_GENERATION_KEY)
+
+    def clear(self):
+        self.backend.clear()
+        self._pinned = {}
+        with self._lock:
+            self._stale.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        oldest = time.monotonic() - self.pin_max_age
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / lookups if lookups else None,
+            'ttl': self.ttl,
+            'backend': type(self.backend).__name__,
+            'pinned_numbers': sum(computed_at > oldest for computed_at, value in self._pinned.values()),
+        }
+
+
+lookup_cache = LookupCache()
@@ -0,0 +1,218 @@
+import threading
+from contextlib import contextmanager
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import Count, Max
+from users.cache import lookup_cache
+from users.models import CustomUser, NumberDirectory, PhoneNumber, SpamAction
+from users.name_counts import top_names
+from users.numbers import format_key
+from users.results import ID, RESULT_COLUMNS
+from users.sharding import group_by_shard, shard_for_key, shards
+
+# How many of the most common names are kept per number
+TOP_NAMES_LIMIT = 5
+
+# Number keys aggregated per set-based refresh query
+REFRESH_BATCH_SIZE = 500
+
+# Numbers waiting for a refresh while inside deferred_refresh(), per thread
+_deferred = threading.local()
+
+
+def build_entries(keys):
+    # Aggregate everything known about a set of numbers (by number key) from the source tables with
+    # a constant number of indexed queries
+    entries = {key: {'user': None, 'spam_likelihood': None, 'spam_reports': 0, 'top_names': []} for key in keys}
+
+    # the name frequencies are maintained incrementally, only the top of each number is read
+    for key, names in top_names(keys, TOP_NAMES_LIMIT).items():
+        entries[key]['top_names'] = names
+
+    # the PhoneNumber rows of a number are all on its shard
+    for shard, shard_keys in group_by_shard(keys).items():
+        scores = (PhoneNumber.objects.using(shard).filter(number_key__in=shard_keys)
+                  .values('number_key').annotate(score=Max('spam_likelihood')))
+        for row in scores:
+            entries[row['number_key']]['spam_likelihood'] = row['score']
+
+    reports = (SpamAction.objects.filter(number_key__in=keys, is_marked_as_spam=True)
+               .values('number_key').annotate(count=Count('id')))
+    for row in reports:
+        entries[row['number_key']]['spam_reports'] = row['count']
+
+    for user in CustomUser.objects.filter(number_key__in=keys):
+        entries[user.number_key]['user'] = user
+
+    return entries
+
+
+def refresh_numbers(keys):
+    # Recompute the directory rows of a set of number keys, dropping the rows of numbers nothing references anymore
+    keys = list({key for key in keys if key})
+    for start in range(0, len(keys), REFRESH_BATCH_SIZE):
+        batch = keys[start:start + REFRESH_BATCH_SIZE]
+        values = build_entries(batch)
+        existing = {entry.number_key: entry for entry in NumberDirectory.objects.filter(number_key__in=batch)}
+
+        to_create, to_update, to_delete = [], [], []
+        for key, fields in values.items():
+            entry = existing.get(key)
+            if fields['user'] is None and not fields['top_names'] and not fields['spam_reports']:
+                if entry is not None:
+                    to_delete.append(entry.pk)
+                continue
+            if entry is None:
+                to_create.append(NumberDirectory(number=format_key(key), number_key=key, **fields))
+            else:
+                for field, value in fields.items():
+                    setattr(entry, field, value)
+                to_update.append(entry)
+
+        NumberDirectory.objects.filter(pk__in=to_delete).delete()
+        NumberDirectory.objects.bulk_create(to_create, ignore_conflicts=True)
+        NumberDirectory.objects.bulk_update(to_update, ['user', 'spam_likelihood', 'spam_reports', 'top_names'])
+
+        for key in batch:
+            lookup_cache.invalidate_number(key)
+    return len(keys)
+
+
+def refresh_number(key):
+    # Recompute the directory row of a single number key
+    if not key:
+        return None
+    refresh_numbers([key])
+    return NumberDirectory.objects.filter(number_key=key).first()
+
+
+def snapshot_entry(entry):
+    # Plain-data snapshot of a directory row, suitable for caching
+    user = entry.user
+    return {
+        'number': entry.number,
+        'user': {
+            'id': user.pk,
+            'name': user.name,
+            'phone_number': user.phone_number,
+            'email': user.email,
+        } if user is not None else None,
+        'spam_likelihood': entry.spam_likelihood,
+        'spam_score': entry.spam_score,
+        'spam_score_at': entry.spam_score_at,
+        'top_names': entry.top_names,
+    }
+
+
+def lookup_number(key):
+    # Snapshot of the directory row of a number key; None for unknown numbers
+    entry = NumberDirectory.objects.select_related('user').filter(number_key=key).first()
+    return snapshot_entry(entry) if entry is not None else None
+
+
+def lookup_numbers(keys):
+    # Snapshots for a set of number keys with one query per REFRESH_BATCH_SIZE keys; unknown numbers map to None
+    keys = list(set(keys))
+    snapshots = dict.fromkeys(keys)
+    for start in range(0, len(keys), REFRESH_BATCH_SIZE):
+        batch = keys[start:start + REFRESH_BATCH_SIZE]
+        for entry in NumberDirectory.objects.select_related('user').filter(number_key__in=batch):
+            snapshots[entry.number_key] = snapshot_entry(entry)
+    return snapshots
+
+
+async def alookup_number(key):
+    entry = await NumberDirectory.objects.select_related('user').filter(number_key=key).afirst()
+    return snapshot_entry(entry) if entry is not None else None
+
+
+async def alookup_numbers(keys):
+    keys = list(set(keys))
+    snapshots = dict.fromkeys(keys)
+    for start in range(0, len(keys), REFRESH_BATCH_SIZE):
+        batch = keys[start:start + REFRESH_BATCH_SIZE]
+        async for entry in NumberDirectory.objects.select_related('user').filter(number_key__in=batch):
+            snapshots[entry.number_key] = snapshot_entry(entry)
+    return snapshots
+
+
+def shard_saved_entries(shard, key, after_id=None, limit=None):
+    # Keyset page over the global PhoneNumber rows of a number key, on the number_key index
+    # (whose entries end with the row id), as result rows (see users/results.py)
+    rows = PhoneNumber.objects.using(shard).filter(number_key=key)
+    if after_id is not None:
+        rows = rows.filter(id__gt=after_id)
+    rows = rows.order_by('id').values_list(*RESULT_COLUMNS)
+    return rows[:limit] if limit else rows
+
+
+def saved_entries(key, after_id=None, limit=None):
+    return shard_saved_entries(shard_for_key(key), key, after_id, limit)
+
+
+def iter_saved_entries(key, chunk_size=REFRESH_BATCH_SIZE):
+    # Every PhoneNumber row of a number key, fetched one keyset page at a time
+    after_id = None
+    while True:
+        rows = list(saved_entries(key, after_id, chunk_size))
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        after_id = rows[-1][ID]
+
+
+async def asaved_entries(key, after_id=None, limit=None):
+    # the shard map may reload the prefix assignments, which the async ORM API does not cover
+    shard = await sync_to_async(shard_for_key)(key)
+    return [row async for row in shard_saved_entries(shard, key, after_id, limit)]
+
+
+async def aiter_saved_entries(key, chunk_size=REFRESH_BATCH_SIZE):
+    after_id = None
+    while True:
+        rows = await asaved_entries(key, after_id, chunk_size)
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        after_id = rows[-1][ID]
+
+
+def schedule_refresh(key):
+    # Refresh a number key now, or once at the end of the enclosing deferred_refresh() block
+    if key is None:
+        return
+    pending = getattr(_deferred, 'keys', None)
+    if pending is None:
+        refresh_numbers([key])
+    else:
+        pending.add(key)
+
+
+@contextmanager
+def deferred_refresh():
+    # Batch directory maintenance for bulk writes: every touched number is refreshed once on exit
+    if getattr(_deferred, 'keys', None) is not None:
+        yield
+        return
+
+    _deferred.keys = set()
+    try:
+        yield
+    finally:
+        keys, _deferred.keys = _deferred.keys, None
+        refresh_numbers(keys)
+
+
+@transaction.atomic
+def rebuild_directory():
+    # Full rebuild, needed after writes that bypass model signals (bulk_create, raw SQL, fixtures)
+    keys = set()
+    for shard in shards():
+        keys.update(PhoneNumber.objects.using(shard).exclude(number_key=None).values_list('number_key', flat=True).distinct())
+    keys.update(CustomUser.objects.exclude(number_key=None).values_list('number_key', flat=True))
+    keys.update(SpamAction.objects.filter(is_marked_as_spam=True).exclude(number_key=None)
+                .values_list('number_key', flat=True).distinct())
+
+    NumberDirectory.objects.exclude(number_key__in=keys).delete()
+    return refresh_numbers(keys)
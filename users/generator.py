@@ -0,0 +1,289 @@
+import logging
+import os
+import random
+from collections import deque
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from django.contrib.auth.hashers import make_password
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+from users.cache import lookup_cache
+from users.directory import rebuild_directory
+from users.membership import membership_index, rebuild_memberships
+from users.models import (ContactMembership, CustomUser, NameCount, NameIndexEntry, NumberDirectory, PhoneNumber,
+                          SpamAction, UserContact)
+from users.name_counts import rebuild_name_counts
+from users.name_index import rebuild_name_index
+from users.numbers import number_key
+from users.sharding import group_by_shard, shard_connection, shard_for_key, shards
+from users.spam_feed import rebuild_spam_feed
+from users.spam_scores import recompute_spam_scores
+
+logger = logging.getLogger(__name__)
+
+# Deterministic data generator for development and load testing.
+#
+# Every generated value is derived from (seed, user index) only, so a dataset does not depend on how
+# it was split into chunks: an interrupted run resumes after the last committed chunk and a larger
+# --users appends to an existing dataset, both producing the same rows as a single run would.
+#
+# Numbers saved in contact lists are drawn from a pool where every third number belongs to a
+# (possibly not yet generated) user, with a skew towards the start of the pool so that a few
+# numbers are saved by many users. Spam reports are skewed the same way over a small set of spam
+# numbers. Both pools grow with the user index, one block of users at a time.
+
+USER_NUMBER_BASE = 6000000000
+OTHER_NUMBER_BASE = 8000000000
+SPAM_NUMBER_BASE = 9000000000
+
+# Users per growth step of the contact and spam number pools
+POOL_BLOCK = 10000
+# Pool sizes per block of users
+CONTACT_NUMBERS_PER_BLOCK = POOL_BLOCK * 3
+SPAM_NUMBERS_PER_BLOCK = 100
+
+# Spam reports are spread over this many days before the generation time
+REPORT_PERIOD_DAYS = 90
+
+# Share of the contacts saved under another name than the usual one of the number
+NAME_VARIANT_RATE = 0.3
+
+FIRST_NAMES = [
+    'Aarav', 'Priya', 'Rahul', 'Ananya', 'Vikram', 'Sneha', 'Arjun', 'Kavya', 'Rohan', 'Isha',
+    'John', 'Maria', 'David', 'Sarah', 'Michael', 'Emma', 'James', 'Olivia', 'Robert', 'Sophia',
+    'Mohammed', 'Fatima', 'Wei', 'Mei', 'Carlos', 'Lucia', 'Kenji', 'Yuki', 'Ivan', 'Olga',
+]
+LAST_NAMES = [
+    'Sharma', 'Patel', 'Singh', 'Kumar', 'Gupta', 'Chougule', 'Reddy', 'Iyer', 'Nair', 'Das',
+    'Smith', 'Johnson', 'Brown', 'Garcia', 'Miller', 'Davis', 'Wilson', 'Khan', 'Chen', 'Tanaka',
+]
+SPAM_NAMES = ['Spam', 'Telemarketer', 'Fraud', 'Loan Offer', 'Insurance', 'Do Not Pick']
+
+
+def skewed_choice(rng, values):
+    # Zipf-like pick: the first values are much more frequent than the last ones
+    return values[min(len(values) - 1, int(rng.paretovariate(1.2)) - 1)]
+
+
+def skewed_index(rng, size, skew=3):
+    # Index in [0, size) biased towards 0
+    return int(size * rng.random() ** skew)
+
+
+def random_name(rng):
+    return f'{skewed_choice(rng, FIRST_NAMES)} {skewed_choice(rng, LAST_NAMES)}'
+
+
+def user_number(index):
+    return str(USER_NUMBER_BASE + index)
+
+
+def pool_number(index):
+    # Every third number of the contact pool is the number of user index // 3
+    if index % 3 == 0:
+        return user_number(index // 3)
+    return str(OTHER_NUMBER_BASE + index)
+
+
+def spam_number(index):
+    return str(SPAM_NUMBER_BASE + index)
+
+
+def number_name(seed, index):
+    # Usual name of a pool number (for user numbers, the name of the user)
+    return random_name(random.Random(f'{seed}:name:{index}'))
+
+
+def generate_users(seed, start, end, contacts_per_user, spam_reports_per_user):
+    # Rows of the users [start, end): (user rows, contact rows, spam report rows), the last two
+    # referencing their user by index. Runs in the worker processes, so it must not touch the database.
+    users, contacts, reports = [], [], []
+    for index in range(start, end):
+        rng = random.Random(f'{seed}:user:{index}')
+        blocks = index // POOL_BLOCK + 1
+        number_pool = CONTACT_NUMBERS_PER_BLOCK * blocks
+        email = f'user{index}@example.com' if rng.random() < 0.8 else None
+        users.append((index, number_name(seed, index * 3), user_number(index), email))
+
+        # most users have a few contacts, some have many
+        count = min(number_pool, int(rng.expovariate(1 / contacts_per_user)) + 1)
+        saved = set()
+        for _ in range(count * 2):
+            if len(saved) >= count:
+                break
+            saved.add(skewed_index(rng, number_pool))
+        for contact in sorted(saved):
+            name = number_name(seed, contact) if rng.random() >= NAME_VARIANT_RATE else random_name(rng)
+            contacts.append((index, name, pool_number(contact)))
+
+        reported = set()
+        if spam_reports_per_user > 0:
+            for _ in range(int(rng.expovariate(1 / spam_reports_per_user))):
+                reported.add(skewed_index(rng, SPAM_NUMBERS_PER_BLOCK * blocks, skew=4))
+        # reports of the last REPORT_PERIOD_DAYS, as (user index, number, age in seconds)
+        reports.extend((index, spam_number(number), rng.random() * REPORT_PERIOD_DAYS * 86400) for number in sorted(reported))
+    return users, contacts, reports
+
+
+def generated_chunks(tasks, workers):
+    # Generate the chunks in a process pool and yield them in order, with a bounded number of
+    # chunks in flight so that memory does not grow when the writes are the bottleneck
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(generate_users, *task))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def insert_rows(model, fields, rows, using=None):
+    # Plain executemany INSERT, bulk loads would spend most of their time building model instances
+    if not rows:
+        return
+    connection = shard_connection(using)
+    quote = connection.ops.quote_name
+    columns = [model._meta.get_field(field).column for field in fields]
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        quote(model._meta.db_table),
+        ', '.join(quote(column) for column in columns),
+        ', '.join(['%s'] * len(columns)),
+    )
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+
+
+def generated_user_count():
+    # Users are generated in order and committed chunk by chunk, so the highest generated number
+    # tells where a previous run stopped
+    highest = (CustomUser.objects.filter(phone_number__gte=user_number(0), phone_number__lt=str(OTHER_NUMBER_BASE))
+               .aggregate(highest=Max('phone_number'))['highest'])
+    return 0 if highest is None else int(highest) - USER_NUMBER_BASE + 1
+
+
+def write_chunk(users, contacts, reports, password):
+    # The PhoneNumber rows of a sharded directory commit on their shards just before the rest of the
+    # chunk, and are deleted again if it fails to commit, so that the resumed run writes them once
+    inserted = {}
+    try:
+        _write_chunk(users, contacts, reports, password, inserted)
+    except BaseException:
+        for shard, first_id in inserted.items():
+            delete_shard_rows(shard, first_id)
+        raise
+
+
+def delete_shard_rows(shard, first_id):
+    # PhoneNumber rows from `first_id` on (generated chunks are the only writer, see generate())
+    quote = connection.ops.quote_name
+    try:
+        with transaction.atomic(using=shard), shard_connection(shard).cursor() as cursor:
+            cursor.execute(f'DELETE FROM {quote(PhoneNumber._meta.db_table)} WHERE {quote("id")} >= %s', [first_id])
+    except Exception:
+        logger.exception('Failed to delete the PhoneNumber rows of an interrupted chunk from %s (ids from %s)', shard, first_id)
+
+
+def _write_chunk(users, contacts, reports, password, inserted):
+    with transaction.atomic():
+        CustomUser.objects.bulk_create(
+            CustomUser(name=name, phone_number=number, number_key=number_key(number), email=email, password=password)
+            for index, name, number, email in users
+        )
+        user_ids = dict(CustomUser.objects.filter(phone_number__in=[number for index, name, number, email in users])
+                        .values_list('phone_number', 'id'))
+        ids = {index: user_ids[number] for index, name, number, email in users}
+
+        # contacts are mirrored into the global database, as contact imports do
+        keys = {number: number_key(number) for index, name, number in contacts}
+        insert_rows(UserContact, ('user', 'contact_name', 'phone_number', 'number_key'),
+                    [(ids[index], name, number, keys[number]) for index, name, number in contacts])
+        phone_numbers = {}
+        for index, name, number in contacts:
+            phone_numbers.setdefault(shard_for_key(keys[number]), []).append((name, number, keys[number], 0))
+        for shard, rows in phone_numbers.items():
+            with transaction.atomic(using=shard, savepoint=False):
+                first_id = (PhoneNumber.objects.using(shard).aggregate(last=Max('id'))['last'] or 0) + 1
+                insert_rows(PhoneNumber, ('name', 'number', 'number_key', 'spam_likelihood'), rows, using=shard)
+            if shard_connection(shard) is not connections[DEFAULT_DB_ALIAS]:
+                inserted[shard] = first_id
+        now = timezone.now()
+        insert_rows(SpamAction, ('user', 'phone_number', 'number_key', 'is_marked_as_spam', 'reported_at'),
+                    [(ids[index], number, number_key(number), True, now - timedelta(seconds=age)) for index, number, age in reports])
+
+
+@transaction.atomic
+def update_spam_scores():
+    # Spam likelihood of the global rows = number of reports, which is what report_spam maintains
+    # incrementally; reported numbers nobody saved get a row, as with report_spam
+    first_key = number_key(spam_number(0))
+    reports = SpamAction.objects.filter(is_marked_as_spam=True, number_key__gte=first_key)
+    counts = dict(reports.values_list('number_key').annotate(count=Count('id')).order_by())
+    saved = set()
+    for shard, keys in group_by_shard(counts).items():
+        saved.update(PhoneNumber.objects.using(shard).filter(number_key__in=keys).values_list('number_key', flat=True).distinct())
+    for key, count in counts.items():
+        if key in saved:
+            PhoneNumber.objects.using(shard_for_key(key)).filter(number_key=key).update(spam_likelihood=count)
+    numbers = {key: spam_number(key - first_key) for key in counts if key not in saved}
+    for shard, keys in group_by_shard(numbers).items():
+        PhoneNumber.objects.using(shard).bulk_create(
+            PhoneNumber(name=skewed_choice(random.Random(numbers[key]), SPAM_NAMES), number=numbers[key], number_key=key, spam_likelihood=counts[key])
+            for key in keys
+        )
+
+
+def clear():
+    # Delete the contacts, numbers and reports of everybody and the generated users. Raw deletes,
+    # the ORM would run the model signals (a directory refresh) for every single row.
+    quote = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        for model in (NameIndexEntry, NameCount, NumberDirectory, ContactMembership, SpamAction, UserContact, PhoneNumber):
+            cursor.execute(f'DELETE FROM {quote(model._meta.db_table)}')
+        cursor.execute(
+            f'DELETE FROM {quote(CustomUser._meta.db_table)} WHERE {quote("phone_number")} >= %s AND {quote("phone_number")} < %s',
+            [user_number(0), str(OTHER_NUMBER_BASE)],
+        )
+    # the PhoneNumber rows of a sharded directory (see users/sharding.py)
+    for shard in filter(None, shards()):
+        with transaction.atomic(using=shard), shard_connection(shard).cursor() as cursor:
+            for model in (NameIndexEntry, PhoneNumber):
+                cursor.execute(f'DELETE FROM {quote(model._meta.db_table)}')
+    lookup_cache.clear()
+    membership_index.clear()
+
+
+def generate(users, contacts_per_user=10, spam_reports_per_user=0.5, password='password', seed=42,
+             chunk_size=1000, workers=None, log=print):
+    # Generate users up to `users` in total (resuming after the already generated ones), then build
+    # the spam scores and the derived tables once for the whole dataset
+    start = generated_user_count()
+    if start >= users:
+        log(f'{start} users already generated')
+    else:
+        log(f'Generating users {start} to {users}')
+        password = make_password(password)
+        tasks = [(seed, chunk_start, min(users, chunk_start + chunk_size), contacts_per_user, spam_reports_per_user)
+                 for chunk_start in range(start, users, chunk_size)]
+
+        # the workers only generate rows, the writes stay in this process (one writer per database)
+        connections.close_all()
+        for users_rows, contacts, reports in generated_chunks(tasks, workers or os.cpu_count()):
+            write_chunk(users_rows, contacts, reports, password)
+            log(f'  users up to {users_rows[-1][0] + 1}: {len(contacts)} contacts, {len(reports)} spam reports')
+
+    log('Updating spam likelihoods')
+    update_spam_scores()
+    log('Building the name index')
+    rebuild_name_index()
+    log('Building the contact memberships')
+    rebuild_memberships()
+    log('Counting the names of every number')
+    rebuild_name_counts()
+    log('Building the number directory')
+    rebuild_directory()
+    log('Computing the spam scores')
+    recompute_spam_scores(workers=workers, log=log)
+    log('Recording the spam change feed')
+    rebuild_spam_feed()
@@ -0,0 +1,243 @@
+import logging
+import os
+import socket
+import threading
+import time
+from array import array
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Sum
+from users.cache import lookup_cache
+from users.directory import lookup_numbers
+from users.models import HotNumber
+
+logger = logging.getLogger(__name__)
+
+# Streaming heavy-hitter tracking of the numbers looked up (search/number/) and reported
+# (markSpam/), to spot spam campaigns and keep the lookups of their numbers pinned in the cache.
+#
+# Every process counts its requests in two Count-Min sketches of fixed size (HOT_NUMBERS
+# SKETCH_WIDTH x SKETCH_DEPTH counters) and keeps the TOP_K numbers with the highest estimates of
+# each. Counts are decayed: they halve every HALF_LIFE seconds, so a number stays hot only while
+# its surge lasts. Every PUBLISH_INTERVAL seconds a background thread replaces the HotNumber rows
+# of the process with its top numbers, then pins in the lookup cache the lookups of the hottest
+# numbers of all processes (see LookupCache.pin_numbers), so that the lookups of a campaign's
+# numbers are answered from memory and their reports do not turn into a query per lookup.
+
+# Mersenne prime of the sketch hash functions
+PRIME = 2 ** 61 - 1
+
+# (multiplier, increment) of the hash functions of the sketch rows; fixed, so that sketches of a
+# same size are comparable across processes and restarts
+HASH_SEEDS = (
+    (0x1f3a5c7e9b2d4f61, 0x0b7e151628aed2a6), (0x13198a2e03707344, 0x0a4093822299f31d),
+    (0x082efa98ec4e6c89, 0x052821e638d01377), (0x0be5466cf34e90c6, 0x0c0ac29b7c97c50d),
+    (0x1d5b5e5ef1c9a1b3, 0x03f84d5b5b547091), (0x179216d5d98979fb, 0x1bd1310ba698dfb5),
+    (0x0ac20d1a8a9d2c35, 0x0f12c4a38b1e4d3c), (0x0e8c5f1b4e9d7a2f, 0x06a09e667f3bcc90),
+)
+
+
+class CountMinSketch:
+    # Count-Min sketch with conservative update: `depth` rows of `width` counters, a number adds to
+    # one counter per row and its estimate is the smallest of them. Estimates never undercount, and
+    # overcount by at most a few times total / width.
+
+    def __init__(self, width, depth):
+        if depth > len(HASH_SEEDS):
+            raise ValueError(f"A sketch has at most {len(HASH_SEEDS)} rows.")
+        self.width = width
+        self.rows = [array('d', bytes(8 * width)) for row in range(depth)]
+        self.seeds = HASH_SEEDS[:depth]
+
+    def _cells(self, key):
+        return [(multiplier * key + increment) % PRIME % self.width for multiplier, increment in self.seeds]
+
+    def estimate(self, key):
+        return min(row[cell] for row, cell in zip(self.rows, self._cells(key)))
+
+    def add(self, key, count=1.0):
+        # Add `count` to a number and return its new estimate. Only the counters below the new
+        # estimate are raised (conservative update), which keeps the collisions from adding up.
+        cells = self._cells(key)
+        estimate = min(row[cell] for row, cell in zip(self.rows, cells)) + count
+        for row, cell in zip(self.rows, cells):
+            if row[cell] < estimate:
+                row[cell] = estimate
+        return estimate
+
+    def scale(self, factor):
+        for index, row in enumerate(self.rows):
+            self.rows[index] = array('d', (value * factor for value in row))
+
+
+class HeavyHitters:
+    # The `capacity` numbers with the highest estimates of a Count-Min sketch. A number enters the
+    # top when its estimate exceeds the lowest one of the top (kept as a floor, so that counting a
+    # number that is not hot costs no scan of the top).
+
+    def __init__(self, capacity, width, depth):
+        self.capacity = capacity
+        self.sketch = CountMinSketch(width, depth)
+        self.top = {}
+        self._floor = 0.0
+
+    def add(self, key, count=1.0):
+        estimate = self.sketch.add(key, count)
+        if key in self.top:
+            self.top[key] = estimate
+        elif len(self.top) < self.capacity:
+            self.top[key] = estimate
+            self._floor = min(self.top.values())
+        elif estimate > self._floor:
+            del self.top[min(self.top, key=self.top.get)]
+            self.top[key] = estimate
+            self._floor = min(self.top.values())
+        return estimate
+
+    def estimate(self, key):
+        return self.top.get(key) or self.sketch.estimate(key)
+
+    def decay(self, factor):
+        self.sketch.scale(factor)
+        self.top = {key: count * factor for key, count in self.top.items()}
+        self._floor *= factor
+
+
+class HotNumbers:
+    # Heavy hitters of this process and publisher of the HotNumber rows. Counting is in memory under
+    # a lock; the database is only written by the publishing thread.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lookups = None
+        self._reports = None
+        self._decayed_at = time.monotonic()
+        self._thread = None
+        self._published_at = None
+        self._pinned_at = None
+
+    @property
+    def config(self):
+        return settings.HOT_NUMBERS
+
+    def _trackers(self):
+        # (lookups, reports) heavy hitters, created on first use with the configured sizes
+        if self._lookups is None:
+            config = self.config
+            self._lookups = HeavyHitters(config['TOP_K'], config['SKETCH_WIDTH'], config['SKETCH_DEPTH'])
+            self._reports = HeavyHitters(config['TOP_K'], config['SKETCH_WIDTH'], config['SKETCH_DEPTH'])
+        return self._lookups, self._reports
+
+    def _decay(self):
+        # Halve the counts once per elapsed HALF_LIFE; called with the lock held
+        half_lives = int((time.monotonic() - self._decayed_at) // self.config['HALF_LIFE'])
+        if half_lives > 0:
+            for tracker in self._trackers():
+                tracker.decay(0.5 ** half_lives)
+            self._decayed_at += half_lives * self.config['HALF_LIFE']
+
+    def _record(self, index, key):
+        if key is None or not self.config['ENABLED']:
+            return
+        with self._lock:
+            self._decay()
+            self._trackers()[index].add(key)
+        if self.config['PUBLISH_INTERVAL'] > 0:
+            self._ensure_thread()
+
+    def record_lookup(self, key):
+        self._record(0, key)
+
+    def record_report(self, key):
+        self._record(1, key)
+
+    def local_top(self):
+        # [(number_key, lookups, reports)] of the top numbers of this process, hottest first
+        with self._lock:
+            self._decay()
+            lookups, reports = self._trackers()
+            rows = [(key, lookups.estimate(key), reports.estimate(key)) for key in {*lookups.top, *reports.top}]
+        return sorted(rows, key=lambda row: row[1] + row[2], reverse=True)
+
+    @staticmethod
+    def process_name():
+        # computed on every publish, forked workers get their own name
+        return f'{socket.gethostname()}:{os.getpid()}'[:64]
+
+    def publish(self):
+        # Replace the HotNumber rows of this process by its current top numbers (and drop the rows
+        # of processes that stopped publishing); returns the number of rows written
+        process = self.process_name()
+        now = time.time()
+        rows = [HotNumber(process=process, number_key=key, lookups=lookups, reports=reports, published_at=now)
+                for key, lookups, reports in self.local_top()]
+        with transaction.atomic():
+            HotNumber.objects.filter(process=process).delete()
+            HotNumber.objects.filter(published_at__lt=now - self.config['STALE_AFTER']).delete()
+            HotNumber.objects.bulk_create(rows)
+        self._published_at = now
+        return len(rows)
+
+    def hottest(self, limit=None):
+        # [{"number_key", "lookups", "reports", "heat"}] of the hottest numbers of all the
+        # processes that published recently, hottest first
+        rows = (HotNumber.objects.filter(published_at__gte=time.time() - self.config['STALE_AFTER'])
+                .values('number_key')
+                .annotate(lookups=Sum('lookups'), reports=Sum('reports'))
+                .annotate(heat=F('lookups') + F('reports'))
+                .order_by('-heat', 'number_key'))
+        return list(rows[:limit or self.config['TOP_K']])
+
+    def prewarm(self):
+        # Pin the lookups of the PIN_COUNT hottest numbers that reach PIN_MIN_COUNT in the lookup
+        # cache (and unpin the numbers that cooled down); returns the number of lookups computed
+        config = self.config
+        keys = [row['number_key'] for row in self.hottest(config['PIN_COUNT']) if row['heat'] >= config['PIN_MIN_COUNT']]
+        computed = lookup_cache.pin_numbers(keys, lookup_numbers)
+        self._pinned_at = time.time()
+        return computed
+
+    def stats(self):
+        with self._lock:
+            tracked = 0 if self._lookups is None else len({*self._lookups.top, *self._reports.top})
+        return {
+            'process': self.process_name(),
+            'tracked_numbers': tracked,
+            'published_at': self._published_at,
+            'pinned_at': self._pinned_at,
+            'pinned_numbers': lookup_cache.stats()['pinned_numbers'],
+        }
+
+    def clear(self):
+        with self._lock:
+            self._lookups = self._reports = None
+            self._decayed_at = time.monotonic()
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='hot-numbers-publisher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        # stops when the publishing is disabled. The pinned lookups are refreshed even when publishing
+        # fails (from the rows the other processes published), they expire otherwise.
+        while self.config['PUBLISH_INTERVAL'] > 0:
+            time.sleep(self.config['PUBLISH_INTERVAL'])
+            close_old_connections()
+            try:
+                self.publish()
+            except Exception:
+                logger.exception('Failed to publish hot numbers, retrying in %s seconds', self.config['PUBLISH_INTERVAL'])
+            try:
+                self.prewarm()
+            except Exception:
+                logger.exception('Failed to refresh the pinned lookups, retrying in %s seconds', self.config['PUBLISH_INTERVAL'])
+            finally:
+                close_old_connections()
+
+
+hot_numbers = HotNumbers()
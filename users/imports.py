@@ -0,0 +1,151 @@
+import codecs
+import csv
+import json
+import logging
+from collections import Counter
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from users.directory import deferred_refresh, schedule_refresh
+from users.membership import add_new_memberships
+from users.name_counts import add_names
+from users.models import NameIndexEntry, PhoneNumber, UserContact
+from users.name_index import index_new_phone_numbers
+from users.numbers import format_key, number_key
+from users.sharding import delete_rows, group_by_shard, shard_connection
+
+logger = logging.getLogger(__name__)
+
+# Accepted column / key names for the two fields of a contact
+NAME_FIELDS = ('name', 'contact_name')
+PHONE_FIELDS = ('phone', 'phone_number', 'number')
+
+class ImportFormatError(ValueError):
+    pass
+
+
+def _first_value(row, fields):
+    for field in fields:
+        value = row.get(field)
+        if value not in (None, ''):
+            return value
+    return None
+
+
+def iter_ndjson_rows(lines):
+    # One JSON object per line; malformed lines are yielded as None so that they are counted as invalid
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield None
+            continue
+        yield row if isinstance(row, dict) else None
+
+
+def iter_csv_rows(lines):
+    # CSV with a header row naming the name and phone columns
+    reader = csv.DictReader(lines)
+    if reader.fieldnames is None:
+        return
+    fieldnames = {field.strip().lower() for field in reader.fieldnames if field}
+    if not fieldnames & set(NAME_FIELDS) or not fieldnames & set(PHONE_FIELDS):
+        raise ImportFormatError(f"CSV header must contain one of {NAME_FIELDS} and one of {PHONE_FIELDS}.")
+    reader.fieldnames = [(field or '').strip().lower() for field in reader.fieldnames]
+    yield from reader
+
+
+def iter_upload_rows(stream, content_type):
+    # Decode the upload lazily, line by line, so that memory does not grow with the upload size
+    lines = codecs.iterdecode(stream, 'utf-8-sig', errors='replace')
+    if 'csv' in content_type:
+        return iter_csv_rows(lines)
+    if 'json' in content_type:
+        return iter_ndjson_rows(lines)
+    raise ImportFormatError("Unsupported content type, upload NDJSON (application/x-ndjson) or CSV (text/csv).")
+
+
+def import_contacts(user, rows, chunk_size=None, max_rows=None):
+    # Normalize, deduplicate and store contacts in chunks, each chunk in its own short transaction.
+    # Only user.pk is used, so the token user of the request will do.
+    chunk_size = chunk_size or settings.CONTACT_IMPORT_CHUNK_SIZE
+    max_rows = max_rows or settings.CONTACT_IMPORT_MAX_ROWS
+    summary = {'imported': 0, 'duplicates': 0, 'invalid': 0, 'truncated': False}
+
+    # numbers already saved by the user are skipped, as are repeats inside the upload; read on the
+    # primary, a lagging replica would miss the contacts the user just saved
+    known_keys = set(UserContact.objects.using(DEFAULT_DB_ALIAS).filter(user_id=user.pk).exclude(number_key=None).values_list('number_key', flat=True))
+    chunk = []
+    for count, row in enumerate(rows):
+        if count >= max_rows:
+            summary['truncated'] = True
+            break
+
+        name = _first_value(row, NAME_FIELDS) if row else None
+        key = number_key(_first_value(row, PHONE_FIELDS)) if row else None
+        name = ' '.join(str(name).split())[:255] if name is not None else ''
+        if not name or key is None:
+            summary['invalid'] += 1
+            continue
+        if key in known_keys:
+            summary['duplicates'] += 1
+            continue
+
+        known_keys.add(key)
+        chunk.append((name, key))
+        if len(chunk) >= chunk_size:
+            summary['imported'] += _write_chunk(user, chunk)
+            chunk = []
+
+    if chunk:
+        summary['imported'] += _write_chunk(user, chunk)
+    return summary
+
+
+def _write_chunk(user, chunk):
+    # bulk_create bypasses the model signals, so the number keys, the name index and the directory
+    # are maintained here. Numbers are stored in their E.164 form. The global rows go to the shards
+    # of their numbers (see users/sharding.py), in one transaction per shard. A shard on its own
+    # database commits just before the rest of the chunk, so its rows are deleted again if the chunk
+    # fails to commit (as users/generator.py does).
+    committed = {}
+    try:
+        return _write_rows(user, chunk, committed)
+    except BaseException:
+        for shard, ids in committed.items():
+            _delete_shard_rows(shard, ids)
+        raise
+
+
+def _delete_shard_rows(shard, ids):
+    # Raw deletes: the model signals of the rows wrote to the default database, which rolled back
+    try:
+        with transaction.atomic(using=shard):
+            NameIndexEntry.objects.using(shard).filter(phone_number_id__in=ids).delete()
+            delete_rows(PhoneNumber, ids, using=shard)
+    except Exception:
+        logger.exception('Failed to delete the PhoneNumber rows of an interrupted import from %s', shard)
+
+
+def _write_rows(user, chunk, committed):
+    names = {key: name for name, key in chunk}
+    with deferred_refresh(), transaction.atomic():
+        UserContact.objects.bulk_create(
+            UserContact(user_id=user.pk, contact_name=name, phone_number=format_key(key), number_key=key) for name, key in chunk
+        )
+        for shard, keys in group_by_shard(names).items():
+            with transaction.atomic(using=shard, savepoint=False):
+                phone_numbers = PhoneNumber.objects.using(shard).bulk_create(
+                    PhoneNumber(name=names[key], number=format_key(key), number_key=key) for key in keys
+                )
+                index_new_phone_numbers(phone_numbers, using=shard)
+            if shard_connection(shard) is not connections[DEFAULT_DB_ALIAS]:
+                committed[shard] = [phone_number.pk for phone_number in phone_numbers]
+        add_names(Counter((key, name) for name, key in chunk))
+        add_new_memberships(user.pk, [key for name, key in chunk])
+        # queue the touched numbers for one set-based directory refresh after the commit
+        for name, key in chunk:
+            schedule_refresh(key)
+    return len(chunk)
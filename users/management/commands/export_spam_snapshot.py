@@ -0,0 +1,19 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from users.spam_snapshot import export_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Export the spam signals of every reported number to the memory-mapped snapshot used by the score lookups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=None, help="Snapshot file (default: SPAM_SNAPSHOT['PATH'])")
+
+    def handle(self, *args, **options):
+        path = options['output'] or settings.SPAM_SNAPSHOT['PATH']
+        if not path:
+            raise CommandError('No snapshot file, set SPAM_SNAPSHOT_PATH or pass --output.')
+        start = time.perf_counter()
+        count = export_snapshot(path)
+        self.stdout.write(self.style.SUCCESS(f'Spam snapshot of {count} numbers written to {path} in {time.perf_counter() - start:.1f} s'))
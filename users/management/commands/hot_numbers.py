@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from users.heavy_hitters import hot_numbers
+from users.numbers import format_key
+
+
+class Command(BaseCommand):
+    help = 'Show the hottest looked up and reported numbers published by the worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20, help='Number of numbers to show')
+
+    def handle(self, *args, **options):
+        rows = hot_numbers.hottest(options['limit'])
+        if not rows:
+            self.stdout.write('No hot numbers published recently')
+            return
+        self.stdout.write(f"{'number':<18}{'lookups':>10}{'reports':>10}")
+        for row in rows:
+            self.stdout.write(f"{format_key(row['number_key']):<18}{row['lookups']:>10.1f}{row['reports']:>10.1f}")
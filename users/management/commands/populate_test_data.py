@@ -1,42 +1,33 @@
-import random
+import time
 from django.core.management.base import BaseCommand
-from users.models import CustomUser, UserContact, PhoneNumber
+from users import generator
 
-class Command(BaseCommand):
-    help = 'Populate database with random sample data'
-
-    def handle(self, *args, **options):
-        # Delete all users except the admin
-        user_to_keep = CustomUser.objects.get(phone_number='1234567890')
-        users_to_delete = CustomUser.objects.exclude(id=user_to_keep.id)
-        users_to_delete.delete()
-
-        # Delete all other data
-        UserContact.objects.all().delete()
-        PhoneNumber.objects.all().delete()
 
-        # Generate random sample data
-        for _ in range(50):  # Adjust the number based on your needs
-            user = CustomUser.objects.create(
-                name=f'CustomUser{random.randint(1, 100)}',
-                phone_number=f'{random.randint(1000000000, 9999999999)}',
-                email=f'user{random.randint(1, 100)}@example.com'
-            )
-
-            # Create contacts for each user
-            for _ in range(random.randint(1, 10)):
-                contact = UserContact.objects.create(
-                    user=user,
-                    contact_name=f'Contact{random.randint(1, 100)}',  
-                    phone_number=f'{random.randint(1000000000, 9999999999)}'
-                )
+class Command(BaseCommand):
+    help = 'Generate a deterministic sample dataset (resumes or extends an existing one)'
 
-            # Create random phone numbers
-            for _ in range(random.randint(1, 10)):
-                PhoneNumber.objects.create(
-                    name=f'Phone{random.randint(1, 100)}',
-                    number=f'{random.randint(1000000000, 9999999999)}',
-                    spam_likelihood=random.randint(0, 100)
-                )
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help='Total number of generated users')
+        parser.add_argument('--contacts-per-user', type=int, default=10, help='Average contact list size')
+        parser.add_argument('--spam-reports-per-user', type=float, default=0.5, help='Average spam reports per user')
+        parser.add_argument('--password', default='password', help='Password of every generated user')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Users generated and written per transaction')
+        parser.add_argument('--workers', type=int, default=None, help='Generator processes (default: one per CPU)')
+        parser.add_argument('--reset', action='store_true', help='Delete all users, contacts, numbers and reports first')
 
-        self.stdout.write(self.style.SUCCESS('Database populated with random sample data'))
\ No newline at end of file
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        if options['reset']:
+            generator.clear()
+        generator.generate(
+            users=options['users'],
+            contacts_per_user=options['contacts_per_user'],
+            spam_reports_per_user=options['spam_reports_per_user'],
+            password=options['password'],
+            seed=options['seed'],
+            chunk_size=options['chunk_size'],
+            workers=options['workers'],
+            log=self.stdout.write,
+        )
+        self.stdout.write(self.style.SUCCESS(f'Database populated in {time.perf_counter() - start:.1f} s'))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from users.models import ShardPrefix
+from users.rebalancing import InvalidAssignment, assign_prefix, rebalance, unassign_prefix, wait_for_workers
+from users.sharding import sharded
+
+
+class Command(BaseCommand):
+    help = 'Assign number prefixes to directory shards and move the PhoneNumber rows that are not on their shard'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--assign', nargs=2, metavar=('PREFIX', 'SHARD'), help='Assign the numbers starting with PREFIX to SHARD')
+        parser.add_argument('--unassign', metavar='PREFIX', help='Remove the assignment of PREFIX')
+        parser.add_argument('--no-wait', action='store_true',
+                            help='Move the rows right away, without waiting for the workers to reload the assignments')
+
+    def handle(self, *args, **options):
+        if not sharded():
+            raise CommandError('The directory is not sharded, set DIRECTORY_SHARDS (or SQLITE_SHARD_PATHS).')
+        prefix = None
+        try:
+            if options['assign']:
+                prefix = assign_prefix(*options['assign'])
+            elif options['unassign']:
+                prefix = unassign_prefix(options['unassign'])
+        except InvalidAssignment as e:
+            raise CommandError(str(e))
+        if prefix is not None and not options['no_wait']:
+            self.stdout.write('Waiting for the workers to reload the shard assignments')
+            wait_for_workers()
+
+        moved = rebalance(prefix, log=self.stdout.write)
+        for assignment in ShardPrefix.objects.order_by('prefix'):
+            self.stdout.write(f'  +{assignment.prefix} -> {assignment.shard}')
+        self.stdout.write(self.style.SUCCESS(f'{moved} rows moved'))
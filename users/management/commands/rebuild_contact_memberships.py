@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from users.membership import rebuild_memberships
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the reverse contact membership table from all UserContact rows'
+
+    def handle(self, *args, **options):
+        count = rebuild_memberships()
+        self.stdout.write(self.style.SUCCESS(f'Contact memberships rebuilt: {count} (number, owner) pairs'))
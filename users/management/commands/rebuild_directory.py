@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from users.directory import rebuild_directory
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the canonical number directory from PhoneNumber, SpamAction and CustomUser rows'
+
+    def handle(self, *args, **options):
+        count = rebuild_directory()
+        self.stdout.write(self.style.SUCCESS(f'Number directory rebuilt for {count} numbers'))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from users.name_counts import rebuild_name_counts
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-number name frequencies from all PhoneNumber rows'
+
+    def handle(self, *args, **options):
+        count = rebuild_name_counts()
+        self.stdout.write(self.style.SUCCESS(f'Name frequencies rebuilt: {count} (number, name) pairs'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from users.name_index import rebuild_name_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the name search index from all PhoneNumber rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Index entries inserted per bulk_create')
+
+    def handle(self, *args, **options):
+        count = rebuild_name_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Name index rebuilt for {count} phone numbers'))
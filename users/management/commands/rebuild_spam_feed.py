@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from users.spam_feed import rebuild_spam_feed
+
+
+class Command(BaseCommand):
+    help = 'Record the current spam signals of every reported number in the spam change feed'
+
+    def handle(self, *args, **options):
+        count = rebuild_spam_feed()
+        self.stdout.write(self.style.SUCCESS(f'Spam change feed rebuilt: {count} changes recorded'))
@@ -0,0 +1,16 @@
+import time
+from django.core.management.base import BaseCommand
+from users.spam_scores import recompute_spam_scores
+
+
+class Command(BaseCommand):
+    help = 'Recompute the time-decayed spam scores of all numbers from the report timestamps'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='Scoring processes (default: one per CPU)')
+        parser.add_argument('--shards', type=int, default=None, help='Number ranges scored independently (default: 4 per worker)')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        count = recompute_spam_scores(workers=options['workers'], shards=options['shards'], log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(f'Spam scores recomputed for {count} reported numbers in {time.perf_counter() - start:.1f} s'))
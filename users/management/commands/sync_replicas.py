@@ -0,0 +1,26 @@
+import sqlite3
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class Command(BaseCommand):
+    help = 'Copy the primary SQLite database to the SQLite read replicas (local stand-in for replication)'
+
+    def handle(self, *args, **options):
+        replicas = settings.DATABASE_ROUTING['REPLICAS']
+        if not replicas:
+            raise CommandError('No replicas configured, set SQLITE_REPLICA_PATHS.')
+        for alias in [DEFAULT_DB_ALIAS, *replicas]:
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError(f"'{alias}' is not a SQLite database, its replication is managed by the database server.")
+
+        primary = connections[DEFAULT_DB_ALIAS]
+        primary.ensure_connection()
+        for alias in replicas:
+            # the online backup API copies a consistent snapshot while the primary stays writable
+            connections[alias].close()
+            with sqlite3.connect(connections[alias].settings_dict['NAME']) as replica:
+                primary.connection.backup(replica)
+            replica.close()
+            self.stdout.write(self.style.SUCCESS(f"Replica '{alias}' synced"))
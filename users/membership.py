@@ -0,0 +1,237 @@
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from users.models import ContactMembership, UserContact
+
+
+class BloomFilter:
+    # Fixed-size Bloom filter over number keys: no false negatives, about `error_rate` false positives
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # double hashing over one 128-bit digest
+        digest = hashlib.blake2b(value.to_bytes(8, 'little'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class MembershipIndex:
+    # Answers "has owner saved this number?" for the email visibility rule.
+    #
+    # The source of truth is the composite-indexed ContactMembership table. In front of it, every
+    # process keeps a bounded LRU of per-owner Bloom filters: a negative answer (the common case)
+    # needs no query at all, a positive one is confirmed with a single indexed point lookup.
+    # Filters only learn about contacts added in this process, so they expire after
+    # CONTACT_BLOOM_FILTERS['TTL'] seconds to pick up writes made by other workers.
+
+    def __init__(self):
+        self._filters = OrderedDict()
+        self._lock = threading.Lock()
+        self.skipped_queries = 0
+        self.queries = 0
+
+    @property
+    def config(self):
+        return settings.CONTACT_BLOOM_FILTERS
+
+    def _cached_filter(self, owner_id):
+        with self._lock:
+            item = self._filters.get(owner_id)
+            if item is None:
+                return None
+            expires_at, bloom = item
+            if expires_at <= time.monotonic():
+                del self._filters[owner_id]
+                return None
+            self._filters.move_to_end(owner_id)
+            return bloom
+
+    def _store_filter(self, owner_id, keys):
+        # headroom so that contacts added later in this process keep the error rate low
+        bloom = BloomFilter(len(keys) * 2 + 64, self.config['ERROR_RATE'])
+        for key in keys:
+            bloom.add(key)
+        with self._lock:
+            self._filters[owner_id] = (time.monotonic() + self.config['TTL'], bloom)
+            self._filters.move_to_end(owner_id)
+            while len(self._filters) > self.config['MAX_OWNERS']:
+                self._filters.popitem(last=False)
+        return bloom
+
+    def _filter(self, owner_id):
+        bloom = self._cached_filter(owner_id)
+        if bloom is None:
+            keys = list(ContactMembership.objects.filter(owner_id=owner_id).values_list('number_key', flat=True))
+            bloom = self._store_filter(owner_id, keys)
+        return bloom
+
+    async def _afilter(self, owner_id):
+        bloom = self._cached_filter(owner_id)
+        if bloom is None:
+            memberships = ContactMembership.objects.filter(owner_id=owner_id).values_list('number_key', flat=True)
+            bloom = self._store_filter(owner_id, [key async for key in memberships])
+        return bloom
+
+    def _count(self, skipped):
+        with self._lock:
+            if skipped:
+                self.skipped_queries += 1
+            else:
+                self.queries += 1
+
+    def has_saved(self, owner_id, key):
+        if key is None:
+            return False
+        if not self.config['ENABLED']:
+            return ContactMembership.objects.filter(number_key=key, owner_id=owner_id).exists()
+        if key not in self._filter(owner_id):
+            self._count(skipped=True)
+            return False
+        self._count(skipped=False)
+        return ContactMembership.objects.filter(number_key=key, owner_id=owner_id).exists()
+
+    async def ahas_saved(self, owner_id, key):
+        if key is None:
+            return False
+        if not self.config['ENABLED']:
+            return await ContactMembership.objects.filter(number_key=key, owner_id=owner_id).aexists()
+        if key not in await self._afilter(owner_id):
+            self._count(skipped=True)
+            return False
+        self._count(skipped=False)
+        return await ContactMembership.objects.filter(number_key=key, owner_id=owner_id).aexists()
+
+    def candidates(self, owner_ids, key):
+        # Owners that may have saved the number; the others definitely have not
+        if key is None:
+            return set()
+        if not self.config['ENABLED']:
+            return set(owner_ids)
+        return {owner_id for owner_id in owner_ids if key in self._filter(owner_id)}
+
+    def owners_with_number(self, owner_ids, key):
+        # Set-based variant of has_saved for the batch lookups: one query for all maybe-owners
+        owner_ids = self.candidates(owner_ids, key)
+        if not owner_ids:
+            return set()
+        return set(ContactMembership.objects.filter(number_key=key, owner_id__in=owner_ids).values_list('owner_id', flat=True))
+
+    async def aowners_with_number(self, owner_ids, key):
+        if key is None:
+            return set()
+        if self.config['ENABLED']:
+            owner_ids = {owner_id for owner_id in owner_ids if key in await self._afilter(owner_id)}
+        if not owner_ids:
+            return set()
+        memberships = ContactMembership.objects.filter(number_key=key, owner_id__in=owner_ids).values_list('owner_id', flat=True)
+        return {owner_id async for owner_id in memberships}
+
+    def added(self, owner_id, keys):
+        # Keep the local filter of the owner complete after its contacts were saved
+        bloom = self._cached_filter(owner_id)
+        if bloom is not None:
+            for key in keys:
+                bloom.add(key)
+
+    def clear(self):
+        with self._lock:
+            self._filters.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'owners_cached': len(self._filters),
+                'queries': self.queries,
+                'skipped_queries': self.skipped_queries,
+            }
+
+
+membership_index = MembershipIndex()
+
+
+def add_membership(owner_id, key):
+    # One more UserContact row of the owner for the number key
+    with transaction.atomic():
+        updated = ContactMembership.objects.filter(number_key=key, owner_id=owner_id).update(saved_count=F('saved_count') + 1)
+        if not updated:
+            try:
+                with transaction.atomic():
+                    ContactMembership.objects.create(number_key=key, owner_id=owner_id)
+            except IntegrityError:
+                # created concurrently by another worker
+                ContactMembership.objects.filter(number_key=key, owner_id=owner_id).update(saved_count=F('saved_count') + 1)
+    membership_index.added(owner_id, [key])
+
+
+def remove_membership(owner_id, key):
+    # One UserContact row of the owner for the number less; the pair disappears with the last one
+    with transaction.atomic():
+        ContactMembership.objects.filter(number_key=key, owner_id=owner_id).update(saved_count=F('saved_count') - 1)
+        ContactMembership.objects.filter(number_key=key, owner_id=owner_id, saved_count__lte=0).delete()
+
+
+def remove_memberships(counts):
+    # Set-based counterpart of remove_membership() for {(owner_id, number_key): UserContact rows removed}
+    rows = [(count, key, owner_id) for (owner_id, key), count in counts.items() if key is not None]
+    if not rows:
+        return
+    quote = connection.ops.quote_name
+    sql = 'UPDATE {table} SET {saved_count} = {saved_count} - %s WHERE {number_key} = %s AND {owner} = %s'.format(
+        table=quote(ContactMembership._meta.db_table),
+        saved_count=quote('saved_count'),
+        number_key=quote('number_key'),
+        owner=quote(ContactMembership._meta.get_field('owner').column),
+    )
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, rows)
+        ContactMembership.objects.filter(owner_id__in={owner_id for count, key, owner_id in rows}, saved_count__lte=0).delete()
+
+
+def add_new_memberships(owner_id, keys):
+    # Bulk path for imports, where the numbers are known not to be saved by the owner yet
+    ContactMembership.objects.bulk_create(
+        [ContactMembership(number_key=key, owner_id=owner_id) for key in keys],
+        ignore_conflicts=True,
+    )
+    membership_index.added(owner_id, keys)
+
+
+@transaction.atomic
+def rebuild_memberships():
+    # Full rebuild from UserContact, needed after writes that bypass model signals. A single
+    # INSERT ... SELECT, so that the aggregation never leaves the database.
+    ContactMembership.objects.all().delete()
+    quote = connection.ops.quote_name
+    contact_fields = [UserContact._meta.get_field(field).column for field in ('number_key', 'user')]
+    membership_fields = [ContactMembership._meta.get_field(field).column for field in ('number_key', 'owner', 'saved_count')]
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO {} ({}) SELECT {}, COUNT(*) FROM {} WHERE {} IS NOT NULL GROUP BY {}'.format(
+            quote(ContactMembership._meta.db_table),
+            ', '.join(quote(column) for column in membership_fields),
+            ', '.join(quote(column) for column in contact_fields),
+            quote(UserContact._meta.db_table),
+            quote(contact_fields[0]),
+            ', '.join(quote(column) for column in contact_fields),
+        ))
+        count = cursor.rowcount
+    membership_index.clear()
+    return count
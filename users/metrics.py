@@ -0,0 +1,182 @@
+import bisect
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Bucket upper bounds of the request histograms
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# At most this many statements are kept per request for the slow request log
+SLOW_REQUEST_MAX_QUERIES = 50
+
+# Statistics of the request being handled, visible from every thread running code for it
+# (sync_to_async and the shard query pool copy the context into their worker threads)
+_current = ContextVar('request_stats', default=None)
+
+
+class RequestStats:
+    # Everything measured while handling one request
+
+    def __init__(self, keep_sql=False):
+        self.started_at = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.keep_sql = keep_sql
+        self.statements = []
+        # the shard queries of a request run on several threads (see users/sharding.py)
+        self._lock = threading.Lock()
+
+    def record_query(self, sql, duration):
+        with self._lock:
+            self.queries += 1
+            self.db_time += duration
+            if self.keep_sql and len(self.statements) < SLOW_REQUEST_MAX_QUERIES:
+                self.statements.append((duration, sql))
+
+
+def record_query(execute, sql, params, many, context):
+    # Execute wrapper installed on every database connection (see users/signals.py)
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.record_query(sql, time.perf_counter() - start)
+
+
+def install_query_recorder(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class Histogram:
+    # Cumulative histogram in the Prometheus sense: counts per upper bound, plus sum and count
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        # (le, cumulative count) pairs, ending with +Inf
+        total = 0
+        for bound, count in zip([*self.buckets, float('inf')], self.counts):
+            total += count
+            yield bound, total
+
+
+class RequestMetrics:
+    # Per-process aggregates of the requests, by route and method
+
+    HISTOGRAMS = {
+        'request_duration_seconds': ('Wall time of the request', DURATION_BUCKETS),
+        'request_db_queries': ('SQL queries run by the request', QUERY_COUNT_BUCKETS),
+        'request_db_duration_seconds': ('Time spent in SQL queries by the request', DURATION_BUCKETS),
+        'response_size_bytes': ('Size of the response body (streamed responses excluded)', SIZE_BUCKETS),
+    }
+
+    def __init__(self, prefix='truedetector'):
+        self.prefix = prefix
+        self._histograms = {name: {} for name in self.HISTOGRAMS}
+        self._requests = {}
+        self._lock = threading.Lock()
+
+    def _observe(self, name, labels, value):
+        histogram = self._histograms[name].get(labels)
+        if histogram is None:
+            histogram = self._histograms[name][labels] = Histogram(self.HISTOGRAMS[name][1])
+        histogram.observe(value)
+
+    def observe(self, route, method, status, stats, duration, size):
+        with self._lock:
+            key = (route, method, str(status))
+            self._requests[key] = self._requests.get(key, 0) + 1
+            labels = (route, method)
+            self._observe('request_duration_seconds', labels, duration)
+            self._observe('request_db_queries', labels, stats.queries)
+            self._observe('request_db_duration_seconds', labels, stats.db_time)
+            if size is not None:
+                self._observe('response_size_bytes', labels, size)
+
+    def clear(self):
+        with self._lock:
+            self._histograms = {name: {} for name in self.HISTOGRAMS}
+            self._requests.clear()
+
+    def render(self):
+        # Prometheus text exposition format, version 0.0.4
+        lines = []
+        with self._lock:
+            name = f'{self.prefix}_requests_total'
+            lines += [f'# HELP {name} Requests handled by this process', f'# TYPE {name} counter']
+            for (route, method, status), count in sorted(self._requests.items()):
+                lines.append(f'{name}{{route="{escape(route)}",method="{method}",status="{status}"}} {count}')
+
+            for metric, (help_text, buckets) in self.HISTOGRAMS.items():
+                name = f'{self.prefix}_{metric}'
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for (route, method), histogram in sorted(self._histograms[metric].items()):
+                    labels = f'route="{escape(route)}",method="{method}"'
+                    for bound, count in histogram.samples():
+                        le = '+Inf' if bound == float('inf') else format_number(bound)
+                        lines.append(f'{name}_bucket{{{labels},le="{le}"}} {count}')
+                    lines.append(f'{name}_sum{{{labels}}} {format_number(histogram.sum)}')
+                    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+request_metrics = RequestMetrics()
+
+
+def start_request():
+    threshold = settings.REQUEST_METRICS['SLOW_REQUEST_THRESHOLD']
+    stats = RequestStats(keep_sql=threshold is not None and settings.REQUEST_METRICS['LOG_SLOW_REQUEST_SQL'])
+    return stats, _current.set(stats)
+
+
+def finish_request(request, response, stats, token):
+    _current.reset(token)
+    duration = time.perf_counter() - stats.started_at
+
+    # the route pattern, not the path, so that the label cardinality stays bounded
+    match = getattr(request, 'resolver_match', None)
+    route = match.route if match is not None else 'unmatched'
+    # streamed bodies are produced after the view returns and are not measured
+    size = None if response.streaming else len(response.content)
+    request_metrics.observe(route, request.method, response.status_code, stats, duration, size)
+
+    threshold = settings.REQUEST_METRICS['SLOW_REQUEST_THRESHOLD']
+    if threshold is not None and duration >= threshold:
+        log_slow_request(request, route, stats, duration)
+
+
+def log_slow_request(request, route, stats, duration):
+    message = [f'Slow request {request.method} {request.path} ({route}): {duration * 1000:.1f} ms, '
+               f'{stats.queries} queries in {stats.db_time * 1000:.1f} ms']
+    for query_duration, sql in stats.statements:
+        message.append(f'  {query_duration * 1000:.1f} ms  {sql}')
+    if stats.queries > len(stats.statements) and stats.keep_sql:
+        message.append(f'  ... {stats.queries - len(stats.statements)} more')
+    logger.warning('\n'.join(message))
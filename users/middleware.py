@@ -0,0 +1,58 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from users import metrics, routers
+
+
+class RequestMetricsMiddleware:
+    # Records wall time, SQL queries, DB time and response size of every request per route
+    # (see users/metrics.py); works in front of both the sync and the async views
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats, token = metrics.start_request()
+        response = self.get_response(request)
+        metrics.finish_request(request, response, stats, token)
+        return response
+
+    async def __acall__(self, request):
+        stats, token = metrics.start_request()
+        response = await self.get_response(request)
+        metrics.finish_request(request, response, stats, token)
+        return response
+
+
+class DatabaseRoutingMiddleware:
+    # Lets the database router send the search and lookup reads of the request to a replica
+    # and pins the user to the primary after their writes (see users/routers.py)
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = routers.start_request()
+        response = self.get_response(request)
+        routers.finish_request(token, request, response)
+        return response
+
+    async def __acall__(self, request):
+        token = routers.start_request()
+        response = await self.get_response(request)
+        routers.finish_request(token, request, response)
+        return response
@@ -0,0 +1,94 @@
+# Generated by Django 5.1.3 on 2026-10-18 07:28
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, Max
+
+
+BATCH_SIZE = 500
+
+
+def number_batches(*querysets):
+    # Distinct numbers of all sources in ascending order, BATCH_SIZE at a time, without holding them all
+    last = ''
+    while True:
+        batch = set()
+        for queryset in querysets:
+            batch.update(queryset.filter(number__gt=last).order_by('number').values_list('number', flat=True).distinct()[:BATCH_SIZE])
+        if not batch:
+            return
+        batch = sorted(batch)[:BATCH_SIZE]
+        last = batch[-1]
+        yield batch
+
+
+def populate_directory(apps, schema_editor):
+    CustomUser = apps.get_model('users', 'CustomUser')
+    PhoneNumber = apps.get_model('users', 'PhoneNumber')
+    SpamAction = apps.get_model('users', 'SpamAction')
+    NumberDirectory = apps.get_model('users', 'NumberDirectory')
+
+    sources = (
+        PhoneNumber.objects.all(),
+        CustomUser.objects.annotate(number=F('phone_number')),
+        SpamAction.objects.filter(is_marked_as_spam=True).annotate(number=F('phone_number')),
+    )
+    for batch in number_batches(*sources):
+        phone_rows = PhoneNumber.objects.filter(number__in=batch)
+        scores = dict(phone_rows.values('number').annotate(score=Max('spam_likelihood')).values_list('number', 'score'))
+        reports = dict(SpamAction.objects.filter(phone_number__in=batch, is_marked_as_spam=True)
+                       .values('phone_number').annotate(count=Count('id')).values_list('phone_number', 'count'))
+        users = {}
+        for user_id, number in CustomUser.objects.filter(phone_number__in=batch).order_by('-id').values_list('id', 'phone_number'):
+            users[number] = user_id
+        top_names = {}
+        for row in phone_rows.values('number', 'name').annotate(count=Count('id')).order_by('number', '-count', 'name'):
+            names = top_names.setdefault(row['number'], [])
+            if len(names) < 5:
+                names.append({'name': row['name'], 'count': row['count']})
+
+        NumberDirectory.objects.bulk_create(NumberDirectory(
+            number=number,
+            user_id=users.get(number),
+            spam_likelihood=scores.get(number),
+            spam_reports=reports.get(number, 0),
+            top_names=top_names.get(number, []),
+        ) for number in batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_alter_customuser_groups_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='phonenumber',
+            name='name',
+            field=models.CharField(max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='phonenumber',
+            name='number',
+            field=models.CharField(db_index=True, max_length=15),
+        ),
+        migrations.AlterField(
+            model_name='spamaction',
+            name='phone_number',
+            field=models.CharField(db_index=True, max_length=15),
+        ),
+        migrations.CreateModel(
+            name='NumberDirectory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.CharField(max_length=15, unique=True)),
+                ('spam_likelihood', models.IntegerField(blank=True, null=True)),
+                ('spam_reports', models.IntegerField(default=0)),
+                ('top_names', models.JSONField(blank=True, default=list)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(populate_directory, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 5.1.3 on 2026-10-18 07:29
+
+import django.db.models.deletion
+from django.db import migrations, models, transaction
+
+
+BATCH_SIZE = 2000
+
+
+def name_keys(name):
+    normalized = ' '.join((name or '').lower().split())
+    for position, char in enumerate(normalized):
+        if char == ' ':
+            continue
+        if position == 0:
+            rank = 0
+        elif normalized[position - 1] == ' ':
+            rank = 1
+        else:
+            rank = 2
+        yield normalized[position:position + 32], rank
+
+
+def populate_name_index(apps, schema_editor):
+    # One transaction per range of BATCH_SIZE phone numbers, so neither the write lock nor the entries
+    # are held for the whole table; a range is cleared first, which makes a rerun after a failure safe
+    PhoneNumber = apps.get_model('users', 'PhoneNumber')
+    NameIndexEntry = apps.get_model('users', 'NameIndexEntry')
+    using = schema_editor.connection.alias
+
+    last_id = 0
+    while True:
+        rows = list(PhoneNumber.objects.using(using).filter(id__gt=last_id).order_by('id').values_list('id', 'name')[:BATCH_SIZE])
+        if not rows:
+            return
+        with transaction.atomic(using=using):
+            NameIndexEntry.objects.using(using).filter(phone_number_id__gt=last_id, phone_number_id__lte=rows[-1][0]).delete()
+            NameIndexEntry.objects.using(using).bulk_create(
+                NameIndexEntry(phone_number_id=phone_id, key=key, rank=rank) for phone_id, name in rows for key, rank in name_keys(name)
+            )
+        last_id = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+    # The backfill commits range by range
+    atomic = False
+
+    dependencies = [
+        ('users', '0003_number_directory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NameIndexEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=32)),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('phone_number', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='name_index', to='users.phonenumber')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['rank', 'key'], name='users_nameindex_rank_key')],
+            },
+        ),
+        migrations.RunPython(populate_name_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.3 on 2026-10-18 07:30
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_spam_actions(apps, schema_editor):
+    SpamAction = apps.get_model('users', 'SpamAction')
+    duplicates = (SpamAction.objects.values('user', 'phone_number')
+                  .annotate(first_id=Min('id'), count=Count('id')).filter(count__gt=1))
+    for duplicate in duplicates:
+        (SpamAction.objects.filter(user=duplicate['user'], phone_number=duplicate['phone_number'])
+         .exclude(id=duplicate['first_id']).delete())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_name_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_spam_actions, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='spamaction',
+            constraint=models.UniqueConstraint(fields=('user', 'phone_number'), name='users_spamaction_unique_user_number'),
+        ),
+    ]
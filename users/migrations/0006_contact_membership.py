@@ -0,0 +1,40 @@
+# Generated by Django 5.1.3 on 2026-10-18 07:41
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def populate_memberships(apps, schema_editor):
+    UserContact = apps.get_model('users', 'UserContact')
+    ContactMembership = apps.get_model('users', 'ContactMembership')
+
+    pairs = UserContact.objects.values('phone_number', 'user').annotate(count=Count('id'))
+    ContactMembership.objects.bulk_create(
+        (ContactMembership(number=pair['phone_number'], owner_id=pair['user'], saved_count=pair['count']) for pair in pairs.iterator()),
+        batch_size=5000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_spamaction_unique_user_number'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContactMembership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.CharField(max_length=15)),
+                ('saved_count', models.PositiveIntegerField(default=1)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('number', 'owner'), name='users_contactmembership_unique_number_owner')],
+            },
+        ),
+        migrations.RunPython(populate_memberships, migrations.RunPython.noop),
+    ]
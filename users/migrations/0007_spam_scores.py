@@ -0,0 +1,39 @@
+# Generated by Django 5.1.3 on 2026-10-18 08:16
+
+import time
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def populate_spam_scores(apps, schema_editor):
+    # Existing reports get the migration time as timestamp, so their decayed count is the report count
+    NumberDirectory = apps.get_model('users', 'NumberDirectory')
+    NumberDirectory.objects.filter(spam_reports__gt=0).update(spam_score=F('spam_reports'), spam_score_at=time.time())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_contact_membership'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='numberdirectory',
+            name='spam_score',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='numberdirectory',
+            name='spam_score_at',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='spamaction',
+            name='reported_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(populate_spam_scores, migrations.RunPython.noop),
+    ]
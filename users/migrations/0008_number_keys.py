@@ -0,0 +1,197 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:02
+
+import re
+from collections import Counter
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+BATCH_SIZE = 2000
+
+# users.numbers as of this migration, copied so that later changes to the app code do not change it
+SEPARATORS = re.compile(r'[\s\-.()/]')
+E164_DIGITS = re.compile(r'[1-9][0-9]{7,14}')
+
+
+def number_key(raw):
+    # Integer key of the E.164 form of a number, or None when it cannot be one
+    if raw is None:
+        return None
+    text = SEPARATORS.sub('', str(raw))
+    if text.startswith('+'):
+        digits = text[1:]
+    elif text.startswith('00'):
+        digits = text[2:]
+    else:
+        config = settings.PHONE_NUMBERS
+        national_length = config['NATIONAL_NUMBER_LENGTH']
+        digits = text
+        if len(digits) == national_length + 1 and digits.startswith('0'):
+            digits = digits[1:]
+        if len(digits) == national_length:
+            digits = config['DEFAULT_COUNTRY_CODE'] + digits
+    return int(digits) if E164_DIGITS.fullmatch(digits) else None
+
+
+def update_rows(schema_editor, model, field, values):
+    # Set `field` from (value, id) pairs with a single executemany
+    quote = schema_editor.connection.ops.quote_name
+    sql = 'UPDATE {} SET {} = %s WHERE {} = %s'.format(
+        quote(model._meta.db_table), quote(model._meta.get_field(field).column), quote(model._meta.pk.column))
+    with schema_editor.connection.cursor() as cursor:
+        cursor.executemany(sql, values)
+
+
+def iter_pages(model, *fields):
+    # (id, *fields) rows in keyset pages of BATCH_SIZE
+    last_id = 0
+    while True:
+        rows = list(model.objects.filter(id__gt=last_id).order_by('id').values_list('id', *fields)[:BATCH_SIZE])
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def set_number_keys(schema_editor, model, field):
+    # Key of every row from its number column
+    for rows in iter_pages(model, field):
+        update_rows(schema_editor, model, 'number_key', [(number_key(number), row_id) for row_id, number in rows])
+
+
+def merge_directory_rows(rows, spam_reports):
+    # Numbers stored in several formats had one directory row per format: keep one row per key,
+    # with the decayed scores added up (recompute_spam_scores gives the exact ones)
+    first, *others = sorted(rows, key=lambda row: (-row.spam_reports, row.id))
+    names = Counter()
+    for row in rows:
+        for saved_name in row.top_names:
+            names[saved_name['name']] += saved_name['count']
+    first.user_id = first.user_id or next((row.user_id for row in others if row.user_id), None)
+    likelihoods = [row.spam_likelihood for row in rows if row.spam_likelihood is not None]
+    first.spam_likelihood = max(likelihoods) if likelihoods else None
+    first.spam_reports = spam_reports
+    first.spam_score = sum(row.spam_score for row in rows)
+    score_times = [row.spam_score_at for row in rows if row.spam_score_at is not None]
+    first.spam_score_at = max(score_times) if score_times else None
+    first.top_names = [{'name': name, 'count': count}
+                       for name, count in sorted(names.items(), key=lambda item: (-item[1], item[0]))[:5]]
+    first.save()
+    return [row.id for row in others]
+
+
+def populate_number_keys(apps, schema_editor):
+    CustomUser = apps.get_model('users', 'CustomUser')
+    UserContact = apps.get_model('users', 'UserContact')
+    PhoneNumber = apps.get_model('users', 'PhoneNumber')
+    SpamAction = apps.get_model('users', 'SpamAction')
+    NumberDirectory = apps.get_model('users', 'NumberDirectory')
+    ContactMembership = apps.get_model('users', 'ContactMembership')
+
+    set_number_keys(schema_editor, CustomUser, 'phone_number')
+    set_number_keys(schema_editor, UserContact, 'phone_number')
+    set_number_keys(schema_editor, PhoneNumber, 'number')
+    set_number_keys(schema_editor, SpamAction, 'phone_number')
+
+    # a user reporting a number in two formats reported it once
+    duplicates = (SpamAction.objects.exclude(number_key=None).values('user', 'number_key')
+                  .annotate(first_id=Min('id'), count=Count('id')).filter(count__gt=1))
+    for duplicate in duplicates:
+        (SpamAction.objects.filter(user=duplicate['user'], number_key=duplicate['number_key'])
+         .exclude(id=duplicate['first_id']).delete())
+
+    # the derived tables are keyed by number key only, invalid numbers drop out of them
+    set_number_keys(schema_editor, ContactMembership, 'number')
+    ContactMembership.objects.filter(number_key=None).delete()
+    duplicates = (ContactMembership.objects.values('owner', 'number_key')
+                  .annotate(first_id=Min('id'), count=Count('id')).filter(count__gt=1))
+    for duplicate in duplicates:
+        memberships = list(ContactMembership.objects.filter(owner=duplicate['owner'], number_key=duplicate['number_key']))
+        ContactMembership.objects.filter(id=duplicate['first_id']).update(
+            saved_count=sum(membership.saved_count for membership in memberships))
+        ContactMembership.objects.filter(id__in=[membership.id for membership in memberships if membership.id != duplicate['first_id']]).delete()
+
+    set_number_keys(schema_editor, NumberDirectory, 'number')
+    NumberDirectory.objects.filter(number_key=None).delete()
+    duplicates = NumberDirectory.objects.values('number_key').annotate(count=Count('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        spam_reports = SpamAction.objects.filter(number_key=duplicate['number_key'], is_marked_as_spam=True).count()
+        NumberDirectory.objects.filter(id__in=merge_directory_rows(
+            list(NumberDirectory.objects.filter(number_key=duplicate['number_key'])), spam_reports)).delete()
+    # the directory shows numbers in their E.164 form
+    for rows in iter_pages(NumberDirectory, 'number_key'):
+        update_rows(schema_editor, NumberDirectory, 'number', [(f'+{key}', row_id) for row_id, key in rows])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_spam_scores'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='contactmembership',
+            name='users_contactmembership_unique_number_owner',
+        ),
+        migrations.RemoveConstraint(
+            model_name='spamaction',
+            name='users_spamaction_unique_user_number',
+        ),
+        migrations.AddField(
+            model_name='contactmembership',
+            name='number_key',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='number_key',
+            field=models.BigIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='numberdirectory',
+            name='number_key',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='phonenumber',
+            name='number_key',
+            field=models.BigIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='spamaction',
+            name='number_key',
+            field=models.BigIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='usercontact',
+            name='number_key',
+            field=models.BigIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='customuser',
+            name='phone_number',
+            field=models.CharField(max_length=16, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='numberdirectory',
+            name='number',
+            field=models.CharField(max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='phonenumber',
+            name='number',
+            field=models.CharField(max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='spamaction',
+            name='phone_number',
+            field=models.CharField(max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='usercontact',
+            name='phone_number',
+            field=models.CharField(max_length=16),
+        ),
+        migrations.RunPython(populate_number_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_number_keys'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='contactmembership',
+            name='number',
+        ),
+        migrations.AlterField(
+            model_name='contactmembership',
+            name='number_key',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='numberdirectory',
+            name='number_key',
+            field=models.BigIntegerField(unique=True),
+        ),
+        migrations.AddConstraint(
+            model_name='contactmembership',
+            constraint=models.UniqueConstraint(fields=('number_key', 'owner'), name='users_contactmembership_unique_number_owner'),
+        ),
+        migrations.AddConstraint(
+            model_name='spamaction',
+            constraint=models.UniqueConstraint(fields=('user', 'number_key'), name='users_spamaction_unique_user_number'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.1.3 on 2026-10-18 08:55
+
+from django.db import migrations, models
+
+
+def populate_name_counts(apps, schema_editor):
+    # Same aggregation as users.name_counts.rebuild_name_counts(), inside the database
+    PhoneNumber = apps.get_model('users', 'PhoneNumber')
+    NameCount = apps.get_model('users', 'NameCount')
+    quote = schema_editor.connection.ops.quote_name
+    schema_editor.execute('INSERT INTO {} ({}, {}, {}) SELECT {}, {}, COUNT(*) FROM {} WHERE {} IS NOT NULL GROUP BY {}, {}'.format(
+        quote(NameCount._meta.db_table),
+        quote('number_key'), quote('name'), quote('count'),
+        quote('number_key'), quote('name'),
+        quote(PhoneNumber._meta.db_table),
+        quote('number_key'),
+        quote('number_key'), quote('name'),
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_number_key_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NameCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number_key', models.BigIntegerField()),
+                ('name', models.CharField(max_length=255)),
+                ('count', models.PositiveIntegerField(default=1)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['number_key', '-count'], name='users_namecount_number_count')],
+                'constraints': [models.UniqueConstraint(fields=('number_key', 'name'), name='users_namecount_unique_number_name')],
+            },
+        ),
+        migrations.RunPython(populate_name_counts, migrations.RunPython.noop),
+    ]
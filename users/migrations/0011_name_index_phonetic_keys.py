@@ -0,0 +1,79 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:02
+
+import unicodedata
+
+from django.db import migrations
+
+# users.phonetic as of this migration, copied so that later changes to the app code do not change it
+SOUND_ALIKES = (
+    ('sch', 's'), ('tch', 'ch'), ('ph', 'f'), ('gh', 'g'), ('kh', 'k'), ('bh', 'b'), ('dh', 'd'),
+    ('th', 't'), ('sh', 's'), ('ck', 'k'), ('qu', 'k'), ('wh', 'w'),
+)
+SOUND_CLASSES = {
+    **dict.fromkeys('bfpvw', '1'),
+    **dict.fromkeys('cgjkqsxz', '2'),
+    **dict.fromkeys('dt', '3'),
+    'l': '4',
+    **dict.fromkeys('mn', '5'),
+    'r': '6',
+}
+VOWELS = set('aeiouy')
+KEY_LENGTH = 4
+MIN_WORD_LENGTH = 2
+
+
+def phonetic_key(word):
+    decomposed = unicodedata.normalize('NFKD', word.lower())
+    letters = ''.join(char for char in decomposed if 'a' <= char <= 'z')
+    if len(letters) < MIN_WORD_LENGTH:
+        return None
+    for spelling, sound in SOUND_ALIKES:
+        letters = letters.replace(spelling, sound)
+    key = '0' if letters[0] in VOWELS else ''
+    for letter in letters:
+        code = SOUND_CLASSES.get(letter)
+        if code is not None and not key.endswith(code):
+            key += code
+    return key[:KEY_LENGTH] or None
+
+
+def phonetic_keys(name):
+    keys = []
+    for word in name.split():
+        key = phonetic_key(word)
+        if key is not None and key not in keys:
+            keys.append(key)
+    return keys
+
+
+# NameIndexEntry.RANK_PHONETIC
+RANK_PHONETIC = 3
+
+
+def add_phonetic_keys(apps, schema_editor):
+    PhoneNumber = apps.get_model('users', 'PhoneNumber')
+    NameIndexEntry = apps.get_model('users', 'NameIndexEntry')
+
+    entries = []
+    for phone_id, name in PhoneNumber.objects.values_list('id', 'name').iterator(chunk_size=5000):
+        entries.extend(NameIndexEntry(phone_number_id=phone_id, key=key, rank=RANK_PHONETIC) for key in phonetic_keys(name or ''))
+        if len(entries) >= 5000:
+            NameIndexEntry.objects.bulk_create(entries)
+            entries = []
+    NameIndexEntry.objects.bulk_create(entries)
+
+
+def remove_phonetic_keys(apps, schema_editor):
+    NameIndexEntry = apps.get_model('users', 'NameIndexEntry')
+    NameIndexEntry.objects.filter(rank=RANK_PHONETIC).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0010_name_counts'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_phonetic_keys, remove_phonetic_keys),
+    ]
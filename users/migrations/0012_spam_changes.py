@@ -0,0 +1,37 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:03
+
+from django.db import migrations, models
+
+
+def populate_spam_changes(apps, schema_editor):
+    # Start the feed with one change per reported number of the directory
+    NumberDirectory = apps.get_model('users', 'NumberDirectory')
+    SpamChange = apps.get_model('users', 'SpamChange')
+    quote = schema_editor.connection.ops.quote_name
+    columns = ', '.join(quote(column) for column in ('number_key', 'spam_likelihood', 'spam_score', 'spam_score_at'))
+    schema_editor.execute('INSERT INTO {} ({}) SELECT {} FROM {} WHERE {} > 0 OR {} > 0 ORDER BY {}'.format(
+        quote(SpamChange._meta.db_table), columns, columns,
+        quote(NumberDirectory._meta.db_table),
+        quote('spam_score'), quote('spam_likelihood'),
+        quote('number_key'),
+    ))
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0011_name_index_phonetic_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpamChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number_key', models.BigIntegerField(db_index=True)),
+                ('spam_likelihood', models.IntegerField(blank=True, null=True)),
+                ('spam_score', models.FloatField(default=0)),
+                ('spam_score_at', models.FloatField(blank=True, null=True)),
+            ],
+        ),
+        migrations.RunPython(populate_spam_changes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0012_spam_changes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HotNumber',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('process', models.CharField(db_index=True, max_length=64)),
+                ('number_key', models.BigIntegerField()),
+                ('lookups', models.FloatField(default=0)),
+                ('reports', models.FloatField(default=0)),
+                ('published_at', models.FloatField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0013_hot_numbers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShardPrefix',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.CharField(max_length=15, unique=True)),
+                ('shard', models.CharField(max_length=64)),
+            ],
+        ),
+    ]
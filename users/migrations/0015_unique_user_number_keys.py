@@ -0,0 +1,37 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:38
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def release_duplicate_numbers(apps, schema_editor):
+    # Users registered before numbers were canonicalized can share a number in different formats
+    # ("+91 98765 43210" and "098765 43210"). Logins already went to the oldest of them, which keeps
+    # the number; the others are deactivated and lose their number key, and are listed for review.
+    CustomUser = apps.get_model('users', 'CustomUser')
+    NumberDirectory = apps.get_model('users', 'NumberDirectory')
+
+    duplicates = (CustomUser.objects.exclude(number_key=None).values('number_key')
+                  .annotate(count=Count('id')).filter(count__gt=1).values_list('number_key', flat=True))
+    for key in list(duplicates):
+        first, *others = CustomUser.objects.filter(number_key=key).order_by('id')
+        CustomUser.objects.filter(id__in=[user.id for user in others]).update(number_key=None, is_active=False)
+        NumberDirectory.objects.filter(number_key=key).update(user=first)
+        print(f'\n  +{key}: kept by user {first.id} ({first.phone_number}), deactivated '
+              + ', '.join(f'user {user.id} ({user.phone_number})' for user in others))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0014_shard_prefixes'),
+    ]
+
+    operations = [
+        migrations.RunPython(release_duplicate_numbers, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='customuser',
+            name='number_key',
+            field=models.BigIntegerField(blank=True, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.3 on 2026-10-18 11:02
+
+from django.db import migrations, models
+from django.db.models import F, Max
+
+
+def populate_versions(apps, schema_editor):
+    # The ids were the versions so far; the counter continues after the last one
+    SpamChange = apps.get_model('users', 'SpamChange')
+    SpamFeedVersion = apps.get_model('users', 'SpamFeedVersion')
+    SpamChange.objects.update(version=F('id'))
+    last = SpamChange.objects.aggregate(last=Max('version'))['last'] or 0
+    SpamFeedVersion.objects.create(pk=1, version=last)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0015_unique_user_number_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpamFeedVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='spamchange',
+            name='version',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.RunPython(populate_versions, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='spamchange',
+            name='version',
+            field=models.BigIntegerField(unique=True),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import BaseUserManager, AbstractBaseUser, PermissionsMixin, Group
 
 # Custom User Manager to handle user creation and superuser creation
@@ -20,7 +21,10 @@ class CustomUserManager(BaseUserManager):
 class CustomUser(AbstractBaseUser, PermissionsMixin):
     name = models.CharField(max_length=255)
     email = models.EmailField(blank=True, null=True)
-    phone_number = models.CharField(max_length=15, unique=True)
+    phone_number = models.CharField(max_length=16, unique=True)
+    # integer key of the E.164 form of phone_number (see users/numbers.py), set on save; a number
+    # belongs to one user whatever format it was registered in
+    number_key = models.BigIntegerField(null=True, blank=True, unique=True)
     password = models.CharField(max_length=255)
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)
@@ -47,18 +51,32 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
 class UserContact(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="contacts")
     contact_name = models.CharField(max_length=255)
-    phone_number = models.CharField(max_length=10)
+    phone_number = models.CharField(max_length=16)
+    number_key = models.BigIntegerField(null=True, blank=True, db_index=True)
 
     def __str__(self):
-        return f"{self.name} ({self.phone_number})"
+        return f"{self.contact_name} ({self.phone_number})"
+
+
+class PhoneNumberQuerySet(models.QuerySet):
+
+    def create(self, **kwargs):
+        # Saved without a database unless one was chosen with using(), so that the router puts the
+        # new row on the shard of its number (see users/sharding.py) instead of the default database
+        phone_number = self.model(**kwargs)
+        phone_number.save(force_insert=True, using=self._db)
+        return phone_number
 
 
 # Phone_Book or Contact_list of all users are stored via this model 
 class PhoneNumber(models.Model):
     name = models.CharField(max_length=255)
-    number = models.CharField(max_length=15)
+    number = models.CharField(max_length=16)
+    number_key = models.BigIntegerField(null=True, blank=True, db_index=True)
     spam_likelihood = models.IntegerField(default=0)
 
+    objects = PhoneNumberQuerySet.as_manager()
+
     def __str__(self):
         return self.number
     
@@ -66,8 +84,155 @@ class PhoneNumber(models.Model):
 # Model to track spam actions by users
 class SpamAction(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
-    phone_number = models.CharField(max_length=15)
+    phone_number = models.CharField(max_length=16)
+    number_key = models.BigIntegerField(null=True, blank=True, db_index=True)
     is_marked_as_spam = models.BooleanField(default=False)
+    # reports lose weight over time, see users/spam_scores.py
+    reported_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        # a user can only report a given number once, whatever format it was entered in
+        constraints = [
+            models.UniqueConstraint(fields=["user", "number_key"], name="users_spamaction_unique_user_number"),
+        ]
+
+    def __str__(self):
+        # no user query per report (admin lists, deletion logs)
+        return f"{self.user_id} -> {self.phone_number}"
+
+
+# Canonical directory with exactly one row per distinct number key, kept in sync from
+# PhoneNumber, SpamAction and CustomUser changes (see users/directory.py)
+class NumberDirectory(models.Model):
+    # E.164 form of the number
+    number = models.CharField(max_length=16)
+    number_key = models.BigIntegerField(unique=True)
+    # registered user owning this number, if any
+    user = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+    # highest spam_likelihood across the global PhoneNumber rows of this number (None when no rows exist)
+    spam_likelihood = models.IntegerField(null=True, blank=True)
+    # number of users that have marked this number as spam
+    spam_reports = models.IntegerField(default=0)
+    # most common names saved for this number: [{"name": ..., "count": ...}, ...]
+    top_names = models.JSONField(default=list, blank=True)
+    # time-decayed reporter count as of spam_score_at (Unix time), maintained by users/spam_scores.py
+    spam_score = models.FloatField(default=0)
+    spam_score_at = models.FloatField(null=True, blank=True)
+
+    def __str__(self):
+        return self.number
+
+
+# Substring index over PhoneNumber.name used by the name search (see users/name_index.py).
+# Every position of the normalized name is stored as a (truncated) suffix key, so that both
+# "starts with" and "contains" queries become index range scans on (rank, key). The phonetic keys
+# of the words are stored next to them for the fuzzy search.
+class NameIndexEntry(models.Model):
+    RANK_NAME_PREFIX = 0  # key starts at the beginning of the name
+    RANK_WORD_PREFIX = 1  # key starts at the beginning of a later word
+    RANK_INFIX = 2        # key starts inside a word
+    RANK_PHONETIC = 3     # key is the phonetic key of a word (fuzzy search, see users/phonetic.py)
+
+    phone_number = models.ForeignKey(PhoneNumber, on_delete=models.CASCADE, related_name="name_index")
+    key = models.CharField(max_length=32)
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["rank", "key"], name="users_nameindex_rank_key"),
+        ]
+
+    def __str__(self):
+        return self.key
+
+
+# Reverse contact index: "who has saved this number". One row per (number, owner) pair, whatever
+# the number of UserContact rows of the owner for that number (see users/membership.py)
+class ContactMembership(models.Model):
+    number_key = models.BigIntegerField()
+    owner = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="+")
+    saved_count = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["number_key", "owner"], name="users_contactmembership_unique_number_owner"),
+        ]
+
+    def __str__(self):
+        return f"{self.owner_id} -> +{self.number_key}"
+
+# Name frequencies of the global database: how many PhoneNumber rows save a number under each name.
+# Counts are updated incrementally as rows are added, renamed and removed (see users/name_counts.py),
+# so the most common names of a number are one index range scan on (number_key, -count).
+class NameCount(models.Model):
+    number_key = models.BigIntegerField()
+    name = models.CharField(max_length=255)
+    count = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["number_key", "name"], name="users_namecount_unique_number_name"),
+        ]
+        indexes = [
+            models.Index(fields=["number_key", "-count"], name="users_namecount_number_count"),
+        ]
+
+    def __str__(self):
+        return f"+{self.number_key}: {self.name} ({self.count})"
+
+
+# Change feed of the spam signals, for clients that screen calls from a local copy of the spam list
+# (see users/spam_feed.py). A number's row is replaced by a new one, with a higher version, whenever
+# its signals change, so the log holds the latest state of every number ever reported and a delta
+# "since version N" is a range scan on the version index.
+class SpamChange(models.Model):
+    # feed version, allocated from SpamFeedVersion by the transaction that records the change
+    version = models.BigIntegerField(unique=True)
+    number_key = models.BigIntegerField(db_index=True)
+    # same values as the NumberDirectory row when the change was recorded; all empty once the
+    # number is no longer reported
+    spam_likelihood = models.IntegerField(null=True, blank=True)
+    spam_score = models.FloatField(default=0)
+    spam_score_at = models.FloatField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.version}: +{self.number_key}"
+
+
+# Last version of the spam change feed, a single row. Writers take its row lock when allocating
+# versions and keep it until they commit, so that versions become visible in increasing order
+# (autoincrement ids are allocated at insert time and may commit out of order).
+class SpamFeedVersion(models.Model):
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return str(self.version)
+
+
+# Hottest numbers of every worker process (see users/heavy_hitters.py): each process replaces its
+# rows with the estimated recent lookups and spam reports of its top numbers every
+# HOT_NUMBERS['PUBLISH_INTERVAL'] seconds, readers add up the rows of the processes alive.
+class HotNumber(models.Model):
+    # "host:pid" of the publishing process
+    process = models.CharField(max_length=64, db_index=True)
+    number_key = models.BigIntegerField()
+    lookups = models.FloatField(default=0)
+    reports = models.FloatField(default=0)
+    # Unix time
+    published_at = models.FloatField()
+
+    def __str__(self):
+        return f"{self.process}: +{self.number_key}"
+
+
+# Shard assignments of number prefixes for the sharded directory rows (see users/sharding.py): the
+# PhoneNumber rows of a number live on the shard of its longest assigned prefix. Changed with
+# `python manage.py rebalance_shards`, which also moves the rows.
+class ShardPrefix(models.Model):
+    # leading E.164 digits, country code included
+    prefix = models.CharField(max_length=15, unique=True)
+    # database alias of the shard
+    shard = models.CharField(max_length=64)
 
     def __str__(self):
-        return self.user.name
\ No newline at end of file
+        return f"+{self.prefix} -> {self.shard}"
@@ -0,0 +1,118 @@
+from collections import Counter
+from django.db import connection, transaction
+from django.db.models import Count, F, Window
+from django.db.models.functions import RowNumber
+from users.models import NameCount, PhoneNumber
+from users.sharding import sharded, shards
+
+# Rows written per executemany while counting imported names
+WRITE_BATCH_SIZE = 1000
+
+
+def _upsert_sql():
+    # Insert a (number_key, name, count) row or add its count to the existing one, atomically
+    # (supported by SQLite and PostgreSQL)
+    quote = connection.ops.quote_name
+    table = quote(NameCount._meta.db_table)
+    return (
+        'INSERT INTO {table} ({number_key}, {name}, {count}) VALUES (%s, %s, %s) '
+        'ON CONFLICT ({number_key}, {name}) DO UPDATE SET {count} = {table}.{count} + excluded.{count}'
+    ).format(table=table, number_key=quote('number_key'), name=quote('name'), count=quote('count'))
+
+
+def _decrement_sql():
+    quote = connection.ops.quote_name
+    return 'UPDATE {table} SET {count} = {count} - %s WHERE {number_key} = %s AND {name} = %s'.format(
+        table=quote(NameCount._meta.db_table), count=quote('count'), number_key=quote('number_key'), name=quote('name'))
+
+
+def add_names(counts):
+    # Add {(number_key, name): count} to the name frequencies
+    rows = [(key, name, count) for (key, name), count in counts.items() if key is not None]
+    if not rows:
+        return
+    sql = _upsert_sql()
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), WRITE_BATCH_SIZE):
+            cursor.executemany(sql, rows[start:start + WRITE_BATCH_SIZE])
+
+
+def add_name(key, name):
+    # One more PhoneNumber row saving the number under this name
+    add_names({(key, name): 1})
+
+
+def remove_name(key, name):
+    # One PhoneNumber row less; the name disappears from the number with its last row
+    if key is None:
+        return
+    with transaction.atomic():
+        NameCount.objects.filter(number_key=key, name=name).update(count=F('count') - 1)
+        NameCount.objects.filter(number_key=key, name=name, count__lte=0).delete()
+
+
+def remove_names(counts):
+    # Subtract {(number_key, name): count} from the name frequencies (set-based deletes); names
+    # disappear from a number with its last row
+    rows = [(count, key, name) for (key, name), count in counts.items() if key is not None]
+    if not rows:
+        return
+    sql = _decrement_sql()
+    keys = list({key for count, key, name in rows})
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), WRITE_BATCH_SIZE):
+                cursor.executemany(sql, rows[start:start + WRITE_BATCH_SIZE])
+        for start in range(0, len(keys), WRITE_BATCH_SIZE):
+            NameCount.objects.filter(number_key__in=keys[start:start + WRITE_BATCH_SIZE], count__lte=0).delete()
+
+
+def top_names(keys, limit):
+    # {number_key: [{"name": ..., "count": ...}, ...]} with the `limit` most common names of every
+    # number, most common first (ties by name), read from the (number_key, -count) index
+    names = {key: [] for key in keys}
+    rows = (NameCount.objects.filter(number_key__in=keys)
+            .annotate(position=Window(RowNumber(), partition_by=[F('number_key')], order_by=[F('count').desc(), F('name')]))
+            .filter(position__lte=limit)
+            .order_by('number_key', '-count', 'name')
+            .values_list('number_key', 'name', 'count'))
+    for key, name, count in rows:
+        names[key].append({'name': name, 'count': count})
+    return names
+
+
+@transaction.atomic
+def rebuild_name_counts():
+    # Full rebuild from PhoneNumber, needed after writes that bypass model signals. A single
+    # INSERT ... SELECT, so that the aggregation never leaves the database, unless the PhoneNumber
+    # rows are on shards: every shard then aggregates its rows, which are added here.
+    NameCount.objects.all().delete()
+    if sharded():
+        return sum(count_shard_names(shard) for shard in shards())
+    quote = connection.ops.quote_name
+    number_key, name = (quote(PhoneNumber._meta.get_field(field).column) for field in ('number_key', 'name'))
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO {} ({}, {}, {}) SELECT {}, {}, COUNT(*) FROM {} WHERE {} IS NOT NULL GROUP BY {}, {}'.format(
+            quote(NameCount._meta.db_table),
+            quote('number_key'), quote('name'), quote('count'),
+            number_key, name,
+            quote(PhoneNumber._meta.db_table),
+            number_key,
+            number_key, name,
+        ))
+        return cursor.rowcount
+
+
+def count_shard_names(shard):
+    rows = (PhoneNumber.objects.using(shard).exclude(number_key=None).values_list('number_key', 'name')
+            .annotate(count=Count('id')).order_by())
+    counts = Counter()
+    written = 0
+    for key, name, count in rows.iterator(chunk_size=WRITE_BATCH_SIZE):
+        counts[key, name] = count
+        if len(counts) >= WRITE_BATCH_SIZE:
+            add_names(counts)
+            written += len(counts)
+            counts.clear()
+    add_names(counts)
+    return written + len(counts)
@@ -0,0 +1,368 @@
+import heapq
+from itertools import islice
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from users.cache import lookup_cache
+from users.models import NameIndexEntry, PhoneNumber
+from users.pagination import InvalidCursor, decode_cursor
+from users.phonetic import MIN_WORD_LENGTH, EditDistance, ascii_letters, phonetic_keys
+from users.results import ID, NAME, RESULT_COLUMNS
+from users.sharding import run_on_shards, shard_connection, sharded, shards
+
+# Keys are truncated to this many characters; longer queries are verified against the full name
+KEY_LENGTH = NameIndexEntry._meta.get_field('key').max_length
+
+# Rows fetched per index range scan while collecting the top-K results
+SCAN_CHUNK_SIZE = 200
+
+# Distinct names whose keys are kept in memory during a full rebuild
+KEY_CACHE_SIZE = 100000
+
+# Upper bound appended to a prefix to turn "starts with" into an index range scan
+RANGE_END = '\U0010ffff'
+
+# Rows sharing phonetic keys with a fuzzy query that are re-ranked by edit distance
+FUZZY_CANDIDATE_LIMIT = 1000
+
+# Typos tolerated per word of a fuzzy query: one per FUZZY_LETTERS_PER_TYPO letters, at least one.
+# Initials are not limited, any word can stand for them.
+FUZZY_LETTERS_PER_TYPO = 3
+
+
+def normalize_name(name):
+    # Lowercase and collapse whitespace so that matching is case-insensitive
+    return ' '.join((name or '').lower().split())
+
+
+def build_keys(name):
+    # Yield (key, rank) for every position of the normalized name where a match can start
+    normalized = normalize_name(name)
+    for position, char in enumerate(normalized):
+        if char == ' ':
+            continue
+        if position == 0:
+            rank = NameIndexEntry.RANK_NAME_PREFIX
+        elif normalized[position - 1] == ' ':
+            rank = NameIndexEntry.RANK_WORD_PREFIX
+        else:
+            rank = NameIndexEntry.RANK_INFIX
+        yield normalized[position:position + KEY_LENGTH], rank
+
+
+def index_keys(name):
+    # Every (key, rank) index entry of a name: its substring keys and the phonetic keys of its words
+    yield from build_keys(name)
+    for key in phonetic_keys(normalize_name(name)):
+        yield key, NameIndexEntry.RANK_PHONETIC
+
+
+def index_phone_number(phone_number):
+    # (Re)build the index entries of a single PhoneNumber row, on its shard. Cached name searches
+    # are dropped when the row matched or matches a query (unnamed rows of spam reports do not).
+    entries = NameIndexEntry.objects.using(phone_number._state.db)
+    deleted, _ = entries.filter(phone_number=phone_number).delete()
+    created = entries.bulk_create(
+        NameIndexEntry(phone_number=phone_number, key=key, rank=rank)
+        for key, rank in index_keys(phone_number.name)
+    )
+    if deleted or created:
+        lookup_cache.invalidate_names()
+
+
+def insert_entries(rows, using=None):
+    # Insert (phone_number_id, key, rank) tuples with a single executemany. Bulk loads produce
+    # roughly ten entries per name, so model instances would dominate the cost of bulk_create.
+    if not rows:
+        return
+    connection = shard_connection(using)
+    quote = connection.ops.quote_name
+    sql = 'INSERT INTO {} ({}, {}, {}) VALUES (%s, %s, %s)'.format(
+        quote(NameIndexEntry._meta.db_table),
+        quote(NameIndexEntry._meta.get_field('phone_number').column),
+        quote('key'),
+        quote('rank'),
+    )
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+
+
+def index_new_phone_numbers(phone_numbers, using=None):
+    # Index freshly bulk-created PhoneNumber rows of a shard (they have no entries yet, so nothing is deleted)
+    rows = [
+        (phone_number.pk, key, rank)
+        for phone_number in phone_numbers
+        for key, rank in index_keys(phone_number.name)
+    ]
+    insert_entries(rows, using)
+    if rows:
+        lookup_cache.invalidate_names()
+
+
+def rebuild_name_index(batch_size=5000):
+    # Full rebuild, needed after writes that bypass model signals (bulk_create, raw SQL, fixtures)
+    count = sum(rebuild_shard_name_index(shard, batch_size) for shard in shards())
+    lookup_cache.invalidate_names()
+    return count
+
+
+def rebuild_shard_name_index(shard, batch_size=5000):
+    # One transaction per shard: searches keep seeing the old index until the new one is complete.
+    # The (rank, key) index is dropped while the entries are loaded and built once at the end.
+    connection = shard_connection(shard)
+    quote = connection.ops.quote_name
+    search_index = NameIndexEntry._meta.indexes[0]
+    with transaction.atomic(using=shard):
+        NameIndexEntry.objects.using(shard).all().delete()
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP INDEX {quote(search_index.name)}')
+
+        # names repeat a lot across contact lists, so their keys are computed once
+        keys = {}
+        rows = []
+        count = 0
+        for phone_id, name in PhoneNumber.objects.using(shard).values_list('id', 'name').iterator(chunk_size=batch_size):
+            count += 1
+            if name not in keys:
+                if len(keys) >= KEY_CACHE_SIZE:
+                    keys.clear()
+                keys[name] = list(index_keys(name))
+            rows.extend((phone_id, key, rank) for key, rank in keys[name])
+            if len(rows) >= batch_size:
+                insert_entries(rows, shard)
+                rows = []
+        insert_entries(rows, shard)
+
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE INDEX {} ON {} ({})'.format(
+                quote(search_index.name),
+                quote(NameIndexEntry._meta.db_table),
+                ', '.join(quote(NameIndexEntry._meta.get_field(field).column) for field in search_index.fields),
+            ))
+    return count
+
+
+class NameSearch:
+    # Ranked name search plan: names starting with the query first, then names with a word starting
+    # with it, then names containing it anywhere. Rows are visited in (rank, key, phone_number_id)
+    # index order and each row is only emitted at its best index position, so the scan can resume
+    # from any position (keyset pagination) without repeating or skipping rows. A plan scans one
+    # shard; ids being unique across shards, the positions of all the shards are totally ordered
+    # and their matches are merged in position order.
+
+    RANKS = (NameIndexEntry.RANK_NAME_PREFIX, NameIndexEntry.RANK_WORD_PREFIX, NameIndexEntry.RANK_INFIX)
+
+    def __init__(self, query, after=None, shard=None):
+        self.shard = shard
+        self.normalized = normalize_name(query)
+        self.prefix = self.normalized[:KEY_LENGTH]
+        self.needs_verification = len(self.normalized) > KEY_LENGTH
+        # (rank, key, phone_number_id) of the last row of the previous page
+        self.after = tuple(after) if after else None
+
+    def scan_plan(self):
+        # Yield (rank, start) pairs, start being the (key, phone_number_id) to resume after
+        if not self.normalized:
+            return
+        for rank in self.RANKS:
+            if self.after is None or rank > self.after[0]:
+                yield rank, None
+            elif rank == self.after[0]:
+                yield rank, self.after[1:]
+
+    def matches(self, rank, start):
+        # Next chunk of the (rank, key) index range of the prefix, in key order
+        entries = NameIndexEntry.objects.using(self.shard).filter(rank=rank, key__gte=self.prefix, key__lt=self.prefix + RANGE_END)
+        if start is not None:
+            key, phone_id = start
+            entries = entries.filter(Q(key__gt=key) | Q(key=key, phone_number_id__gt=phone_id))
+        return entries.order_by('key', 'phone_number_id').values_list('key', 'phone_number_id')[:SCAN_CHUNK_SIZE]
+
+    def best_position(self, name):
+        # Index position (rank, key) through which the scan first reaches a name: the smallest
+        # build_keys() entry starting with the prefix, found without building every key
+        normalized = normalize_name(name)
+        if normalized.startswith(self.prefix):
+            return NameIndexEntry.RANK_NAME_PREFIX, normalized[:KEY_LENGTH]
+        best = None
+        position = normalized.find(self.prefix, 1)
+        while position != -1:
+            rank = NameIndexEntry.RANK_WORD_PREFIX if normalized[position - 1] == ' ' else NameIndexEntry.RANK_INFIX
+            candidate = (rank, normalized[position:position + KEY_LENGTH])
+            if best is None or candidate < best:
+                best = candidate
+            position = normalized.find(self.prefix, position + 1)
+        return best
+
+    def rows(self, entries):
+        # Result rows (see users/results.py) of the PhoneNumber rows of a chunk of entries
+        return PhoneNumber.objects.using(self.shard).filter(id__in={phone_id for key, phone_id in entries}).values_list(*RESULT_COLUMNS)
+
+    def accept(self, rank, entries, rows):
+        # Yield ((rank, key, phone_number_id), row) for the scanned entries that are emitted here
+        rows = {row[ID]: row for row in rows}
+        for key, phone_id in entries:
+            row = rows.get(phone_id)
+            if row is None:
+                continue
+            if self.needs_verification and self.normalized not in normalize_name(row[NAME]):
+                continue
+            if self.best_position(row[NAME]) != (rank, key):
+                continue
+            yield (rank, key, phone_id), row
+
+
+def decode_name_cursor(token):
+    # (rank, key, phone_number_id) position of a name search cursor
+    after = decode_cursor(token, (int, str, int))
+    if after is not None and after[0] not in NameSearch.RANKS:
+        raise InvalidCursor("Invalid cursor.")
+    return after
+
+
+def match_position(match):
+    return match[0]
+
+
+def iter_shard_matches(shard, query, after=None):
+    # Every PhoneNumber row of a shard matching the query in ranked order, fetched SCAN_CHUNK_SIZE entries at a time
+    search = NameSearch(query, after, shard)
+    for rank, start in search.scan_plan():
+        while True:
+            entries = list(search.matches(rank, start))
+            yield from search.accept(rank, entries, search.rows(entries))
+            if len(entries) < SCAN_CHUNK_SIZE:
+                break
+            start = entries[-1]
+
+
+def iter_name_matches(query, after=None):
+    # Every PhoneNumber row matching the query in ranked order, the shards' matches merged lazily
+    streams = [iter_shard_matches(shard, query, after) for shard in shards()]
+    return streams[0] if len(streams) == 1 else heapq.merge(*streams, key=match_position)
+
+
+async def aiter_name_matches(query, after=None):
+    # Same as iter_name_matches, using the async ORM API (the merge of sharded matches runs in a
+    # thread, a chunk at a time)
+    if sharded():
+        matches = iter_name_matches(query, after)
+        while True:
+            chunk = await sync_to_async(lambda: list(islice(matches, SCAN_CHUNK_SIZE)))()
+            for match in chunk:
+                yield match
+            if len(chunk) < SCAN_CHUNK_SIZE:
+                return
+    search = NameSearch(query, after)
+    for rank, start in search.scan_plan():
+        while True:
+            entries = [entry async for entry in search.matches(rank, start)]
+            rows = [row async for row in search.rows(entries)]
+            for match in search.accept(rank, entries, rows):
+                yield match
+            if len(entries) < SCAN_CHUNK_SIZE:
+                break
+            start = entries[-1]
+
+
+def page_size_limit(limit):
+    return min(limit or settings.SEARCH_MAX_PAGE_SIZE, settings.SEARCH_MAX_PAGE_SIZE)
+
+
+def first_shard_matches(shard, query, limit, after):
+    return list(islice(iter_shard_matches(shard, query, after), limit))
+
+
+def search_names(query, limit=None, after=None):
+    # One page of ranked results; returns (rows, next_position), next_position is None on the last
+    # page. The page is among the first `limit` matches of every shard, searched in parallel.
+    limit = page_size_limit(limit)
+    results = []
+    for position, row in heapq.merge(*run_on_shards(first_shard_matches, query, limit, after), key=match_position):
+        results.append(row)
+        if len(results) >= limit:
+            return results, position
+    return results, None
+
+
+async def asearch_names(query, limit=None, after=None):
+    if sharded():
+        return await sync_to_async(search_names)(query, limit, after)
+    limit = page_size_limit(limit)
+    results = []
+    async for position, row in aiter_name_matches(query, after):
+        results.append(row)
+        if len(results) >= limit:
+            return results, position
+    return results, None
+
+
+def filter_names(queryset, query):
+    # PhoneNumber rows of a queryset whose name contains the query, unranked (admin search): the
+    # index range of every rank is used as an id subquery instead of scanning the names
+    normalized = normalize_name(query)
+    if not normalized:
+        return queryset
+    prefix = normalized[:KEY_LENGTH]
+    entries = NameIndexEntry.objects.filter(rank__in=NameSearch.RANKS, key__gte=prefix, key__lt=prefix + RANGE_END)
+    queryset = queryset.filter(id__in=entries.values('phone_number_id'))
+    if len(normalized) > KEY_LENGTH:
+        queryset = queryset.filter(name__icontains=normalized)
+    return queryset
+
+
+class FuzzySearch:
+    # Typo-tolerant name search: the rows sharing phonetic keys with the words of the query are
+    # fetched with one indexed query (rows matching more of the words first), then re-ranked by the
+    # edit distance between every query word and the closest word of the name. Rows where a query
+    # word has no close enough word are dropped, sounding alike is not enough.
+
+    def __init__(self, query):
+        normalized = normalize_name(query)
+        self.keys = phonetic_keys(normalized)
+        words = [word for word in map(ascii_letters, normalized.split()) if word]
+        self.distances = [EditDistance(word) for word in words]
+        self.max_distances = [max(1, len(word) // FUZZY_LETTERS_PER_TYPO) if len(word) >= MIN_WORD_LENGTH else float('inf')
+                              for word in words]
+
+    def candidates(self, shard=None):
+        return (PhoneNumber.objects.using(shard)
+                .filter(name_index__rank=NameIndexEntry.RANK_PHONETIC, name_index__key__in=self.keys)
+                .annotate(matched_keys=Count('name_index__key', distinct=True))
+                .order_by('-matched_keys', 'id')
+                .values_list(*RESULT_COLUMNS)[:FUZZY_CANDIDATE_LIMIT])
+
+    def distance(self, name):
+        # Sum of the distances of the query words to their closest word of the name, None beyond the cutoff
+        words = [ascii_letters(word) for word in name.split()] or ['']
+        total = 0
+        for distance, max_distance in zip(self.distances, self.max_distances):
+            word_distance = min(map(distance, words))
+            if word_distance > max_distance:
+                return None
+            total += word_distance
+        return total
+
+    def rank(self, rows, limit):
+        scored = [(distance, row[ID], row) for row in rows if (distance := self.distance(row[NAME])) is not None]
+        return [row for distance, row_id, row in heapq.nsmallest(limit, scored, key=lambda item: item[:2])]
+
+
+def fuzzy_search_names(query, limit=None):
+    # The best `limit` typo-tolerant matches, closest first
+    search = FuzzySearch(query)
+    if not search.keys:
+        return []
+    # the candidates of every shard, fetched in parallel
+    candidates = run_on_shards(lambda shard: list(search.candidates(shard)))
+    return search.rank([row for rows in candidates for row in rows], page_size_limit(limit))
+
+
+async def afuzzy_search_names(query, limit=None):
+    if sharded():
+        return await sync_to_async(fuzzy_search_names)(query, limit)
+    search = FuzzySearch(query)
+    if not search.keys:
+        return []
+    return search.rank([row async for row in search.candidates()], page_size_limit(limit))
@@ -0,0 +1,60 @@
+import re
+from django.conf import settings
+
+# Phone number normalization.
+#
+# Numbers are accepted in the usual written forms ("+91 98765 43210", "0091-98765-43210",
+# "098765 43210", "9876543210") and canonicalized to E.164 ("+919876543210"); numbers without a
+# country code belong to PHONE_NUMBERS['DEFAULT_COUNTRY_CODE']. The digits of an E.164 number never
+# start with 0 and are at most 15 long, so they are used as a 64-bit integer key: the number_key
+# columns identify a number whatever format it was entered in, with 8-byte index entries.
+
+# Spaces and the usual punctuation of written numbers
+SEPARATORS = re.compile(r'[\s\-.()/]')
+
+# Country code and subscriber number, 8 to 15 digits
+E164_DIGITS = re.compile(r'[1-9][0-9]{7,14}')
+
+
+def normalize(raw):
+    # E.164 form of a number, or None when it cannot be one
+    if raw is None:
+        return None
+    text = SEPARATORS.sub('', str(raw))
+    if text.startswith('+'):
+        digits = text[1:]
+    elif text.startswith('00'):
+        digits = text[2:]
+    else:
+        config = settings.PHONE_NUMBERS
+        national_length = config['NATIONAL_NUMBER_LENGTH']
+        digits = text
+        if len(digits) == national_length + 1 and digits.startswith('0'):
+            # national number with its trunk prefix
+            digits = digits[1:]
+        if len(digits) == national_length:
+            digits = config['DEFAULT_COUNTRY_CODE'] + digits
+    if not E164_DIGITS.fullmatch(digits):
+        return None
+    return f'+{digits}'
+
+
+def number_key(raw):
+    # Integer key of a number, or None when it is not a valid number
+    number = normalize(raw)
+    return int(number[1:]) if number is not None else None
+
+
+def format_key(key):
+    # E.164 form of a number key
+    return f'+{key}'
+
+
+def prefix_ranges(prefix):
+    # [low, high) number key ranges of the numbers whose E.164 digits start with `prefix`, one per
+    # possible number length
+    value = int(prefix)
+    return [
+        (value * 10 ** (length - len(prefix)), (value + 1) * 10 ** (length - len(prefix)))
+        for length in range(max(len(prefix), 8), 16)
+    ]
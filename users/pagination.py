@@ -0,0 +1,61 @@
+import base64
+import json
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from users.renderers import render_json
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(position):
+    # Opaque token for the keyset position of the last row of a page
+    if position is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(list(position)).encode()).decode()
+
+
+def decode_cursor(token, shape):
+    # Keyset position of a cursor token, whose values must have the types of `shape` (a tuple of
+    # types, one per value), so that a forged or truncated cursor is a client error
+    if not token:
+        return None
+    try:
+        position = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except ValueError:
+        raise InvalidCursor("Invalid cursor.")
+    if not isinstance(position, list) or len(position) != len(shape):
+        raise InvalidCursor("Invalid cursor.")
+    for value, kind in zip(position, shape):
+        # JSON booleans decode to bool, a subclass of int
+        if not isinstance(value, kind) or isinstance(value, bool):
+            raise InvalidCursor("Invalid cursor.")
+    return position
+
+
+def get_page_size(query_params):
+    # Client requested page size, capped by the server-enforced SEARCH_MAX_PAGE_SIZE
+    try:
+        page_size = int(query_params.get('page_size', settings.SEARCH_MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        page_size = settings.SEARCH_MAX_PAGE_SIZE
+    return max(1, min(page_size, settings.SEARCH_MAX_PAGE_SIZE))
+
+
+def wants_stream(request):
+    # NDJSON export is opt-in through ?stream=ndjson
+    return request.GET.get('stream') == 'ndjson'
+
+
+def stream_ndjson(items):
+    # One JSON document per line, produced lazily so memory stays flat however many rows match
+    return StreamingHttpResponse((render_json(item) + b'\n' for item in items), content_type='application/x-ndjson')
+
+
+def stream_ndjson_async(items):
+    # Same as stream_ndjson for async iterators, served natively under ASGI
+    async def lines():
+        async for item in items:
+            yield render_json(item) + b'\n'
+    return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
@@ -0,0 +1,99 @@
+import unicodedata
+
+# Phonetic keys and edit distances for the typo-tolerant name search (see users/name_index.py).
+#
+# A word's key is a Soundex-style code: spellings that sound alike are rewritten to one spelling,
+# consonants are replaced by the digit of their sound class, vowels are dropped and repeated codes
+# collapsed. Unlike Soundex the first letter is coded too, so "Kumar" and "Cumar" share a key.
+
+# Rewritten before coding, in this order
+SOUND_ALIKES = (
+    ('sch', 's'), ('tch', 'ch'), ('ph', 'f'), ('gh', 'g'), ('kh', 'k'), ('bh', 'b'), ('dh', 'd'),
+    ('th', 't'), ('sh', 's'), ('ck', 'k'), ('qu', 'k'), ('wh', 'w'),
+)
+
+# Sound class of every coded letter; the other letters (vowels, h, y) are dropped
+SOUND_CLASSES = {
+    **dict.fromkeys('bfpvw', '1'),
+    **dict.fromkeys('cgjkqsxz', '2'),
+    **dict.fromkeys('dt', '3'),
+    'l': '4',
+    **dict.fromkeys('mn', '5'),
+    'r': '6',
+}
+
+VOWELS = set('aeiouy')
+
+# Coded sounds kept per key (Soundex keeps 3 after the first letter)
+KEY_LENGTH = 4
+
+# Shorter words (initials) get no key
+MIN_WORD_LENGTH = 2
+
+
+def ascii_letters(word):
+    # Lowercase ASCII letters of a word, accents removed ("José" -> "jose")
+    decomposed = unicodedata.normalize('NFKD', word.lower())
+    return ''.join(char for char in decomposed if 'a' <= char <= 'z')
+
+
+def phonetic_key(word):
+    # Phonetic key of one word, None for words too short or without letters
+    letters = ascii_letters(word)
+    if len(letters) < MIN_WORD_LENGTH:
+        return None
+    for spelling, sound in SOUND_ALIKES:
+        letters = letters.replace(spelling, sound)
+    # words starting with a vowel keep a marker, so that "Anil" and "Nil" differ
+    key = '0' if letters[0] in VOWELS else ''
+    for letter in letters:
+        code = SOUND_CLASSES.get(letter)
+        if code is not None and not key.endswith(code):
+            key += code
+    return key[:KEY_LENGTH] or None
+
+
+def phonetic_keys(name):
+    # Distinct phonetic keys of the words of a name, in word order
+    keys = []
+    for word in name.split():
+        key = phonetic_key(word)
+        if key is not None and key not in keys:
+            keys.append(key)
+    return keys
+
+
+class EditDistance:
+    # Levenshtein distance from one pattern to many texts with Myers' bit-parallel algorithm
+    # (in Hyyrö's formulation): the pattern is encoded once as per-character bit masks, and every
+    # text character updates a whole column of the dynamic programming matrix with a few integer
+    # operations, instead of one cell at a time.
+
+    def __init__(self, pattern):
+        self.length = len(pattern)
+        self.masks = {}
+        for position, char in enumerate(pattern):
+            self.masks[char] = self.masks.get(char, 0) | (1 << position)
+        self.all_bits = (1 << self.length) - 1
+        self.last_bit = 1 << (self.length - 1) if self.length else 0
+
+    def __call__(self, text):
+        if not self.length:
+            return len(text)
+        all_bits, last_bit, masks = self.all_bits, self.last_bit, self.masks
+        positive, negative, distance = all_bits, 0, self.length
+        for char in text:
+            equal = masks.get(char, 0)
+            vertical = equal | negative
+            horizontal = (((equal & positive) + positive) ^ positive) | equal
+            horizontal_positive = negative | (~(horizontal | positive) & all_bits)
+            horizontal_negative = positive & horizontal
+            if horizontal_positive & last_bit:
+                distance += 1
+            elif horizontal_negative & last_bit:
+                distance -= 1
+            horizontal_positive = ((horizontal_positive << 1) | 1) & all_bits
+            horizontal_negative = (horizontal_negative << 1) & all_bits
+            positive = horizontal_negative | (~(vertical | horizontal_positive) & all_bits)
+            negative = horizontal_positive & vertical
+        return distance
@@ -0,0 +1,109 @@
+import time
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Q
+from users.bulk_actions import batches
+from users.directory import deferred_refresh, schedule_refresh
+from users.models import NameIndexEntry, PhoneNumber, ShardPrefix
+from users.name_index import index_new_phone_numbers
+from users.numbers import prefix_ranges
+from users.sharding import delete_rows, shard_map, shards
+
+# Moves of directory rows between shards (see users/sharding.py), after a prefix was assigned to
+# another shard or shards were added.
+#
+# Rows are moved in batches: a batch is inserted on its new shard with its name index entries
+# (getting new ids there), then deleted from the old one, each side in its own transaction. The
+# prefix assignment is changed first, and the rows are moved once every worker reloaded it, so
+# that writes made while the rows move already go to the new shard. Until a number's rows are
+# moved its saved entries listing is incomplete; the directory rows of the moved numbers are
+# refreshed after every batch (or at the end of the enclosing deferred_refresh() block).
+
+ROW_COLUMNS = ('id', 'name', 'number', 'number_key', 'spam_likelihood')
+
+
+class InvalidAssignment(ValueError):
+    pass
+
+
+def assign_prefix(prefix, shard):
+    # Assign the numbers starting with `prefix` to `shard`
+    prefix = prefix.lstrip('+')
+    if not prefix.isdigit() or prefix.startswith('0') or len(prefix) > 15:
+        raise InvalidAssignment(f"'{prefix}' is not a number prefix (leading E.164 digits).")
+    if shard not in settings.DIRECTORY_SHARDS['SHARDS']:
+        raise InvalidAssignment(f"'{shard}' is not a configured shard ({', '.join(settings.DIRECTORY_SHARDS['SHARDS'])}).")
+    ShardPrefix.objects.using(DEFAULT_DB_ALIAS).update_or_create(prefix=prefix, defaults={'shard': shard})
+    shard_map.clear()
+    return prefix
+
+
+def unassign_prefix(prefix):
+    # Numbers starting with `prefix` go back to the shorter assigned prefixes, or to their hash shard
+    prefix = prefix.lstrip('+')
+    deleted, _ = ShardPrefix.objects.using(DEFAULT_DB_ALIAS).filter(prefix=prefix).delete()
+    if not deleted:
+        raise InvalidAssignment(f"'{prefix}' is not assigned to a shard.")
+    shard_map.clear()
+    return prefix
+
+
+def wait_for_workers():
+    # The workers reload the prefix assignments within MAP_CHECK_INTERVAL seconds
+    time.sleep(settings.DIRECTORY_SHARDS['MAP_CHECK_INTERVAL'])
+    shard_map.clear()
+
+
+def move_rows(source, ids):
+    # Move PhoneNumber rows (by id) from `source` to the shards of their numbers; returns
+    # {old id: new id} of the rows that moved
+    rows = list(PhoneNumber.objects.using(source).filter(id__in=ids).values_list(*ROW_COLUMNS))
+    targets = {}
+    for row in rows:
+        target = shard_map.shard_for_key(row[3])
+        if target != source:
+            targets.setdefault(target, []).append(row)
+
+    moved = {}
+    for target, target_rows in targets.items():
+        with transaction.atomic(using=target):
+            created = PhoneNumber.objects.using(target).bulk_create(
+                PhoneNumber(name=name, number=number, number_key=key, spam_likelihood=likelihood)
+                for row_id, name, number, key, likelihood in target_rows
+            )
+            index_new_phone_numbers(created, using=target)
+        moved.update(zip((row[0] for row in target_rows), (phone_number.pk for phone_number in created)))
+
+    if moved:
+        with transaction.atomic(using=source):
+            NameIndexEntry.objects.using(source).filter(phone_number_id__in=list(moved)).delete()
+            delete_rows(PhoneNumber, list(moved), using=source)
+        with deferred_refresh():
+            for row in rows:
+                if row[0] in moved:
+                    schedule_refresh(row[3])
+    return moved
+
+
+def rebalance(prefix=None, log=print):
+    # Move every row that is not on the shard of its number (only the numbers starting with
+    # `prefix` when given); returns the number of rows moved. The default database is scanned too
+    # when it is not a shard, which moves the rows of a directory that was not sharded before.
+    sources = shards()
+    if DEFAULT_DB_ALIAS not in sources:
+        sources.append(DEFAULT_DB_ALIAS)
+    ranges = Q()
+    for low, high in prefix_ranges(prefix) if prefix else []:
+        ranges |= Q(number_key__gte=low, number_key__lt=high)
+
+    total = 0
+    for source in sources:
+        moved = 0
+        for batch in batches(PhoneNumber.objects.using(source).filter(ranges), 'number_key'):
+            misplaced = [row_id for row_id, key in batch if shard_map.shard_for_key(key) != source]
+            if misplaced:
+                moved += len(move_rows(source, misplaced))
+        if moved:
+            log(f'{moved} rows moved out of {source}')
+        total += moved
+    return total
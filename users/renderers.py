@@ -0,0 +1,45 @@
+from django.http import HttpResponse
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    # installed by requirements.txt; the standard library encoder is used without it
+    orjson = None
+
+# Types orjson does not encode natively (Decimal, lazy translations, querysets, ...) go through DRF's encoder
+_fallback_encoder = JSONEncoder()
+
+# UTC datetimes end in "Z" as with DRF's encoder
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z if orjson is not None else 0
+
+
+def render_json(data):
+    # Compact UTF-8 JSON, encoded by orjson straight to bytes when it is installed
+    if orjson is None:
+        return JSONRenderer().render(data)
+    rendered = orjson.dumps(data, default=_fallback_encoder.default, option=ORJSON_OPTIONS)
+    if b'\xe2\x80' in rendered:
+        # same as DRF: U+2028 and U+2029 are escaped so that the output is valid JavaScript
+        rendered = rendered.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+    return rendered
+
+
+class FastJSONRenderer(JSONRenderer):
+    # DRF's JSONRenderer with orjson for the compact output of the API (the default). Indented
+    # output (e.g. "Accept: application/json; indent=4") and the ASCII-only or non-compact
+    # settings of DRF keep the standard library encoder.
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if (orjson is None or self.ensure_ascii or not self.compact
+                or self.get_indent(accepted_media_type, renderer_context or {}) is not None):
+            return super().render(data, accepted_media_type, renderer_context)
+        return render_json(data)
+
+
+def json_response(data, status=200):
+    # JsonResponse counterpart for the plain Django (async) views
+    return HttpResponse(render_json(data), status=status, content_type='application/json')
@@ -0,0 +1,59 @@
+from operator import itemgetter
+from users.numbers import format_key
+
+# Result rows of the name search and of the saved entries listing of a number.
+#
+# Rows are read with values_list() as plain (id, name, number, spam_likelihood, number_key) tuples
+# instead of model instances, and turned into the response objects with a single dict per row,
+# holding only the fields the client asked for (?fields=name,phone_number). Numbers are returned in
+# their E.164 form, as by every other endpoint, whatever form they were saved in.
+
+# PhoneNumber columns read for a result row, in tuple order
+RESULT_COLUMNS = ('id', 'name', 'number', 'spam_likelihood', 'number_key')
+ID, NAME, NUMBER, SPAM_LIKELIHOOD, NUMBER_KEY = range(len(RESULT_COLUMNS))
+
+
+def phone_number(row):
+    # saved numbers that are not valid numbers have no key and are returned as saved
+    key = row[NUMBER_KEY]
+    return row[NUMBER] if key is None else format_key(key)
+
+
+# Response fields, in response order, and the function reading each one from a row
+RESULT_FIELDS = {'name': itemgetter(NAME), 'phone_number': phone_number, 'spam_likelihood': itemgetter(SPAM_LIKELIHOOD)}
+
+
+class InvalidFields(ValueError):
+    pass
+
+
+def parse_fields(value):
+    # ?fields= value -> tuple of response fields in response order; None when every field is wanted
+    if not value:
+        return None
+    requested = {field.strip() for field in value.split(',')} - {''}
+    unknown = requested - RESULT_FIELDS.keys()
+    if unknown or not requested:
+        raise InvalidFields(f"Unknown fields: {', '.join(sorted(unknown)) or value}. Available fields: {', '.join(RESULT_FIELDS)}.")
+    return tuple(field for field in RESULT_FIELDS if field in requested)
+
+
+def format_result(row):
+    return {'name': row[NAME], 'phone_number': phone_number(row), 'spam_likelihood': row[SPAM_LIKELIHOOD]}
+
+
+def result_formatter(fields=None):
+    # Function turning a result row into its response object
+    if fields is None or fields == tuple(RESULT_FIELDS):
+        return format_result
+    columns = [(field, RESULT_FIELDS[field]) for field in fields]
+    return lambda row: {field: read(row) for field, read in columns}
+
+
+def format_results(rows, fields=None):
+    return list(map(result_formatter(fields), rows))
+
+
+def row_numbers(rows):
+    # Number keys of the rows, for the invalidation of cached results (see users/cache.py)
+    return {row[NUMBER_KEY] for row in rows if row[NUMBER_KEY] is not None}
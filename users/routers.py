@@ -0,0 +1,104 @@
+import random
+import time
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Read/write splitting between the primary ("default") and the read replicas of DATABASE_ROUTING.
+#
+# Only the reads of the search and lookup tables made while handling a request can go to a replica;
+# everything else (writes, authentication and user rows, management commands, background threads)
+# uses the primary. A request is pinned to the primary as soon as it writes or opens a transaction,
+# and a user stays pinned for DATABASE_ROUTING['STICKY_SECONDS'] after their own writes, so that
+# they read their writes while the replicas catch up.
+
+# Tables served by the search and lookup endpoints
+REPLICA_MODELS = {'numberdirectory', 'nameindexentry', 'phonenumber', 'contactmembership', 'usercontact', 'spamaction', 'spamchange'}
+
+_current = ContextVar('database_routing', default=None)
+
+
+class RequestRouting:
+    # Routing state of one request
+
+    def __init__(self):
+        self.pinned = False
+        self.wrote = False
+        self.user_id = None
+
+
+def start_request():
+    return _current.set(RequestRouting())
+
+
+def finish_request(token, request, response):
+    state = _current.get()
+    _current.reset(token)
+    if state is not None and state.wrote and state.user_id is not None and response.status_code < 400:
+        sticky_users.add(state.user_id)
+
+
+def note_write():
+    # For writes that do not go through the router in this request (e.g. buffered spam reports)
+    state = _current.get()
+    if state is not None:
+        state.wrote = state.pinned = True
+
+
+def user_authenticated(user_id):
+    # Called by the authentication class once the user of the request is known
+    state = _current.get()
+    if state is not None:
+        state.user_id = user_id
+        if sticky_users.is_sticky(user_id):
+            state.pinned = True
+
+
+class StickyUsers:
+    # Users that wrote in the last STICKY_SECONDS; kept in a cache so that every worker sees them
+    # when the cache is shared
+
+    @property
+    def cache(self):
+        return caches[settings.DATABASE_ROUTING['STICKY_CACHE']]
+
+    def key(self, user_id):
+        return f'db:sticky:{user_id}'
+
+    def add(self, user_id):
+        if settings.DATABASE_ROUTING['REPLICAS']:
+            self.cache.set(self.key(user_id), time.time(), settings.DATABASE_ROUTING['STICKY_SECONDS'])
+
+    def is_sticky(self, user_id):
+        return self.cache.get(self.key(user_id)) is not None
+
+
+sticky_users = StickyUsers()
+
+
+class PrimaryReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        replicas = settings.DATABASE_ROUTING['REPLICAS']
+        state = _current.get()
+        if not replicas or state is None or state.pinned or model._meta.model_name not in REPLICA_MODELS:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            # reads inside a transaction must see its writes
+            state.pinned = True
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        state = _current.get()
+        if state is not None:
+            state.wrote = state.pinned = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
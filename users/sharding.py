@@ -0,0 +1,209 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections
+from users.models import PhoneNumber, ShardPrefix
+from users.numbers import number_key
+
+# Number-prefix sharding of the global directory rows.
+#
+# PhoneNumber rows, and the name index entries pointing at them, are partitioned across the
+# database aliases of DIRECTORY_SHARDS['SHARDS'] by the E.164 digits of their number: the
+# ShardPrefix table (on the default database) assigns prefixes to shards, the longest assigned
+# prefix of a number wins, and numbers without an assigned prefix are spread by hash. Without
+# shards everything stays on the default database, and the shard of every row is None, which
+# .using() and transaction.atomic() read as "let the routers decide".
+#
+# Code reading or writing the sharded tables names the shard: .using(shard_for_key(key)) for the
+# rows of one number (a point lookup touches a single shard), group_by_shard() for sets of numbers
+# and run_on_shards() to scatter a query over every shard (the name searches) and gather the
+# results. PhoneNumber ids are unique across the shards: each one allocates them from its own
+# range of SHARD_ID_SPAN ids, set when it is migrated, and rows moving to another shard get a new
+# id there (see users/rebalancing.py). Transactions do not span shards: the derived tables of the
+# default database (name frequencies, directory) are written after the shard rows and can be
+# rebuilt from them with the rebuild commands.
+
+# Models stored on the shards
+SHARDED_MODELS = {'phonenumber', 'nameindexentry'}
+
+# PhoneNumber ids allocated per shard, the shard at position N starting at N * SHARD_ID_SPAN
+SHARD_ID_SPAN = 2 ** 40
+
+
+def sharded():
+    return bool(settings.DIRECTORY_SHARDS['SHARDS'])
+
+
+def shards():
+    # Aliases of the shards; [None] when the directory is not sharded
+    return list(settings.DIRECTORY_SHARDS['SHARDS']) or [None]
+
+
+def shard_connection(shard):
+    return connections[shard or DEFAULT_DB_ALIAS]
+
+
+def delete_rows(model, ids, using=None):
+    # Raw DELETE by primary key on a shard (or the default database); the ORM would load the rows
+    # to send the model signals one by one
+    if not ids:
+        return 0
+    connection = shard_connection(using)
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM {} WHERE {} IN ({})'.format(
+            quote(model._meta.db_table), quote(model._meta.pk.column), ', '.join(['%s'] * len(ids))), ids)
+        return cursor.rowcount
+
+
+class ShardMap:
+    # The prefix assignments of the ShardPrefix table in this process, reloaded every
+    # DIRECTORY_SHARDS['MAP_CHECK_INTERVAL'] seconds
+
+    def __init__(self):
+        self._prefixes = None
+        self._lengths = ()
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def prefixes(self):
+        now = time.monotonic()
+        if self._loaded_at is None or now - self._loaded_at >= settings.DIRECTORY_SHARDS['MAP_CHECK_INTERVAL']:
+            with self._lock:
+                if self._loaded_at is None or now - self._loaded_at >= settings.DIRECTORY_SHARDS['MAP_CHECK_INTERVAL']:
+                    # assignments to shards that are no longer configured are ignored
+                    configured = set(shards())
+                    prefixes = {prefix: shard for prefix, shard in ShardPrefix.objects.using(DEFAULT_DB_ALIAS).values_list('prefix', 'shard')
+                                if shard in configured}
+                    self._prefixes, self._lengths = prefixes, sorted({len(prefix) for prefix in prefixes}, reverse=True)
+                    self._loaded_at = now
+        return self._prefixes
+
+    def shard_for_key(self, key):
+        all_shards = shards()
+        if key is None:
+            # rows without a valid number
+            return all_shards[0]
+        prefixes = self.prefixes()
+        digits = str(key)
+        for length in self._lengths:
+            shard = prefixes.get(digits[:length])
+            if shard is not None:
+                return shard
+        return all_shards[key % len(all_shards)]
+
+    def clear(self):
+        self._loaded_at = None
+
+
+shard_map = ShardMap()
+
+
+def shard_for_key(key):
+    # Shard holding the PhoneNumber rows of a number key (None when the directory is not sharded)
+    if not sharded():
+        return None
+    return shard_map.shard_for_key(key)
+
+
+def group_by_shard(keys):
+    # {shard: [number keys]} of a set of number keys
+    if not sharded():
+        return {None: list(keys)}
+    groups = {}
+    for key in keys:
+        groups.setdefault(shard_map.shard_for_key(key), []).append(key)
+    return groups
+
+
+def queryset_shard(queryset):
+    # Shard of a queryset over a sharded model, for the writes derived from it
+    return queryset.db if sharded() else None
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _executor_for(workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None or _executor._max_workers != workers:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='shard-query')
+        return _executor
+
+
+def _run_on_shard(function, shard, args):
+    try:
+        return function(shard, *args)
+    finally:
+        # the pool threads keep their connections for CONN_MAX_AGE, like request threads
+        close_old_connections()
+
+
+def run_on_shards(function, *args):
+    # [function(shard, *args) for every shard], in shard order; run in parallel on the
+    # SEARCH_WORKERS threads of the process when there are several shards. Every task runs in a copy
+    # of the caller's context, so that its queries count in the metrics of the request.
+    all_shards = shards()
+    workers = settings.DIRECTORY_SHARDS['SEARCH_WORKERS']
+    if len(all_shards) == 1 or workers <= 0:
+        return [function(shard, *args) for shard in all_shards]
+    executor = _executor_for(workers)
+    futures = [executor.submit(contextvars.copy_context().run, _run_on_shard, function, shard, args) for shard in all_shards]
+    return [future.result() for future in futures]
+
+
+def start_id_range(shard):
+    # Make a freshly migrated shard allocate its PhoneNumber ids from its own range
+    if shard not in settings.DIRECTORY_SHARDS['SHARDS']:
+        return
+    start = settings.DIRECTORY_SHARDS['SHARDS'].index(shard) * SHARD_ID_SPAN
+    if not start:
+        return
+    connection = connections[shard]
+    table = PhoneNumber._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            # next AUTOINCREMENT id = highest of sqlite_sequence and of the table + 1
+            cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s AND seq < %s', [start, table, start])
+            cursor.execute('INSERT INTO sqlite_sequence (name, seq) SELECT %s, %s WHERE NOT EXISTS '
+                           '(SELECT 1 FROM sqlite_sequence WHERE name = %s)', [table, start, table])
+        elif connection.vendor == 'postgresql':
+            cursor.execute('SELECT setval(pg_get_serial_sequence(%s, %s), GREATEST(%s, (SELECT COALESCE(MAX({}), 0) FROM {})))'.format(
+                connection.ops.quote_name('id'), connection.ops.quote_name(table)), [table, 'id', start])
+
+
+class DirectoryShardRouter:
+    # Routes the sharded models when the directory is sharded: an instance is read from and saved
+    # to the shard it was loaded from, a new PhoneNumber row to the shard of its number, and their
+    # tables are only created on the shards (and the default database). Querysets without an
+    # instance cannot be routed by number, they name their shard with .using().
+
+    def _instance_shard(self, model, hints):
+        instance = hints.get('instance')
+        if instance is None or not sharded() or model._meta.model_name not in SHARDED_MODELS:
+            return None
+        if instance._state.db is not None:
+            return instance._state.db
+        if model._meta.model_name == 'phonenumber':
+            return shard_map.shard_for_key(number_key(instance.number))
+        # a new name index entry goes to the shard of its PhoneNumber row
+        phone_number = instance._state.fields_cache.get('phone_number')
+        return phone_number._state.db if phone_number is not None else None
+
+    def db_for_read(self, model, **hints):
+        return self._instance_shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._instance_shard(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == DEFAULT_DB_ALIAS or db not in settings.DIRECTORY_SHARDS['SHARDS']:
+            return None
+        return app_label == 'users' and model_name in SHARDED_MODELS
@@ -0,0 +1,218 @@
+from django.core.management import call_command
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_init, post_migrate, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from users.authentication import token_revocations
+from users.directory import schedule_refresh
+from users.membership import add_membership, remove_membership
+from users.name_counts import add_name, remove_name
+from users.metrics import install_query_recorder
+from users.name_index import index_phone_number
+from users.numbers import number_key
+from users.models import CustomUser, PhoneNumber, SpamAction, UserContact
+from users.rebalancing import move_rows
+from users.sharding import shard_for_key, start_id_range
+from users.spam import spam_reports
+from users.spam_feed import record_changes
+from users.spam_scores import spam_scores_changed
+
+
+# Derive the integer key of the number of every saved row (bulk writes set it themselves)
+
+@receiver(pre_save, sender=CustomUser)
+@receiver(pre_save, sender=UserContact)
+@receiver(pre_save, sender=SpamAction)
+def number_row_saving(sender, instance, **kwargs):
+    instance.number_key = number_key(instance.phone_number)
+
+
+@receiver(pre_save, sender=PhoneNumber)
+def phone_number_saving(sender, instance, **kwargs):
+    if instance._saved_name is NOT_LOADED:
+        instance._saved_name = PhoneNumber.objects.using(instance._state.db).filter(pk=instance.pk).values_list('number_key', 'name').first()
+    instance.number_key = number_key(instance.number)
+
+
+# The post_init receivers below remember the saved values of some fields to tell what a save
+# changed. They must not read deferred fields (.only()/.defer() querysets): loading one builds
+# another instance, and so on. NOT_LOADED stands for values read back from the database before
+# a save; a deleted row's saved values are its current ones.
+NOT_LOADED = object()
+
+
+def loaded(instance, *fields):
+    return not instance.get_deferred_fields().intersection(fields)
+
+
+@receiver(pre_delete, sender=PhoneNumber)
+@receiver(pre_delete, sender=UserContact)
+@receiver(pre_delete, sender=SpamAction)
+@receiver(pre_delete, sender=CustomUser)
+def number_row_deleting(sender, instance, **kwargs):
+    # the post_delete receivers read the fields of the deleted row: deferred ones are loaded while it still exists
+    deferred = instance.get_deferred_fields()
+    if deferred:
+        instance.refresh_from_db(fields=deferred)
+
+
+# Keep the name frequencies of the numbers in sync with PhoneNumber rows. Registered before the
+# directory receivers, which read them.
+
+@receiver(post_init, sender=PhoneNumber)
+def phone_number_loaded(sender, instance, **kwargs):
+    if not instance.pk:
+        instance._saved_name = None
+    elif loaded(instance, 'number_key', 'name'):
+        instance._saved_name = (instance.number_key, instance.name)
+    else:
+        instance._saved_name = NOT_LOADED
+
+
+@receiver(post_save, sender=PhoneNumber)
+def phone_number_saved(sender, instance, created, **kwargs):
+    previous, current = instance._saved_name, (instance.number_key, instance.name)
+    if not created and previous == current:
+        return
+    if previous is not None and not created:
+        remove_name(*previous)
+        if previous[0] != current[0]:
+            # the number itself changed, its former directory row loses this name
+            schedule_refresh(previous[0])
+    add_name(*current)
+    instance._saved_name = current
+
+
+@receiver(post_delete, sender=PhoneNumber)
+def phone_number_deleted(sender, instance, **kwargs):
+    previous = instance._saved_name
+    remove_name(*(previous if previous not in (None, NOT_LOADED) else (instance.number_key, instance.name)))
+
+
+# Keep the NumberDirectory row of every touched number up to date
+
+@receiver(post_save, sender=PhoneNumber)
+@receiver(post_delete, sender=PhoneNumber)
+@receiver(post_save, sender=SpamAction)
+@receiver(post_delete, sender=SpamAction)
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def number_row_changed(sender, instance, **kwargs):
+    schedule_refresh(instance.number_key)
+
+
+@receiver(post_delete, sender=SpamAction)
+def spam_action_deleted(sender, instance, **kwargs):
+    spam_reports.forget(instance.user_id, instance.number_key)
+
+
+# Record the new spam signals of the numbers whose scores changed in the spam change feed
+
+@receiver(spam_scores_changed)
+def spam_scores_updated(sender, keys, **kwargs):
+    record_changes(keys)
+
+
+# Keep the name search index of every saved PhoneNumber row up to date
+# (deleted rows drop their entries through the CASCADE foreign key)
+
+@receiver(post_save, sender=PhoneNumber)
+def phone_number_name_changed(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'name' not in update_fields:
+        return
+    index_phone_number(instance)
+
+
+# A sharded PhoneNumber row whose number changed to one of another shard moves there (see
+# users/sharding.py). Registered after the receivers above, which update the row where it was saved.
+
+@receiver(post_save, sender=PhoneNumber)
+def phone_number_relocating(sender, instance, **kwargs):
+    shard = shard_for_key(instance.number_key)
+    if shard is None or shard == instance._state.db:
+        return
+    moved = move_rows(instance._state.db, [instance.pk])
+    if instance.pk in moved:
+        instance.pk = moved[instance.pk]
+        instance._state.db = shard
+
+
+# Every shard allocates the PhoneNumber ids of its own range, and the database cache tables (the
+# token revocations) are created with the other tables
+
+@receiver(post_migrate)
+def database_migrated(sender, using, **kwargs):
+    if sender.label == 'users':
+        start_id_range(using)
+        call_command('createcachetable', database=using, verbosity=0)
+
+
+# Keep the reverse contact membership table in sync with UserContact rows
+
+@receiver(post_init, sender=UserContact)
+def user_contact_loaded(sender, instance, **kwargs):
+    if not instance.pk:
+        instance._saved_number_key = None
+    elif loaded(instance, 'number_key'):
+        instance._saved_number_key = instance.number_key
+    else:
+        instance._saved_number_key = NOT_LOADED
+
+
+@receiver(pre_save, sender=UserContact)
+def user_contact_saving(sender, instance, **kwargs):
+    if instance._saved_number_key is NOT_LOADED:
+        instance._saved_number_key = UserContact.objects.filter(pk=instance.pk).values_list('number_key', flat=True).first()
+
+
+@receiver(post_save, sender=UserContact)
+def user_contact_saved(sender, instance, created, **kwargs):
+    previous = instance._saved_number_key
+    if not created and previous == instance.number_key:
+        return
+    if previous is not None and not created:
+        remove_membership(instance.user_id, previous)
+    if instance.number_key is not None:
+        add_membership(instance.user_id, instance.number_key)
+    instance._saved_number_key = instance.number_key
+
+
+@receiver(post_delete, sender=UserContact)
+def user_contact_deleted(sender, instance, **kwargs):
+    previous = instance._saved_number_key
+    key = previous if previous not in (None, NOT_LOADED) else instance.number_key
+    if key is not None:
+        remove_membership(instance.user_id, key)
+
+
+# Count and time the SQL queries of every request (see users/metrics.py)
+
+@receiver(connection_created)
+def database_connected(sender, connection, **kwargs):
+    install_query_recorder(connection)
+
+
+# Revoke the access tokens of users whose token claims or access rights changed
+
+TOKEN_FIELDS = ('is_active', 'password', 'phone_number', 'name', 'is_staff', 'is_superuser')
+
+
+@receiver(post_init, sender=CustomUser)
+def custom_user_loaded(sender, instance, **kwargs):
+    if instance.pk and loaded(instance, *TOKEN_FIELDS):
+        instance._token_fields = tuple(getattr(instance, field) for field in TOKEN_FIELDS)
+    else:
+        # new user, or partially loaded one (any save of it revokes its tokens)
+        instance._token_fields = None
+
+
+@receiver(post_save, sender=CustomUser)
+def custom_user_saved(sender, instance, created, **kwargs):
+    current = tuple(getattr(instance, field) for field in TOKEN_FIELDS)
+    if not created and instance._token_fields != current:
+        token_revocations.revoke_user(instance.pk)
+    instance._token_fields = current
+
+
+@receiver(post_delete, sender=CustomUser)
+def custom_user_deleted(sender, instance, **kwargs):
+    token_revocations.revoke_user(instance.pk)
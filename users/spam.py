@@ -0,0 +1,203 @@
+import atexit
+import logging
+import threading
+from collections import Counter, OrderedDict
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from users.directory import deferred_refresh, schedule_refresh
+from users.models import CustomUser, NameIndexEntry, PhoneNumber, SpamAction
+from users.numbers import format_key
+from users.routers import note_write
+from users.sharding import delete_rows, group_by_shard, shard_connection
+from users.spam_scores import record_reports
+
+logger = logging.getLogger(__name__)
+
+# How many already-reported (user, number) pairs are remembered to skip repeat marks without a query
+SEEN_REPORTS_LIMIT = 100000
+
+
+class SpamReportBuffer:
+    # In-process write-behind buffer for spam reports.
+    #
+    # Reports are deduplicated per (user, number key) and written by a background thread in one
+    # transaction per batch: one multi-row SpamAction insert that skips the reports already stored
+    # (the unique constraint makes this idempotent across workers) followed by one atomic F()
+    # increment per distinct number.
+    # The increments of a sharded directory commit on their shards just before the reports do, and
+    # are reverted if the reports fail to commit, so that the retried batch counts them once.
+
+    def __init__(self, interval=None, batch_size=None):
+        self._interval = interval
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._seen = OrderedDict()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    @property
+    def interval(self):
+        return settings.SPAM_FLUSH_INTERVAL if self._interval is None else self._interval
+
+    @property
+    def batch_size(self):
+        return settings.SPAM_FLUSH_BATCH_SIZE if self._batch_size is None else self._batch_size
+
+    def add(self, user_id, number_key):
+        # Queue a report; returns False when this process already knows the user reported the number
+        key = (user_id, number_key)
+        with self._lock:
+            if key in self._seen or key in self._pending:
+                return False
+            self._pending[key] = True
+            pending_count = len(self._pending)
+
+        if self.interval <= 0:
+            self.flush()
+        else:
+            self._ensure_thread()
+            if pending_count >= self.batch_size:
+                self._wakeup.set()
+        return True
+
+    def forget(self, user_id, number_key):
+        # Called when a stored report is deleted so that the user can report the number again
+        with self._lock:
+            self._seen.pop((user_id, number_key), None)
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        # Write every pending report; returns the number of new reports stored
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending)
+                self._pending.clear()
+            if not batch:
+                return 0
+
+            try:
+                increments = self._write(batch)
+            except Exception:
+                # put the batch back so that the next flush retries it
+                with self._lock:
+                    for key in batch:
+                        self._pending.setdefault(key, True)
+                raise
+
+            with self._lock:
+                for key in batch:
+                    self._seen[key] = True
+                while len(self._seen) > SEEN_REPORTS_LIMIT:
+                    self._seen.popitem(last=False)
+            return sum(increments.values())
+
+    def _write(self, batch):
+        increments = Counter()
+        # reports of users deleted in the meantime are dropped
+        user_ids = set(CustomUser.objects.filter(pk__in={user_id for user_id, number_key in batch}).values_list('pk', flat=True))
+        # {shard: (increments, ids of the created rows)} of the shard writes already committed
+        committed = {}
+        # the directory rows are refreshed before the scores are updated, in the same transaction as
+        # the reports (see users/spam_scores.py)
+        try:
+            with transaction.atomic():
+                with deferred_refresh():
+                    self._store(batch, user_ids, increments, committed)
+                record_reports(increments)
+        except BaseException:
+            self._revert(committed)
+            raise
+        return increments
+
+    def _store(self, batch, user_ids, increments, committed):
+        reports = [(user_id, number_key) for user_id, number_key in batch if user_id in user_ids]
+        if reports:
+            # rows of the reports already stored (possibly by another worker) are not inserted, the
+            # new rows are told apart by the report time of the batch
+            reported_at = timezone.now()
+            SpamAction.objects.bulk_create([
+                SpamAction(user_id=user_id, phone_number=format_key(number_key), number_key=number_key,
+                           is_marked_as_spam=True, reported_at=reported_at)
+                for user_id, number_key in reports
+            ], ignore_conflicts=True)
+            inserted = set(SpamAction.objects.filter(user_id__in={user_id for user_id, number_key in reports},
+                                                     number_key__in={number_key for user_id, number_key in reports},
+                                                     reported_at=reported_at).values_list('user_id', 'number_key'))
+            for user_id, number_key in reports:
+                if (user_id, number_key) in inserted:
+                    increments[number_key] += 1
+
+        # the global rows of a number are on its shard (see users/sharding.py)
+        for shard, keys in group_by_shard(increments).items():
+            created = []
+            with transaction.atomic(using=shard):
+                for number_key in keys:
+                    updated = PhoneNumber.objects.using(shard).filter(number_key=number_key).update(spam_likelihood=F('spam_likelihood') + increments[number_key])
+                    if updated:
+                        # queryset updates bypass the model signals
+                        schedule_refresh(number_key)
+                    else:
+                        # number is not in the global database yet
+                        created.append(PhoneNumber.objects.using(shard).create(number=format_key(number_key), spam_likelihood=increments[number_key]).pk)
+            if shard_connection(shard) is not connections[DEFAULT_DB_ALIAS]:
+                # a shard on its own database committed
+                committed[shard] = ({number_key: increments[number_key] for number_key in keys}, created)
+
+    def _revert(self, committed):
+        # Undo the shard writes of a batch whose reports did not commit (raw deletes of the created
+        # rows: their model signals wrote to the default database, which rolled back)
+        for shard, (counts, created) in committed.items():
+            try:
+                with transaction.atomic(using=shard):
+                    for number_key, count in counts.items():
+                        (PhoneNumber.objects.using(shard).filter(number_key=number_key).exclude(pk__in=created)
+                         .update(spam_likelihood=F('spam_likelihood') - count))
+                    NameIndexEntry.objects.using(shard).filter(phone_number_id__in=created).delete()
+                    delete_rows(PhoneNumber, created, using=shard)
+            except Exception:
+                logger.exception('Failed to revert the spam likelihood increments of %s on %s', sorted(counts), shard)
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='spam-report-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                close_old_connections()
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush spam reports, retrying in %s seconds', self.interval)
+            finally:
+                close_old_connections()
+
+
+spam_reports = SpamReportBuffer()
+
+
+@atexit.register
+def _flush_on_exit():
+    try:
+        spam_reports.flush()
+    except Exception:
+        logger.exception('Failed to flush spam reports on exit')
+
+
+def report_spam(user, number_key):
+    # Entry point used by the views; the database write happens asynchronously
+    note_write()
+    return spam_reports.add(user.pk, number_key)
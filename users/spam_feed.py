@@ -0,0 +1,181 @@
+import gzip
+import threading
+import time
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max, Q
+from users.models import NumberDirectory, SpamChange, SpamFeedVersion
+from users.numbers import format_key
+from users.renderers import render_json
+from users.spam_scores import spam_score
+
+# Versioned change feed of the spam signals, for clients that keep a local copy of the spam list
+# and screen incoming calls without an API call.
+#
+# A client downloads the compressed baseline once, then polls for the changes since the version it
+# holds. Every change carries the full state of a number (not an increment), so applying a change
+# twice or out of a baseline that is already newer is harmless. The SpamChange log keeps a single
+# row per number, the latest one (recording a change deletes the previous row of the number), which
+# bounds the log by the number of reported numbers and makes a delta one range scan on the version
+# index. Versions come from the SpamFeedVersion counter row, locked by the recording transaction until
+# it commits: a client that saw version N can never miss a version below N committed later. Changes
+# are recorded when new reports are folded into the scores and when the scores are recomputed (the
+# spam_scores_changed signal of users/spam_scores.py).
+#
+# Scores are sent as the materialized decayed reporter count and its time, clients derive the 0-100
+# score at any later time with the parameters of the "scoring" object of the responses:
+# count * 2 ** (-(now - count_at) / (half_life_days * 86400)) = d, score = round(100 * d / (d + saturation))
+
+# Fields of every change, in array order
+FEED_COLUMNS = ('phone_number', 'spam_likelihood', 'score', 'score_at')
+
+# Number keys compared and written per batch while recording changes
+WRITE_BATCH_SIZE = 500
+
+# Log rows read per query while building the baseline
+BASELINE_CHUNK_SIZE = 5000
+
+# Signals of a number that is not (or no longer) reported
+CLEARED = (None, 0.0, None)
+
+SIGNAL_COLUMNS = ('spam_likelihood', 'spam_score', 'spam_score_at')
+
+
+def visible_signals(signals, now):
+    # What a client shows for a number: its spam likelihood and its current 0-100 score
+    likelihood, score, score_at = signals
+    return likelihood or 0, spam_score(score, score_at, now)
+
+
+def allocate_versions(count):
+    # `count` new feed versions. The UPDATE locks the counter row until the calling transaction
+    # commits, so concurrent writers commit their versions in the order they allocated them.
+    if not SpamFeedVersion.objects.filter(pk=1).update(version=F('version') + count):
+        # no counter row yet (tables created without the migration data): start after the log
+        try:
+            with transaction.atomic():
+                last = SpamChange.objects.aggregate(last=Max('version'))['last'] or 0
+                SpamFeedVersion.objects.create(pk=1, version=last)
+        except IntegrityError:
+            # created concurrently
+            pass
+        SpamFeedVersion.objects.filter(pk=1).update(version=F('version') + count)
+    last = SpamFeedVersion.objects.filter(pk=1).values_list('version', flat=True).get()
+    return range(last - count + 1, last + 1)
+
+
+def record_changes(keys):
+    # Append the current spam signals of a set of number keys to the feed. Numbers whose visible
+    # signals did not change since their last change are skipped, so that recomputing the scores
+    # does not resend every number. Returns the number of changes recorded.
+    keys = list({key for key in keys if key is not None})
+    now = time.time()
+    recorded = 0
+    with transaction.atomic():
+        for start in range(0, len(keys), WRITE_BATCH_SIZE):
+            batch = keys[start:start + WRITE_BATCH_SIZE]
+            current = dict.fromkeys(batch, CLEARED)
+            for key, *signals in NumberDirectory.objects.filter(number_key__in=batch).values_list('number_key', *SIGNAL_COLUMNS):
+                current[key] = tuple(signals)
+            previous = {key: tuple(signals) for key, *signals in
+                        SpamChange.objects.filter(number_key__in=batch).values_list('number_key', *SIGNAL_COLUMNS)}
+
+            changed = [key for key, signals in current.items()
+                       if visible_signals(signals, now) != visible_signals(previous.get(key, CLEARED), now)]
+            if not changed:
+                continue
+            SpamChange.objects.filter(number_key__in=changed).delete()
+            SpamChange.objects.bulk_create([
+                SpamChange(version=version, number_key=key, **dict(zip(SIGNAL_COLUMNS, current[key])))
+                for version, key in zip(allocate_versions(len(changed)), changed)
+            ])
+            recorded += len(changed)
+    return recorded
+
+
+def rebuild_spam_feed():
+    # Record the signals of every number of the feed and of every reported number of the directory,
+    # needed after writes that bypass the score maintenance (rebuild_directory, raw SQL). Numbers
+    # that are no longer reported get a cleared change.
+    keys = set(SpamChange.objects.values_list('number_key', flat=True))
+    keys.update(NumberDirectory.objects.filter(Q(spam_score__gt=0) | Q(spam_likelihood__gt=0))
+                .values_list('number_key', flat=True))
+    return record_changes(keys)
+
+
+def format_change(row):
+    # Compact array of a (version, number_key, spam_likelihood, spam_score, spam_score_at) log row
+    version, key, likelihood, score, score_at = row
+    return [format_key(key), likelihood or 0, round(score, 3), None if score_at is None else round(score_at)]
+
+
+def scoring():
+    return {
+        'half_life_days': settings.SPAM_SCORE['HALF_LIFE_DAYS'],
+        'saturation': settings.SPAM_SCORE['SATURATION'],
+    }
+
+
+def feed_rows():
+    return SpamChange.objects.order_by('version').values_list('version', 'number_key', *SIGNAL_COLUMNS)
+
+
+def changes_since(version, limit=None):
+    # Delta after `version`: at most `limit` changes, oldest first, and the version to ask for next
+    limit = limit or settings.SPAM_FEED['PAGE_SIZE']
+    rows = list(feed_rows().filter(version__gt=version)[:limit + 1])
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        'version': rows[-1][0] if rows else version,
+        'more': more,
+        'columns': FEED_COLUMNS,
+        'changes': [format_change(row) for row in rows],
+        'scoring': scoring(),
+    }
+
+
+def build_baseline():
+    # (version, gzip-compressed JSON) of every number currently reported, in the delta format
+    version = 0
+    changes = []
+    for row in feed_rows().iterator(chunk_size=BASELINE_CHUNK_SIZE):
+        version = row[0]
+        if row[2] or row[3]:
+            changes.append(format_change(row))
+    body = render_json({'version': version, 'more': False, 'columns': FEED_COLUMNS, 'changes': changes, 'scoring': scoring()})
+    return version, gzip.compress(body)
+
+
+class SpamFeedBaseline:
+    # The compressed baseline of this process, rebuilt at most every SPAM_FEED['BASELINE_MAX_AGE']
+    # seconds. A stale baseline is still correct: clients catch up with the changes since its version.
+
+    def __init__(self):
+        self._baseline = None
+        self._lock = threading.Lock()
+
+    def _stale(self, baseline):
+        return baseline is None or time.monotonic() - baseline[0] >= settings.SPAM_FEED['BASELINE_MAX_AGE']
+
+    def get(self):
+        # (version, compressed body)
+        baseline = self._baseline
+        if self._stale(baseline):
+            with self._lock:
+                baseline = self._baseline
+                if self._stale(baseline):
+                    baseline = self._baseline = (time.monotonic(), *build_baseline())
+        return baseline[1], baseline[2]
+
+    def clear(self):
+        self._baseline = None
+
+    def stats(self):
+        baseline = self._baseline
+        if baseline is None:
+            return {'built': False}
+        return {'built': True, 'version': baseline[1], 'bytes': len(baseline[2]), 'age': time.monotonic() - baseline[0]}
+
+
+spam_feed_baseline = SpamFeedBaseline()
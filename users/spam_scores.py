@@ -0,0 +1,144 @@
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import django
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, Exp
+from django.dispatch import Signal
+from users.cache import lookup_cache
+from users.models import NumberDirectory, SpamAction
+
+# Time-decayed spam scores.
+#
+# Every reporter counts once per number (SpamAction is unique per user and number) and the weight of
+# a report halves every SPAM_SCORE['HALF_LIFE_DAYS']. The decayed reporter count of each number is
+# materialized on its NumberDirectory row as (spam_score, spam_score_at): decaying it to any later
+# time is a single multiplication, so reads get the current score in O(1), and new reports are
+# folded in with one UPDATE per number. Deleted reports are only accounted for by a full
+# recompute (recompute_spam_scores command).
+
+# Directory rows updated per bulk_update of a full recompute
+WRITE_BATCH_SIZE = 1000
+
+# Sent with the number keys (keys=...) whose materialized scores changed, inside the transaction
+# that changed them (the spam change feed records them, see users/spam_feed.py)
+spam_scores_changed = Signal()
+
+
+def decay_rate():
+    # Per second
+    return math.log(2) / (settings.SPAM_SCORE['HALF_LIFE_DAYS'] * 86400)
+
+
+def decayed_score(score, score_at, now=None):
+    # Decayed reporter count at `now` of a materialized (spam_score, spam_score_at) pair
+    if not score or score_at is None:
+        return 0.0
+    now = time.time() if now is None else now
+    return score * math.exp(-decay_rate() * max(0.0, now - score_at))
+
+
+def spam_score(score, score_at, now=None):
+    # 0-100 score shown to clients: half of SPAM_SCORE['SATURATION'] recent reporters give 33,
+    # SATURATION reporters 50, and the score approaches 100 as reporters accumulate
+    decayed = decayed_score(score, score_at, now)
+    return round(100 * decayed / (decayed + settings.SPAM_SCORE['SATURATION']))
+
+
+def record_reports(increments, at=None):
+    # Fold new reports ({number key: count}) into the materialized scores, atomically per row:
+    # score = score * decay(at - score_at) + count
+    at = time.time() if at is None else at
+    for key, count in increments.items():
+        NumberDirectory.objects.filter(number_key=key).update(
+            spam_score=F('spam_score') * Exp(decay_rate() * (Coalesce(F('spam_score_at'), Value(at)) - at)) + count,
+            spam_score_at=at,
+        )
+        lookup_cache.invalidate_number(key)
+    if increments:
+        spam_scores_changed.send(sender=NumberDirectory, keys=list(increments))
+
+
+def in_range(queryset, field, bounds):
+    low, high = bounds
+    if low is not None:
+        queryset = queryset.filter(**{f'{field}__gte': low})
+    if high is not None:
+        queryset = queryset.filter(**{f'{field}__lt': high})
+    return queryset
+
+
+def shard_bounds(shards):
+    # Split the number key space into `shards` contiguous ranges with about the same number of reports
+    keys = (SpamAction.objects.filter(is_marked_as_spam=True).exclude(number_key=None)
+            .order_by('number_key').values_list('number_key', flat=True))
+    count = keys.count()
+    edges = sorted({keys[count * shard // shards] for shard in range(1, shards)} if count else set())
+    return list(zip([None, *edges], [*edges, None]))
+
+
+def now_datetime(now):
+    return datetime.fromtimestamp(now, tz=timezone.utc)
+
+
+def compute_scores(bounds, now):
+    # Decayed reporter counts at `now` of the number keys in a range, from the report timestamps.
+    # Runs in the worker processes.
+    rate = decay_rate()
+    reports = in_range(SpamAction.objects.filter(is_marked_as_spam=True, reported_at__lte=now_datetime(now))
+                       .exclude(number_key=None), 'number_key', bounds)
+    scores = {}
+    for key, reported_at in reports.values_list('number_key', 'reported_at').iterator(chunk_size=5000):
+        weight = math.exp(-rate * max(0.0, now - reported_at.timestamp()))
+        scores[key] = scores.get(key, 0.0) + weight
+    connections.close_all()
+    return bounds, scores
+
+
+def write_scores(bounds, scores, now):
+    # Replace the materialized scores of a range. Reports stored after `now` were not part of the
+    # computation; they are folded in within the same transaction so that none is lost.
+    with transaction.atomic():
+        scored = in_range(NumberDirectory.objects.exclude(spam_score=0), 'number_key', bounds)
+        keys = set(scored.values_list('number_key', flat=True)) | set(scores)
+        scored.update(spam_score=0, spam_score_at=None)
+        keys = list(keys)
+        for start in range(0, len(keys), WRITE_BATCH_SIZE):
+            batch = [key for key in keys[start:start + WRITE_BATCH_SIZE] if key in scores]
+            entries = list(NumberDirectory.objects.filter(number_key__in=batch).only('id', 'number_key'))
+            for entry in entries:
+                entry.spam_score = scores[entry.number_key]
+                entry.spam_score_at = now
+            NumberDirectory.objects.bulk_update(entries, ['spam_score', 'spam_score_at'])
+
+        late = in_range(SpamAction.objects.filter(is_marked_as_spam=True, reported_at__gt=now_datetime(now))
+                        .exclude(number_key=None), 'number_key', bounds)
+        increments = {}
+        for key in late.values_list('number_key', flat=True):
+            increments[key] = increments.get(key, 0) + 1
+        record_reports(increments)
+        spam_scores_changed.send(sender=NumberDirectory, keys=keys)
+
+    for key in keys:
+        lookup_cache.invalidate_number(key)
+
+
+def recompute_spam_scores(workers=None, shards=None, log=print):
+    # Full recomputation from the report timestamps: the number range is split into shards,
+    # scored in a process pool and written back shard by shard from this process
+    now = time.time()
+    workers = workers or os.cpu_count()
+    shards = shards or workers * 4
+    bounds = shard_bounds(shards)
+    connections.close_all()
+    total = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as executor:
+        for (low, high), scores in executor.map(compute_scores, bounds, [now] * len(bounds)):
+            write_scores((low, high), scores, now)
+            total += len(scores)
+            log(f'  number keys {low or "start"} to {high or "end"}: {len(scores)} reported numbers')
+    return total
@@ -0,0 +1,163 @@
+import bisect
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from django.conf import settings
+from django.db.models import Q
+from users.models import NumberDirectory
+from users.spam_scores import spam_score
+
+logger = logging.getLogger(__name__)
+
+# Memory-mapped snapshot of the spam signals of every reported number, for lookups that only need
+# the score (call screening) and should not touch the database.
+#
+# The file is a header followed by four columns of `count` values in native byte order, sorted by
+# number key: number keys (int64), materialized spam scores (float64) and their times (float64, NaN
+# when unset), then the highest spam_likelihood (int32). Readers map the file read-only and binary
+# search the key column in place, so every worker process shares the same pages of the OS page
+# cache. export_snapshot() writes a new file next to the old one and renames it over it; readers
+# notice the new file within SPAM_SNAPSHOT['CHECK_INTERVAL'] seconds and switch to it, while
+# lookups in flight finish on the old mapping.
+
+MAGIC = b'TDSPAM01'
+# Written in native order, tells readers on a machine of a different byte order apart
+BYTE_ORDER_MARK = 0x0102030405060708
+# magic, byte order mark, count, generated at (Unix time)
+HEADER = struct.Struct('=8sQQd')
+# (typecode, item size) of the columns, in file order
+COLUMNS = (('q', 8), ('d', 8), ('d', 8), ('i', 4))
+RECORD_SIZE = sum(size for code, size in COLUMNS)
+
+# Directory rows read per query while exporting
+EXPORT_CHUNK_SIZE = 5000
+
+
+class InvalidSnapshot(Exception):
+    pass
+
+
+def export_snapshot(path):
+    # Write the spam signals of the directory (the aggregate of the PhoneNumber and SpamAction rows
+    # of every number) to `path`, atomically replacing the previous snapshot; returns the number of entries
+    keys, scores, score_times, likelihoods = array('q'), array('d'), array('d'), array('i')
+    rows = (NumberDirectory.objects.filter(Q(spam_score__gt=0) | Q(spam_likelihood__gt=0)).order_by('number_key')
+            .values_list('number_key', 'spam_score', 'spam_score_at', 'spam_likelihood'))
+    for key, score, score_at, likelihood in rows.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        keys.append(key)
+        scores.append(score)
+        score_times.append(float('nan') if score_at is None else score_at)
+        likelihoods.append(likelihood or 0)
+
+    temporary = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temporary, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, BYTE_ORDER_MARK, len(keys), time.time()))
+            for column in (keys, scores, score_times, likelihoods):
+                column.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return len(keys)
+
+
+class SpamSnapshot:
+    # One mapped snapshot file; lookups read the mapping without copying it
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < HEADER.size:
+            raise InvalidSnapshot(f'{path} is too short for a spam snapshot.')
+        magic, byte_order_mark, self.count, self.generated_at = HEADER.unpack_from(self._map)
+        if magic != MAGIC or byte_order_mark != BYTE_ORDER_MARK:
+            raise InvalidSnapshot(f'{path} is not a spam snapshot of this machine type.')
+        if len(self._map) != HEADER.size + self.count * RECORD_SIZE:
+            raise InvalidSnapshot(f'{path} is truncated.')
+
+        view = memoryview(self._map)
+        start = HEADER.size
+        columns = []
+        for code, size in COLUMNS:
+            columns.append(view[start:start + self.count * size].cast(code))
+            start += self.count * size
+        self.keys, self.scores, self.score_times, self.likelihoods = columns
+
+    def get(self, key):
+        # (spam_likelihood, spam_score, spam_score_at) of a number key, None when it was not reported
+        index = bisect.bisect_left(self.keys, key)
+        if index == self.count or self.keys[index] != key:
+            return None
+        score_at = self.score_times[index]
+        return self.likelihoods[index], self.scores[index], None if score_at != score_at else score_at
+
+
+class SpamSnapshotReader:
+    # The current snapshot of SPAM_SNAPSHOT['PATH'] in this process, reloaded when the file is replaced
+
+    def __init__(self):
+        self._snapshot = None
+        self._identity = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def current(self):
+        # The mapped snapshot, or None when no snapshot is configured or readable
+        path = settings.SPAM_SNAPSHOT['PATH']
+        if not path:
+            return None
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at >= settings.SPAM_SNAPSHOT['CHECK_INTERVAL']:
+            with self._lock:
+                if self._checked_at is None or now - self._checked_at >= settings.SPAM_SNAPSHOT['CHECK_INTERVAL']:
+                    self._reload(path)
+                    self._checked_at = now
+        return self._snapshot
+
+    def _reload(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        identity = (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if identity == self._identity:
+            return
+        try:
+            snapshot = SpamSnapshot(path)
+        except (OSError, ValueError, InvalidSnapshot):
+            logger.exception('Failed to load the spam snapshot %s, keeping the previous one', path)
+            return
+        # the previous mapping is released once the lookups still using it are done
+        self._snapshot, self._identity = snapshot, identity
+
+    def lookup(self, key):
+        # (spam_likelihood, 0-100 spam score) of a number key from the snapshot, None without a snapshot
+        snapshot = self.current()
+        if snapshot is None:
+            return None
+        values = snapshot.get(key)
+        if values is None:
+            return 0, 0
+        likelihood, score, score_at = values
+        return likelihood, spam_score(score, score_at)
+
+    def clear(self):
+        with self._lock:
+            self._snapshot = self._identity = self._checked_at = None
+
+    def stats(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            return {'loaded': False}
+        return {'loaded': True, 'entries': snapshot.count, 'generated_at': snapshot.generated_at}
+
+
+spam_snapshot = SpamSnapshotReader()
@@ -1,3 +1,1623 @@
-from django.test import TestCase
+import base64
+import gzip
+import importlib
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import skipUnless
+from unittest.mock import patch
+from uuid import UUID
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.cache import caches
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import Count
+from django.http import HttpResponse
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from benchmarks import compare, dataset, load
+from users import bulk_actions, directory, generator, imports, metrics, rebalancing, routers
+from users.authentication import issue_tokens, token_revocations
+from users.cache import LocalLRUBackend, LookupCache, SharedCacheBackend, lookup_cache
+from users.heavy_hitters import CountMinSketch, HeavyHitters, hot_numbers
+from users.membership import BloomFilter, membership_index, rebuild_memberships
+from users.metrics import request_metrics
+from users.models import CustomUser, NameCount, NameIndexEntry, NumberDirectory, PhoneNumber, SpamAction, SpamChange, SpamFeedVersion, UserContact
+from users.name_counts import rebuild_name_counts, top_names
+from users.numbers import normalize, number_key
+from users.phonetic import EditDistance
+from users.renderers import FastJSONRenderer, json_response
+from users.routers import PrimaryReplicaRouter, sticky_users
+from users.sharding import run_on_shards, shard_for_key, shard_map, sharded, shards
+from users.spam import SpamReportBuffer, spam_reports
+from users.spam_feed import changes_since, record_changes, spam_feed_baseline
+from users.spam_scores import decayed_score, recompute_spam_scores, spam_score
+from users.spam_snapshot import BYTE_ORDER_MARK, HEADER, InvalidSnapshot, SpamSnapshot, export_snapshot, spam_snapshot
 
-# Create your tests here.
+
+def cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+# Spam reports are flushed right away, the hot numbers are not published from a background thread
+# and the shards (when configured) are searched from the test thread, which sees the test transactions
+@override_settings(SPAM_FLUSH_INTERVAL=0, HOT_NUMBERS={**settings.HOT_NUMBERS, 'PUBLISH_INTERVAL': 0},
+                   DIRECTORY_SHARDS={**settings.DIRECTORY_SHARDS, 'SEARCH_WORKERS': 0, 'MAP_CHECK_INTERVAL': 0})
+class APITestCase(TestCase):
+    # The process-wide caches are emptied before every test, and `self.client` is authenticated as `self.user`
+    databases = {'default', *settings.DIRECTORY_SHARDS['SHARDS']}
+
+    def setUp(self):
+        lookup_cache.clear()
+        membership_index.clear()
+        spam_reports._seen.clear()
+        hot_numbers.clear()
+        shard_map.clear()
+        token_revocations.clear()
+        self.user = CustomUser.objects.create_user(phone_number='+911111111111', name='Alice', email='alice@example.com', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def phone_numbers(self, number):
+        # PhoneNumber rows of a number, on its shard when sharded
+        key = number_key(number)
+        return PhoneNumber.objects.using(shard_for_key(key)).filter(number_key=key)
+
+    def bearer(self, user=None):
+        # Authorization header of the async views, which authenticate the JWT themselves
+        return f'Bearer {issue_tokens(user or self.user).access_token}'
+
+
+class DirectoryTests(APITestCase):
+
+    def entry(self, number):
+        return NumberDirectory.objects.filter(number_key=number_key(number)).first()
+
+    def test_saved_names_are_aggregated_on_insert_update_and_delete(self):
+        for name, likelihood in [('Asha', 10), ('Asha', 0), ('Anil', 40)]:
+            PhoneNumber.objects.create(name=name, number='9000000001', spam_likelihood=likelihood)
+        entry = self.entry('+91 90000 00001')
+        self.assertEqual((entry.number, entry.spam_likelihood, entry.user), ('+919000000001', 40, None))
+        self.assertEqual(entry.top_names, [{'name': 'Asha', 'count': 2}, {'name': 'Anil', 'count': 1}])
+
+        phone = self.phone_numbers('9000000001').get(name='Anil')
+        phone.name = 'Asha'
+        phone.save()
+        self.assertEqual(self.entry('9000000001').top_names, [{'name': 'Asha', 'count': 3}])
+
+        # a row moved to another number leaves the directory row of its former number
+        phone.number = '9000000002'
+        phone.save()
+        self.assertEqual(self.entry('9000000001').spam_likelihood, 10)
+        self.assertEqual(self.entry('9000000002').top_names, [{'name': 'Asha', 'count': 1}])
+
+        self.phone_numbers('9000000002').delete()
+        self.assertIsNone(self.entry('9000000002'))
+
+    def test_number_lookup_prefers_the_registered_user(self):
+        PhoneNumber.objects.create(name='Bobby', number='9000000003')
+        response = self.client.get('/search/number/09000000003/').json()
+        self.assertEqual(response['results'][0]['name'], 'Bobby')
+
+        bob = CustomUser.objects.create_user(phone_number='+919000000003', name='Bob', password='secret')
+        self.assertEqual(self.entry('9000000003').user, bob)
+        response = self.client.get('/search/number/9000000003/').json()
+        self.assertEqual((response['result']['name'], response['result']['phone_number']), ('Bob', '+919000000003'))
+
+        bob.delete()
+        self.assertIsNone(self.entry('9000000003').user)
+
+    def test_deferred_refresh_updates_every_number_once_on_exit(self):
+        with patch('users.directory.build_entries', wraps=directory.build_entries) as build_entries:
+            with directory.deferred_refresh():
+                for number in ['9000000004', '9000000005', '9000000004']:
+                    PhoneNumber.objects.create(name='Ravi', number=number)
+                self.assertIsNone(self.entry('9000000004'))
+        self.assertEqual(build_entries.call_count, 1)
+        self.assertEqual(self.entry('9000000004').top_names, [{'name': 'Ravi', 'count': 2}])
+        self.assertEqual(self.entry('9000000005').top_names, [{'name': 'Ravi', 'count': 1}])
+
+
+class NameSearchTests(APITestCase):
+    NAMES = ['Shriram', 'Sita Ram', 'Ramesh', 'ram kumar', 'Ram Ramesh', 'Mohan', 'Param Rama', 'Ramya']
+
+    def setUp(self):
+        super().setUp()
+        for index, name in enumerate(self.NAMES):
+            PhoneNumber.objects.create(name=name, number=f'90000000{index:02}')
+
+    def pages(self, url, page_size):
+        names, params = [], {'page_size': page_size}
+        while True:
+            response = self.client.get(url, params, HTTP_AUTHORIZATION=self.bearer()).json()
+            names.extend(row['name'] for row in response['results'])
+            if response['next'] is None:
+                return names
+            params['cursor'] = response['next']
+
+    def test_names_are_ranked_by_match_position(self):
+        # names starting with the query, then names with a word starting with it, then the others,
+        # every name once at its best position (then by key, then by id)
+        expected = ['ram kumar', 'Ram Ramesh', 'Ramesh', 'Ramya', 'Sita Ram', 'Param Rama', 'Shriram']
+        response = self.client.get('/search/name/RAM/').json()
+        self.assertEqual([row['name'] for row in response['results']], expected)
+        self.assertIsNone(response['next'])
+
+    def test_cursors_resume_without_repeating_or_skipping(self):
+        expected = ['ram kumar', 'Ram Ramesh', 'Ramesh', 'Ramya', 'Sita Ram', 'Param Rama', 'Shriram']
+        with patch('users.name_index.SCAN_CHUNK_SIZE', 2):
+            for page_size in [1, 2, 3]:
+                self.assertEqual(self.pages('/search/name/ram/', page_size), expected, page_size)
+                self.assertEqual(self.pages('/async/search/name/ram/', page_size), expected, page_size)
+            response = self.client.get('/search/name/ram/', {'stream': 'ndjson'})
+            self.assertEqual([json.loads(line)['name'] for line in b''.join(response.streaming_content).splitlines()], expected)
+
+    def test_queries_longer_than_the_keys_are_verified(self):
+        PhoneNumber.objects.create(name='Venkata Subramanya Sastry Gopalakrishnan', number='9000000099')
+        PhoneNumber.objects.create(name='Venkata Subramanya Sastry Gopalaswamy', number='9000000098')
+        response = self.client.get('/search/name/subramanya sastry gopalakrishnan/').json()
+        self.assertEqual([row['name'] for row in response['results']], ['Venkata Subramanya Sastry Gopalakrishnan'])
+        self.assertEqual(self.client.get('/search/name/ /').json()['results'], [])
+
+    def test_numbers_are_returned_in_e164_form(self):
+        PhoneNumber.objects.create(name='Ramdas', number='12345')
+        for url in ['/search/name/ramya/', '/async/search/name/ramya/']:
+            response = self.client.get(url, {'fields': 'phone_number'}, HTTP_AUTHORIZATION=self.bearer()).json()
+            self.assertEqual(response['results'], [{'phone_number': '+919000000007'}], url)
+        # saved numbers that are not valid numbers are returned as saved
+        response = self.client.get('/search/name/ramdas/').json()
+        self.assertEqual([row['phone_number'] for row in response['results']], ['12345'])
+
+
+class NameCountTests(APITestCase):
+
+    def counts(self):
+        return sorted(NameCount.objects.values_list('number_key', 'name', 'count'))
+
+    def test_counts_follow_the_rows(self):
+        for name in ['Asha', 'Asha', 'Anil', 'Ravi']:
+            PhoneNumber.objects.create(name=name, number='9000000001')
+        phone = self.phone_numbers('9000000001').get(name='Ravi')
+        phone.name = 'Anil'
+        phone.save()
+        self.assertEqual(self.counts(), [(919000000001, 'Anil', 2), (919000000001, 'Asha', 2)])
+
+        # renumbered rows move their name, the last row of a name removes it
+        phone.number = '9000000002'
+        phone.save()
+        self.phone_numbers('9000000001').filter(name='Asha').first().delete()
+        self.assertEqual(self.counts(), [(919000000001, 'Anil', 1), (919000000001, 'Asha', 1), (919000000002, 'Anil', 1)])
+
+        bulk_actions.delete_phone_numbers(self.phone_numbers('9000000001'))
+        self.assertEqual(self.counts(), [(919000000002, 'Anil', 1)])
+
+    def test_rebuild_matches_the_incremental_counts(self):
+        for index, name in enumerate(['Asha', 'Asha', 'Anil', 'Ravi', 'Ravi', 'Ravi']):
+            PhoneNumber.objects.create(name=name, number=f'900000000{index % 2}')
+        imports.import_contacts(self.user, [{'name': 'Asha', 'phone': '9000000001'}, {'name': 'Zoya', 'phone': '9000000003'}])
+        incremental = self.counts()
+        self.assertEqual(rebuild_name_counts(), len(incremental))
+        self.assertEqual(self.counts(), incremental)
+
+    def test_top_names(self):
+        for name, count in [('Asha', 3), ('Anil', 1), ('Bina', 3), ('Ravi', 2)]:
+            NameCount.objects.create(number_key=919000000001, name=name, count=count)
+        names = top_names([919000000001, 919000000002], 3)
+        # most common first, ties by name
+        self.assertEqual(names, {919000000001: [{'name': 'Asha', 'count': 3}, {'name': 'Bina', 'count': 3}, {'name': 'Ravi', 'count': 2}],
+                                 919000000002: []})
+
+
+class FuzzySearchTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name in ['Rahul', 'Rahul Kumar', 'Raul', 'Rail', 'Priya Sharma', 'Priya Verma', 'Kumar']:
+            PhoneNumber.objects.create(name=name, number='9000000001')
+
+    def search(self, query, **params):
+        return [row['name'] for row in self.client.get(f'/search/name/{query}/', {'match': 'fuzzy', **params}).json()['results']]
+
+    def test_typos_within_the_cutoff(self):
+        # "rahool" is two typos from "rahul", three from "raul" and "rail", which sound alike
+        self.assertEqual(self.search('rahool'), ['Rahul', 'Rahul Kumar'])
+        self.assertEqual(self.search('Priyaa Sarma'), ['Priya Sharma'])
+        self.assertEqual(self.search('kumaar rahul'), ['Rahul Kumar'])
+        # initials match any word
+        self.assertEqual(self.search('rahul k'), ['Rahul Kumar', 'Rahul', 'Raul'])
+        self.assertEqual(self.search('rahool', page_size=1), ['Rahul'])
+        self.assertEqual(self.search('xy'), [])
+
+    def test_edit_distance(self):
+        distance = EditDistance('rahool')
+        self.assertEqual([distance(word) for word in ['rahool', 'rahul', 'raul', '', 'rahoolx']], [0, 2, 3, 6, 1])
+        self.assertEqual(EditDistance('')('abc'), 3)
+
+    def test_async_results_match(self):
+        for query in ['rahool', 'Priyaa Sarma', 'rahul k']:
+            response = self.client.get(f'/async/search/name/{query}/', {'match': 'fuzzy'}, HTTP_AUTHORIZATION=self.bearer())
+            self.assertEqual([row['name'] for row in response.json()['results']], self.search(query), query)
+
+
+class AdminTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = Client()
+        self.admin.force_login(CustomUser.objects.create_superuser(phone_number='+913333333333', name='Admin', password='secret'))
+        for index, name in enumerate(['Asha Rao', 'Ravi', 'Asha', 'Bina']):
+            PhoneNumber.objects.create(name=name, number=f'900000000{index}', spam_likelihood=index)
+
+    def listed(self, url, **params):
+        # Names of the listed rows
+        response = self.admin.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return sorted(getattr(row, 'name', None) or row.contact_name for row in response.context['cl'].result_list)
+
+    def test_lists_are_not_counted(self):
+        for size in [4, 40]:
+            for index in range(UserContact.objects.count(), size):
+                UserContact.objects.create(user=self.user, contact_name=f'Contact {index}', phone_number=f'98000{index:05}')
+            with CaptureQueriesContext(connection) as queries:
+                self.admin.get('/admin/users/usercontact/')
+            self.assertFalse([query for query in queries if 'COUNT(' in query['sql'].upper()])
+        self.assertEqual(self.listed('/admin/users/usercontact/', q='+91 98000 00001'), ['Contact 1'])
+
+    def test_searches(self):
+        PhoneNumber.objects.create(name='Asha', number='9100000001')
+        self.assertEqual(self.listed('/admin/users/phonenumber/', q='+91 90000 00002'), ['Asha'])
+        # names through the name index, numbers by prefix
+        if not sharded():
+            self.assertEqual(self.listed('/admin/users/phonenumber/', q='asha'), ['Asha', 'Asha', 'Asha Rao'])
+            self.assertEqual(self.listed('/admin/users/phonenumber/', q='asha', number_prefix='9190'), ['Asha', 'Asha Rao'])
+        self.assertEqual(self.listed('/admin/users/customuser/', q='03333333333'), ['Admin'])
+        self.assertEqual(self.listed('/admin/users/customuser/', number_prefix='0'), [])
+
+    def test_set_based_delete(self):
+        actions = dict(self.admin.get('/admin/users/phonenumber/').context['action_form'].fields['action'].choices)
+        self.assertNotIn('delete_selected', actions)
+        for number in ['9000000000', '9000000002']:
+            shard = shard_for_key(number_key(number))
+            selected = list(self.phone_numbers(number).values_list('id', flat=True))
+            self.admin.post(f'/admin/users/phonenumber/?shard={shard}', {'action': 'delete_set', '_selected_action': selected})
+            self.assertFalse(self.phone_numbers(number).exists())
+            self.assertFalse(NameIndexEntry.objects.using(shard).filter(phone_number_id__in=selected).exists())
+        # the derived tables follow
+        self.assertFalse(NumberDirectory.objects.filter(number_key__in=[919000000000, 919000000002]).exists())
+        self.assertFalse(NameCount.objects.filter(name__startswith='Asha').exists())
+        self.assertEqual(self.client.get('/search/name/asha/').json()['results'], [])
+
+
+class SpamReportTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        PhoneNumber.objects.create(name='Spammer', number='9000000001')
+        self.other = CustomUser.objects.create_user(phone_number='+912222222222', name='Bob', password='secret')
+
+    def likelihoods(self, number):
+        return sorted(self.phone_numbers(number).values_list('spam_likelihood', flat=True))
+
+    def test_repeat_reports_count_once_whatever_the_number_format(self):
+        for number in ['9000000001', '+91 90000 00001', '09000000001']:
+            self.assertEqual(self.client.post(f'/markSpam/{number}/').status_code, 200)
+        self.assertEqual(self.likelihoods('9000000001'), [1])
+        other = APIClient()
+        other.force_authenticate(self.other)
+        other.post('/markSpam/9000000001/')
+        self.assertEqual(self.likelihoods('9000000001'), [2])
+        self.assertEqual(SpamAction.objects.filter(number_key=919000000001).count(), 2)
+        self.assertEqual(NumberDirectory.objects.get(number_key=919000000001).spam_reports, 2)
+        self.assertEqual(self.client.post('/markSpam/12/').status_code, 400)
+
+    def test_reports_of_unknown_numbers_add_an_unnamed_row(self):
+        self.client.post('/markSpam/9000000009/')
+        self.assertEqual(list(self.phone_numbers('9000000009').values_list('name', 'spam_likelihood')), [('', 1)])
+        self.assertEqual(NumberDirectory.objects.get(number_key=919000000009).spam_reports, 1)
+
+    def test_a_report_stored_by_another_worker_counts_once(self):
+        worker = SpamReportBuffer(interval=0)
+        self.assertTrue(spam_reports.add(self.user.pk, 919000000001))
+        self.assertTrue(worker.add(self.user.pk, 919000000001))
+        self.assertFalse(worker.add(self.user.pk, 919000000001))
+        self.assertEqual(self.likelihoods('9000000001'), [1])
+        self.assertEqual(SpamAction.objects.count(), 1)
+
+    def test_concurrent_reports_are_written_once(self):
+        buffer = SpamReportBuffer(interval=3600, batch_size=1000)
+        reports = [(user.pk, key) for user in [self.user, self.other] for key in [919000000001, 919000000002]] * 25
+        with patch.object(buffer, '_ensure_thread'), ThreadPoolExecutor(max_workers=8) as executor:
+            added = list(executor.map(lambda report: buffer.add(*report), reports))
+        self.assertEqual((added.count(True), buffer.pending_count()), (4, 4))
+        self.assertEqual(buffer.flush(), 4)
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual((self.likelihoods('9000000001'), self.likelihoods('9000000002')), ([2], [2]))
+        self.assertEqual(SpamAction.objects.count(), 4)
+
+    def test_a_batch_is_stored_with_one_insert(self):
+        SpamAction.objects.create(user=self.other, phone_number='9000000001', is_marked_as_spam=True)
+        buffer = SpamReportBuffer(interval=3600)
+        with patch.object(buffer, '_ensure_thread'):
+            for report in [(self.other.pk, 919000000001), (self.other.pk, 919000000002), (self.user.pk, 919000000001)]:
+                buffer.add(*report)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(buffer.flush(), 2)
+        table = f'"{SpamAction._meta.db_table}"'
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('INSERT') and table in query['sql'].split('(')[0]]), 1)
+        self.assertEqual(sorted(SpamAction.objects.values_list('user_id', 'number_key')),
+                         sorted([(self.other.pk, 919000000001), (self.other.pk, 919000000002), (self.user.pk, 919000000001)]))
+
+    def test_a_deleted_report_can_be_made_again(self):
+        self.client.post('/markSpam/9000000001/')
+        SpamAction.objects.get().delete()
+        self.assertEqual(NumberDirectory.objects.get(number_key=919000000001).spam_reports, 0)
+        self.client.post('/markSpam/9000000001/')
+        self.assertEqual(NumberDirectory.objects.get(number_key=919000000001).spam_reports, 1)
+
+    def test_reports_of_deleted_users_are_dropped(self):
+        buffer = SpamReportBuffer(interval=3600)
+        with patch.object(buffer, '_ensure_thread'):
+            buffer.add(self.other.pk, 919000000001)
+        self.other.delete()
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(self.likelihoods('9000000001'), [0])
+
+
+class SpamScoreTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        PhoneNumber.objects.create(name='Spammer', number='9000000001')
+
+    def score(self):
+        return self.client.get('/search/number/9000000001/').json()['results'][0]['spam_score']
+
+    def test_score_scale_and_decay(self):
+        now = time.time()
+        self.assertEqual(spam_score(5, now, now), 33)
+        self.assertEqual(spam_score(10, now, now), 50)
+        self.assertEqual(spam_score(0, None, now), 0)
+        # a report loses half its weight every HALF_LIFE_DAYS
+        self.assertAlmostEqual(decayed_score(4, now - 30 * 86400, now), 2)
+        self.assertAlmostEqual(decayed_score(4, now + 60, now), 4)
+
+    def test_reports_are_folded_into_the_directory_row(self):
+        self.assertEqual(self.score(), 0)
+        for phone_number in ['+912222222222', '+913333333333']:
+            reporter = APIClient()
+            reporter.force_authenticate(CustomUser.objects.create_user(phone_number=phone_number, name='Reporter', password='secret'))
+            reporter.post('/markSpam/9000000001/')
+        self.assertEqual(self.score(), 17)
+
+        # an old materialized score is decayed before the new report is added
+        month_ago = time.time() - 30 * 86400
+        NumberDirectory.objects.filter(number_key=919000000001).update(spam_score=2, spam_score_at=month_ago)
+        self.client.post('/markSpam/9000000001/')
+        entry = NumberDirectory.objects.get(number_key=919000000001)
+        self.assertAlmostEqual(entry.spam_score, 2, places=3)
+        self.assertEqual(self.score(), 17)
+
+
+class SpamFeedTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        spam_feed_baseline.clear()
+        self.addCleanup(spam_feed_baseline.clear)
+        self.reporters = []
+        for index in range(3):
+            reporter = APIClient()
+            reporter.force_authenticate(CustomUser.objects.create_user(phone_number=f'+91222222222{index}', name='Reporter', password='secret'))
+            self.reporters.append(reporter)
+
+    def changes(self, since, **params):
+        return self.client.get('/spam/feed/', {'since': since, **params}).json()
+
+    def apply(self, local, feed):
+        # What a client does with a response: every change replaces the state of its number
+        for number, likelihood, score, score_at in feed['changes']:
+            local[number] = (likelihood, score)
+        return feed['version']
+
+    def test_deltas_hold_the_changes_since_a_version(self):
+        self.reporters[0].post('/markSpam/9000000001/')
+        self.reporters[0].post('/markSpam/9000000002/')
+        feed = self.changes(0)
+        self.assertEqual([change[:2] for change in feed['changes']], [['+919000000001', 1], ['+919000000002', 1]])
+        self.assertEqual(feed['columns'], ['phone_number', 'spam_likelihood', 'score', 'score_at'])
+        version = feed['version']
+        self.assertEqual(self.changes(version)['changes'], [])
+
+        # only the number reported again, once, with its full state
+        self.reporters[1].post('/markSpam/9000000001/')
+        self.reporters[2].post('/markSpam/9000000001/')
+        feed = self.changes(version)
+        self.assertEqual([change[:3] for change in feed['changes']], [['+919000000001', 3, 3.0]])
+        self.assertGreater(feed['version'], version)
+        # the log keeps the latest change of every number
+        self.assertEqual(SpamChange.objects.count(), 2)
+
+        # recording unchanged signals again adds nothing
+        self.assertEqual(record_changes([919000000001, 919000000002]), 0)
+
+    def test_pages_chain_by_version(self):
+        for number in ['9000000001', '9000000002', '9000000003']:
+            self.reporters[0].post(f'/markSpam/{number}/')
+        local, version, pages = {}, 0, 0
+        with self.settings(SPAM_FEED={**settings.SPAM_FEED, 'PAGE_SIZE': 2}):
+            while True:
+                feed = self.changes(version)
+                version = self.apply(local, feed)
+                pages += 1
+                if not feed['more']:
+                    break
+        self.assertEqual(pages, 2)
+        self.assertEqual(sorted(local), ['+919000000001', '+919000000002', '+919000000003'])
+
+    def test_baseline_and_deltas_rebuild_the_spam_list(self):
+        self.reporters[0].post('/markSpam/9000000001/')
+        self.reporters[0].post('/markSpam/9000000002/')
+        response = self.client.get('/spam/feed/baseline/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        baseline = json.loads(gzip.decompress(response.content))
+        self.assertEqual(int(response['X-Spam-Feed-Version']), baseline['version'])
+        self.assertEqual(json.loads(self.client.get('/spam/feed/baseline/').content), baseline)
+
+        local = {}
+        version = self.apply(local, baseline)
+        self.reporters[1].post('/markSpam/9000000002/')
+        self.reporters[1].post('/markSpam/9000000003/')
+        self.apply(local, self.changes(version))
+
+        replayed = {}
+        self.apply(replayed, self.changes(0))
+        self.assertEqual(local, replayed)
+        self.assertEqual({number: likelihood for number, (likelihood, score) in local.items()},
+                         {'+919000000001': 1, '+919000000002': 2, '+919000000003': 1})
+
+    def test_invalid_versions(self):
+        for since in ['-1', 'x']:
+            self.assertEqual(self.client.get('/spam/feed/', {'since': since}).status_code, 400)
+        self.assertEqual(APIClient().get('/spam/feed/').status_code, 401)
+        self.assertEqual(APIClient().get('/spam/feed/baseline/').status_code, 401)
+
+
+class SpamFeedWriterTests(TransactionTestCase):
+    # the writers run on their own connections, which do not see test transactions
+    databases = {'default'}
+
+    def report(self, key):
+        NumberDirectory.objects.create(number=f'+{key}', number_key=key, spam_likelihood=1)
+
+    def test_versions_are_committed_in_allocation_order(self):
+        self.report(919000000001)
+        self.report(919000000002)
+        allocated, committed = threading.Event(), threading.Event()
+        overtaken = []
+
+        def first():
+            with transaction.atomic():
+                record_changes([919000000001])
+                allocated.set()
+                overtaken.append(committed.wait(0.5))
+            connections.close_all()
+
+        def second():
+            allocated.wait()
+            while True:
+                try:
+                    record_changes([919000000002])
+                    break
+                except OperationalError:
+                    # SQLite does not queue the writer behind the open transaction
+                    time.sleep(0.01)
+            committed.set()
+            connections.close_all()
+
+        threads = [threading.Thread(target=first), threading.Thread(target=second)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # the second writer allocated later and could only commit after the first one
+        self.assertEqual(overtaken, [False])
+        versions = dict(SpamChange.objects.values_list('number_key', 'version'))
+        self.assertLess(versions[919000000001], versions[919000000002])
+        self.assertEqual([row[1] for row in changes_since(0)['changes']], [1, 1])
+        self.assertEqual(changes_since(versions[919000000001])['changes'], [['+919000000002', 1, 0.0, None]])
+
+    def test_versions_continue_after_the_log_without_a_counter(self):
+        self.report(919000000001)
+        record_changes([919000000001])
+        SpamFeedVersion.objects.all().delete()
+        self.report(919000000002)
+        record_changes([919000000002])
+        self.assertEqual(sorted(SpamChange.objects.values_list('version', flat=True)), [1, 2])
+
+
+class SpamSnapshotTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        spam_snapshot.clear()
+        self.addCleanup(spam_snapshot.clear)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'spam.snapshot')
+        PhoneNumber.objects.create(name='Spammer', number='9000000001', spam_likelihood=4)
+        PhoneNumber.objects.create(name='Shop', number='9000000002')
+        self.client.post('/markSpam/9000000001/')
+
+    def spam(self, number):
+        return self.client.get(f'/search/number/{number}/', {'fields': 'spam'}).json()
+
+    def test_lookups_match_the_database_without_a_query(self):
+        expected = [self.spam(number) for number in ['9000000001', '9000000002', '9000000009']]
+        self.assertEqual(expected[0], {'phone_number': '+919000000001', 'spam_likelihood': 5, 'spam_score': 9})
+        self.assertEqual(export_snapshot(self.path), 1)
+
+        with self.settings(SPAM_SNAPSHOT={'PATH': self.path, 'CHECK_INTERVAL': 0}):
+            with CaptureQueriesContext(connection) as queries:
+                answers = [self.spam(number) for number in ['9000000001', '9000000002', '9000000009']]
+        self.assertEqual(answers, expected)
+        self.assertEqual(len(queries), 0)
+
+    def test_replaced_snapshots_are_picked_up(self):
+        export_snapshot(self.path)
+        with self.settings(SPAM_SNAPSHOT={'PATH': self.path, 'CHECK_INTERVAL': 0}):
+            self.assertEqual(self.spam('9000000002')['spam_likelihood'], 0)
+            self.client.post('/markSpam/9000000002/')
+            # until the next export the snapshot answers, which lags the database
+            self.assertEqual(self.spam('9000000002')['spam_likelihood'], 0)
+            export_snapshot(self.path)
+            self.assertEqual(self.spam('9000000002')['spam_likelihood'], 1)
+
+            # a broken file does not replace the loaded snapshot
+            with open(f'{self.path}.tmp', 'wb') as f:
+                f.write(HEADER.pack(b'TDSPAM01', BYTE_ORDER_MARK, 10, time.time()))
+            os.replace(f'{self.path}.tmp', self.path)
+            with self.assertLogs('users.spam_snapshot', 'ERROR'):
+                self.assertEqual(self.spam('9000000002')['spam_likelihood'], 1)
+        with self.assertRaises(InvalidSnapshot):
+            SpamSnapshot(self.path)
+
+    def test_exports_replace_the_file_atomically(self):
+        export_snapshot(self.path)
+        with patch('users.spam_snapshot.os.fsync', side_effect=OSError('disk full')), self.assertRaises(OSError):
+            export_snapshot(self.path)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['spam.snapshot'])
+        self.assertEqual(SpamSnapshot(self.path).get(919000000001)[0], 5)
+
+
+class ContactImportTests(APITestCase):
+
+    def upload(self, body, content_type='application/x-ndjson'):
+        return self.client.post('/contacts/import/', body.encode(), content_type=content_type)
+
+    def test_ndjson_rows_are_normalized_and_deduplicated(self):
+        body = '\n'.join([
+            json.dumps({'name': '  Asha   Rao ', 'phone': '+91 90000 00001'}),
+            json.dumps({'contact_name': 'Asha', 'number': '09000000001'}),
+            json.dumps({'name': 'Ravi', 'phone_number': '9000000002'}),
+            json.dumps({'name': 'No number', 'phone': '12'}),
+            json.dumps({'phone': '9000000003'}),
+            'not json',
+            '',
+        ])
+        response = self.upload(body)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {'imported': 2, 'duplicates': 1, 'invalid': 3, 'truncated': False})
+        self.assertEqual(sorted(UserContact.objects.values_list('contact_name', 'phone_number')),
+                         [('Asha Rao', '+919000000001'), ('Ravi', '+919000000002')])
+        self.assertEqual(NumberDirectory.objects.get(number_key=919000000001).top_names, [{'name': 'Asha Rao', 'count': 1}])
+        results = self.client.get('/search/name/rao/').json()['results']
+        self.assertEqual([(row['name'], row['phone_number']) for row in results], [('Asha Rao', '+919000000001')])
+
+        # numbers the user already saved are skipped
+        self.assertEqual(self.upload(json.dumps({'name': 'Ravi K', 'phone': '9000000002'})).json()['duplicates'], 1)
+
+    def test_csv_uploads(self):
+        response = self.upload('Name,Phone\nAsha,9000000001\nRavi,9000000002\n', 'text/csv')
+        self.assertEqual(response.json(), {'imported': 2, 'duplicates': 0, 'invalid': 0, 'truncated': False})
+        upload = io.BytesIO(b'contact_name,number\nAnil,9000000003\n')
+        upload.name = 'contacts.csv'
+        response = self.client.post('/contacts/import/', {'file': upload}, format='multipart')
+        self.assertEqual((response.status_code, response.json()['imported']), (201, 1))
+        self.assertEqual(UserContact.objects.count(), 3)
+
+        self.assertEqual(self.upload('first,second\na,b\n', 'text/csv').status_code, 400)
+        self.assertEqual(self.upload('Asha,9000000001', 'text/plain').status_code, 400)
+        self.assertEqual(self.client.post('/contacts/import/', {}, format='multipart').status_code, 400)
+
+    @override_settings(CONTACT_IMPORT_CHUNK_SIZE=2, CONTACT_IMPORT_MAX_ROWS=5)
+    def test_large_uploads_are_written_in_chunks_and_truncated(self):
+        body = '\n'.join(json.dumps({'name': f'Contact {index}', 'phone': f'90000000{index:02}'}) for index in range(8))
+        with patch('users.imports._write_chunk', wraps=imports._write_chunk) as write_chunk:
+            response = self.upload(body)
+        self.assertEqual(response.json(), {'imported': 5, 'duplicates': 0, 'invalid': 0, 'truncated': True})
+        self.assertEqual([len(call.args[1]) for call in write_chunk.call_args_list], [2, 2, 1])
+        self.assertEqual(NumberDirectory.objects.filter(number_key__in=range(919000000000, 919000000008)).count(), 5)
+
+    def test_saved_numbers_are_read_on_the_primary(self):
+        self.upload(json.dumps({'name': 'Asha', 'phone': '9000000001'}))
+        # reads routed to the (unconfigured) replica would fail; the router pins the reads made in
+        # a transaction, so the test transaction is hidden from it
+        with self.settings(DATABASE_ROUTING={**settings.DATABASE_ROUTING, 'REPLICAS': ['replica1']}), \
+                patch('users.routers.connections', {'default': SimpleNamespace(in_atomic_block=False)}):
+            response = self.upload(json.dumps({'name': 'Asha R', 'phone': '9000000001'}))
+        self.assertEqual(response.json()['duplicates'], 1)
+
+    def test_shard_rows_of_a_failed_chunk_are_deleted(self):
+        rows = [{'name': 'Asha', 'phone': '9000000001'}, {'name': 'Ravi', 'phone': '9000000002'}]
+        # the default transaction fails after the shards committed their rows
+        with patch('users.imports.add_new_memberships', side_effect=RuntimeError('failed')):
+            with self.assertRaisesMessage(RuntimeError, 'failed'):
+                imports.import_contacts(self.user, rows)
+        self.assertFalse(UserContact.objects.exists())
+        for shard in shards():
+            self.assertFalse(PhoneNumber.objects.using(shard or 'default').exists())
+            self.assertFalse(NameIndexEntry.objects.using(shard or 'default').exists())
+
+        # the import can be repeated
+        self.assertEqual(imports.import_contacts(self.user, rows)['imported'], 2)
+        self.assertEqual(sum(PhoneNumber.objects.using(shard or 'default').count() for shard in shards()), 2)
+
+
+class CursorTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        for number, name in [('9000000001', 'Asha'), ('9000000002', 'Anil'), ('9000000003', 'Priya Arora')]:
+            PhoneNumber.objects.create(name=name, number=number)
+
+    def test_malformed_name_cursors_are_rejected(self):
+        for position in [[], [1], [1, 'a'], [1, 'a', 2, 3], ['1', 'a', 2], [1, 2, 3], [1, 'a', '2'], [True, 'a', 2], [7, 'a', 2], {'rank': 1}]:
+            for url in ['/search/name/a/', '/async/search/name/a/']:
+                response = self.client.get(url, {'cursor': cursor(position)}, HTTP_AUTHORIZATION=self.bearer())
+                self.assertEqual(response.status_code, 400, (url, position))
+        self.assertEqual(self.client.get('/search/name/a/', {'cursor': 'not base64!'}).status_code, 400)
+
+    def test_malformed_number_cursors_are_rejected(self):
+        for position in [[], ['2'], [2, 3], [1.5], [False]]:
+            response = self.client.get('/search/number/9000000001/', {'cursor': cursor(position)})
+            self.assertEqual(response.status_code, 400, position)
+
+    def test_cursor_resumes_name_search(self):
+        first = self.client.get('/search/name/a/', {'page_size': 2}).json()
+        second = self.client.get('/search/name/a/', {'page_size': 2, 'cursor': first['next']}).json()
+        self.assertEqual([row['name'] for row in first['results'] + second['results']], ['Anil', 'Asha', 'Priya Arora'])
+        self.assertIsNone(second['next'])
+
+
+class BatchLookupTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bob = CustomUser.objects.create_user(phone_number='+912222222222', name='Bob', email='bob@example.com', password='secret')
+        UserContact.objects.create(user=self.bob, contact_name='Alice', phone_number='1111111111')
+        PhoneNumber.objects.create(name='Spammer', number='9999999999', spam_likelihood=3)
+
+    def test_lookups_in_input_order(self):
+        response = self.client.post('/search/numbers/', {'numbers': ['9999999999', 'nope', '+91 22222 22222', '5555555555']}, format='json')
+        self.assertEqual(response.status_code, 200)
+        lookups = response.json()['lookups']
+        self.assertEqual([lookup['number'] for lookup in lookups], ['9999999999', 'nope', '+91 22222 22222', '5555555555'])
+        self.assertEqual(lookups[0]['results'][0]['name'], 'Spammer')
+        self.assertEqual(lookups[1]['error'], 'Invalid phone number format')
+        # Bob saved Alice's number, so Alice sees his email
+        self.assertEqual(lookups[2]['result']['email'], 'bob@example.com')
+        self.assertEqual(lookups[3]['results'], [])
+
+    def test_queries_do_not_grow_with_the_batch(self):
+        counts = []
+        for size in [2, 40]:
+            lookup_cache.clear()
+            numbers = [f'98000{index:05}' for index in range(size)]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post('/search/numbers/', {'numbers': numbers}, format='json')
+            self.assertEqual(len(response.json()['lookups']), size)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_async_lookups_match_the_sync_ones(self):
+        numbers = ['9999999999', 'nope', '+91 22222 22222', '5555555555']
+        sync = self.client.post('/search/numbers/', {'numbers': numbers}, format='json').json()
+        response = self.client.post('/async/search/numbers/', {'numbers': numbers}, format='json', HTTP_AUTHORIZATION=self.bearer())
+        self.assertEqual(response.json(), sync)
+
+    def test_limits(self):
+        self.assertEqual(self.client.post('/search/numbers/', {'numbers': []}, format='json').status_code, 400)
+        with self.settings(BATCH_LOOKUP_MAX_NUMBERS=2):
+            self.assertEqual(self.client.post('/search/numbers/', {'numbers': ['1', '2', '3']}, format='json').status_code, 400)
+
+    def test_anonymous_lookups_are_unauthorized(self):
+        anonymous = APIClient()
+        self.assertEqual(anonymous.post('/search/numbers/', {'numbers': ['2222222222']}, format='json').status_code, 401)
+        self.assertEqual(anonymous.get('/search/number/2222222222/').status_code, 401)
+        self.assertEqual(anonymous.post('/async/search/numbers/', {'numbers': ['2222222222']}, format='json').status_code, 401)
+
+
+class ContactMembershipTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bob = CustomUser.objects.create_user(phone_number='+912222222222', name='Bob', email='bob@example.com', password='secret')
+
+    def email(self):
+        return self.client.get('/search/number/2222222222/').json()['result'].get('email')
+
+    def test_email_follows_the_contacts_of_the_registered_user(self):
+        self.assertIsNone(self.email())
+        contact = UserContact.objects.create(user=self.bob, contact_name='Alice', phone_number='+91 11111 11111')
+        self.assertEqual(self.email(), 'bob@example.com')
+
+        # a second row for the same number keeps the email visible until both are gone
+        other = UserContact.objects.create(user=self.bob, contact_name='Alice (work)', phone_number='01111111111')
+        contact.delete()
+        self.assertEqual(self.email(), 'bob@example.com')
+        other.phone_number = '3333333333'
+        other.save()
+        self.assertIsNone(self.email())
+
+    def test_memberships_are_rebuilt_from_the_contacts(self):
+        UserContact.objects.create(user=self.bob, contact_name='Alice', phone_number='1111111111')
+        UserContact.objects.filter(user=self.bob).update(phone_number='4444444444', number_key=number_key('4444444444'))
+        self.assertEqual(rebuild_memberships(), 1)
+        self.assertFalse(membership_index.has_saved(self.bob.id, number_key('1111111111')))
+        self.assertTrue(membership_index.has_saved(self.bob.id, number_key('4444444444')))
+
+    def test_negative_answers_skip_the_query(self):
+        UserContact.objects.create(user=self.bob, contact_name='Alice', phone_number='1111111111')
+        membership_index.has_saved(self.bob.id, number_key('1111111111'))
+        skipped = membership_index.stats()['skipped_queries']
+        with CaptureQueriesContext(connection) as queries:
+            self.assertFalse(membership_index.has_saved(self.bob.id, number_key('5555555555')))
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(membership_index.stats()['skipped_queries'], skipped + 1)
+        with self.settings(CONTACT_BLOOM_FILTERS={**settings.CONTACT_BLOOM_FILTERS, 'ENABLED': False}):
+            self.assertTrue(membership_index.has_saved(self.bob.id, number_key('1111111111')))
+
+    def test_owners_with_number(self):
+        carol = CustomUser.objects.create_user(phone_number='+913333333333', name='Carol', password='secret')
+        UserContact.objects.create(user=self.bob, contact_name='Alice', phone_number='1111111111')
+        owners = membership_index.owners_with_number([self.bob.id, carol.id, self.user.id], number_key('1111111111'))
+        self.assertEqual(owners, {self.bob.id})
+        self.assertEqual(membership_index.owners_with_number([self.bob.id], None), set())
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        keys = range(919000000000, 919000001000)
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        false_positives = sum(key in bloom for key in range(918000000000, 918000010000))
+        self.assertLess(false_positives, 300)
+
+
+class BenchmarkTests(APITestCase):
+
+    def test_in_process_client_counts_queries(self):
+        CustomUser.objects.create_user(phone_number='+913333333333', name='Carol', password=dataset.PASSWORD)
+        client = load.InProcessClient()
+        load.login(client, '+913333333333')
+        status, content, queries = client.request('GET', '/search/number/3333333333/')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(content)['result']['name'], 'Carol')
+        self.assertGreater(queries, 0)
+        with self.assertRaises(RuntimeError):
+            load.login(client, '+911111111111')
+
+    def test_scenarios_are_summarized(self):
+        class Client:
+            def __init__(self):
+                self.requests = []
+
+            def request(self, method, path, body=None):
+                self.requests.append(path)
+                if path == '/login/':
+                    return 200, b'{"access_token": "token"}', 1
+                return (404 if 'missing' in path else 200), b'', 3
+
+            def authenticate(self, token):
+                pass
+
+            def close(self):
+                pass
+
+        data = {'users': ['+911111111111'], 'numbers': ['9000000001', 'missing']}
+        summary = load.run_scenario('search_number', Client, data, requests=40, concurrency=4)
+        self.assertEqual(summary['requests'], 40)
+        self.assertEqual(summary['queries_per_request'], 3)
+        self.assertGreater(summary['errors'], 0)
+        self.assertLessEqual(summary['p50_ms'], summary['p95_ms'])
+        self.assertLessEqual(summary['p95_ms'], summary['p99_ms'])
+
+    def test_compare_gates_regressions(self):
+        baseline = {'scenarios': {'search_name': {'throughput_rps': 100, 'p50_ms': 10, 'p95_ms': 20, 'p99_ms': 30, 'queries_per_request': 2}}}
+        candidate = {'scenarios': {
+            'search_name': {'throughput_rps': 95, 'p50_ms': 15, 'p95_ms': 21, 'p99_ms': 60, 'queries_per_request': 2},
+            'export_name': {'throughput_rps': 10, 'p95_ms': 20},
+        }}
+        with redirect_stdout(io.StringIO()):
+            # p50 and p99 are reported but not gated
+            self.assertEqual(compare.compare(baseline, candidate, threshold=10), [])
+            candidate['scenarios']['search_name'].update(throughput_rps=80, queries_per_request=3)
+            regressions = compare.compare(baseline, candidate, threshold=10)
+        self.assertEqual([(name, metric) for name, metric, delta in regressions],
+                         [('search_name', 'throughput_rps'), ('search_name', 'queries_per_request')])
+
+
+class RequestMetricsTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        request_metrics.clear()
+        self.staff = CustomUser.objects.create_user(phone_number='+913333333333', name='Admin', password='secret', is_staff=True)
+
+    def scrape(self, **headers):
+        return self.client.get('/metrics/', headers=headers)
+
+    def test_requests_are_counted_by_route(self):
+        for number in ['9000000001', '9000000002']:
+            self.client.get(f'/search/number/{number}/')
+        self.client.get('/search/number/nope/')
+        text = self.scrape(Authorization=self.bearer(self.staff)).content.decode()
+        route = 'route="search/number/<str:query>/",method="GET"'
+        self.assertIn(f'truedetector_requests_total{{{route},status="200"}} 2', text)
+        self.assertIn(f'truedetector_requests_total{{{route},status="400"}} 1', text)
+        self.assertIn(f'truedetector_request_duration_seconds_count{{{route}}} 3', text)
+        self.assertIn(f'truedetector_request_db_queries_bucket{{{route},le="+Inf"}} 3', text)
+        # only the invalid number was answered without a query
+        self.assertIn(f'truedetector_request_db_queries_bucket{{{route},le="0"}} 1', text)
+
+    def test_shard_queries_count_in_the_request(self):
+        stats, token = metrics.start_request()
+        try:
+            with self.settings(DIRECTORY_SHARDS={**settings.DIRECTORY_SHARDS, 'SHARDS': ['shard1', 'shard2'], 'SEARCH_WORKERS': 2}):
+                # the shard functions run on the threads of the shard pool
+                run_on_shards(lambda shard: metrics.record_query(lambda *args: None, f'SELECT {shard}', None, False, None))
+        finally:
+            metrics._current.reset(token)
+        self.assertEqual(stats.queries, 2)
+
+    def test_scrapes_need_staff_or_the_token(self):
+        self.assertEqual(self.scrape().status_code, 403)
+        self.assertEqual(self.scrape(Authorization=self.bearer()).status_code, 403)
+        response = self.scrape(Authorization=self.bearer(self.staff))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        with self.settings(REQUEST_METRICS={**settings.REQUEST_METRICS, 'TOKEN': 'scraper'}):
+            self.assertEqual(self.scrape(Authorization='Bearer scraper').status_code, 200)
+            self.assertEqual(self.scrape(Authorization=self.bearer(self.staff)).status_code, 403)
+
+    def test_slow_requests_are_logged_with_their_sql(self):
+        with self.settings(REQUEST_METRICS={**settings.REQUEST_METRICS, 'SLOW_REQUEST_THRESHOLD': 0}), \
+                self.assertLogs('users.metrics', 'WARNING') as logs:
+            self.client.get('/search/number/9000000001/')
+        self.assertIn('Slow request GET /search/number/9000000001/ (search/number/<str:query>/)', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+
+# Run with two SQLite shards: SQLITE_SHARD_PATHS=shard1.sqlite3,shard2.sqlite3 python manage.py test users
+SHARDS = settings.DIRECTORY_SHARDS['SHARDS'][:2]
+
+
+@skipUnless(len(SHARDS) == 2, 'the directory shards are not configured (SQLITE_SHARD_PATHS)')
+@override_settings(DIRECTORY_SHARDS={'SHARDS': SHARDS, 'SEARCH_WORKERS': 0, 'MAP_CHECK_INTERVAL': 0})
+class ShardedTestCase(APITestCase):
+
+    def rows(self, shard):
+        return sorted(PhoneNumber.objects.using(shard).values_list('number_key', 'name', 'spam_likelihood'))
+
+
+class ShardedWriteTests(ShardedTestCase):
+
+    def test_spam_increments_are_reverted_when_the_reports_fail(self):
+        PhoneNumber.objects.create(name='Spammer', number='9999999999', spam_likelihood=2)
+        shard = shard_for_key(number_key('9999999999'))
+        new_shard = shard_for_key(number_key('9999999998'))
+        with patch('users.spam.record_reports', side_effect=RuntimeError('default database down')):
+            with self.assertRaises(RuntimeError):
+                spam_reports.add(self.user.pk, number_key('9999999999'))
+            with self.assertRaises(RuntimeError):
+                spam_reports.add(self.user.pk, number_key('9999999998'))
+        self.assertEqual(self.rows(shard), [(919999999999, 'Spammer', 2)])
+        self.assertFalse(PhoneNumber.objects.using(new_shard).filter(number_key=919999999998).exists())
+        self.assertFalse(SpamAction.objects.exists())
+
+        # the batch is retried by the next flush and counted once
+        self.assertEqual(spam_reports.flush(), 2)
+        self.assertEqual(self.rows(shard)[-1], (919999999999, 'Spammer', 3))
+        self.assertEqual(list(PhoneNumber.objects.using(new_shard).filter(number_key=919999999998).values_list('spam_likelihood', flat=True)), [1])
+
+    def test_generated_chunk_rows_are_deleted_when_the_chunk_fails(self):
+        users, contacts, reports = generator.generate_users(1, 0, 20, 5, 2)
+        password = make_password('secret')
+        failing_insert = generator.insert_rows
+
+        def insert_rows(model, *args, **kwargs):
+            if model is SpamAction:
+                raise RuntimeError('interrupted')
+            return failing_insert(model, *args, **kwargs)
+
+        with patch('users.generator.insert_rows', insert_rows), self.assertRaises(RuntimeError):
+            generator.write_chunk(users, contacts, reports, password)
+        self.assertEqual(sum(PhoneNumber.objects.using(shard).count() for shard in SHARDS), 0)
+
+        generator.write_chunk(users, contacts, reports, password)
+        self.assertEqual(sum(PhoneNumber.objects.using(shard).count() for shard in SHARDS), len(contacts))
+
+
+class ShardRoutingTests(ShardedTestCase):
+    # 919000000001 hashes to the second shard, 919000000002 to the first
+
+    def names(self, shard):
+        return sorted(NameIndexEntry.objects.using(shard).filter(rank=0).values_list('key', flat=True))
+
+    def test_rows_are_written_to_the_shard_of_their_number(self):
+        PhoneNumber.objects.create(name='Asha', number='9000000001')
+        PhoneNumber(name='Ravi', number='+91 90000 00002').save()
+        self.assertEqual(self.rows(SHARDS[1]), [(919000000001, 'Asha', 0)])
+        self.assertEqual(self.rows(SHARDS[0]), [(919000000002, 'Ravi', 0)])
+        self.assertEqual((self.names(SHARDS[0]), self.names(SHARDS[1])), (['ravi'], ['asha']))
+        if 'default' not in SHARDS:
+            self.assertFalse(PhoneNumber.objects.using('default').exists())
+
+    def test_a_changed_number_moves_its_row_with_the_directory(self):
+        phone = PhoneNumber.objects.create(name='Asha', number='9000000001')
+        phone.number = '9000000002'
+        phone.save()
+        self.assertEqual((self.rows(SHARDS[0]), self.rows(SHARDS[1])), ([(919000000002, 'Asha', 0)], []))
+        self.assertEqual((self.names(SHARDS[0]), self.names(SHARDS[1])), (['asha'], []))
+        self.assertEqual(phone._state.db, SHARDS[0])
+        self.assertFalse(NumberDirectory.objects.filter(number_key=919000000001).exists())
+        self.assertEqual(NumberDirectory.objects.get(number_key=919000000002).top_names, [{'name': 'Asha', 'count': 1}])
+        response = self.client.get('/search/name/asha/').json()
+        self.assertEqual([row['phone_number'] for row in response['results']], ['+919000000002'])
+
+    def test_rebalance_moves_the_rows_of_a_reassigned_prefix(self):
+        for name, number in [('Asha', '9000000001'), ('Anil', '9000000003'), ('Ravi', '9100000001')]:
+            PhoneNumber.objects.create(name=name, number=number)
+        self.assertEqual(len(self.rows(SHARDS[1])), 3)
+
+        rebalancing.assign_prefix('+91900', SHARDS[0])
+        self.assertEqual(rebalancing.rebalance('91900', log=lambda message: None), 2)
+        self.assertEqual(self.rows(SHARDS[0]), [(919000000001, 'Asha', 0), (919000000003, 'Anil', 0)])
+        self.assertEqual(self.rows(SHARDS[1]), [(919100000001, 'Ravi', 0)])
+        self.assertEqual(self.names(SHARDS[0]), ['anil', 'asha'])
+        self.assertEqual(rebalancing.rebalance(log=lambda message: None), 0)
+
+        response = self.client.get('/search/name/a/').json()
+        self.assertEqual([row['name'] for row in response['results']], ['Anil', 'Asha', 'Ravi'])
+        response = self.client.get('/search/number/9000000003/').json()
+        self.assertEqual(response['results'][0]['name'], 'Anil')
+
+
+class HotNumberTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        PhoneNumber.objects.create(name='Campaign', number='9888888888', spam_likelihood=1)
+        self.key = number_key('9888888888')
+
+    def test_hot_numbers_are_published_and_pinned(self):
+        for _ in range(12):
+            self.client.get('/search/number/9888888888/')
+        self.client.get('/search/number/9777777777/')
+        self.assertEqual(hot_numbers.publish(), 2)
+        self.assertEqual([row['number_key'] for row in hot_numbers.hottest()], [self.key, number_key('9777777777')])
+
+        with self.settings(HOT_NUMBERS={**settings.HOT_NUMBERS, 'PIN_MIN_COUNT': 10}):
+            self.assertEqual(hot_numbers.prewarm(), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/search/number/9888888888/').json()['results'][0]['name'], 'Campaign')
+
+    def test_pinned_lookups_expire(self):
+        lookup_cache.pin_numbers([self.key], lambda keys: {key: 'pinned' for key in keys})
+        self.assertEqual(lookup_cache.get_pinned([self.key]), {self.key: 'pinned'})
+        computed_at, value = lookup_cache._pinned[self.key]
+        lookup_cache._pinned = {self.key: (computed_at - settings.LOOKUP_CACHE['PIN_MAX_AGE'], value)}
+        self.assertEqual(lookup_cache.get_pinned([self.key]), {})
+        self.assertEqual(lookup_cache.stats()['pinned_numbers'], 0)
+        self.assertEqual(self.client.get('/search/number/9888888888/').json()['results'][0]['name'], 'Campaign')
+
+    def test_pinned_lookups_expire_with_the_ttl(self):
+        lookup_cache.pin_numbers([self.key], lambda keys: {key: 'pinned' for key in keys})
+        computed_at, value = lookup_cache._pinned[self.key]
+        lookup_cache._pinned = {self.key: (computed_at - settings.LOOKUP_CACHE['TTL'], value)}
+        with self.settings(LOOKUP_CACHE={**settings.LOOKUP_CACHE, 'PIN_MAX_AGE': 2 * settings.LOOKUP_CACHE['TTL']}):
+            self.assertEqual(lookup_cache.get_pinned([self.key]), {})
+
+    def test_pinned_lookups_are_refreshed_when_publishing_fails(self):
+        refreshed = []
+
+        def prewarm():
+            refreshed.append(True)
+            # stops the publishing loop
+            settings.HOT_NUMBERS = {**settings.HOT_NUMBERS, 'PUBLISH_INTERVAL': 0}
+
+        with self.settings(HOT_NUMBERS={**settings.HOT_NUMBERS, 'PUBLISH_INTERVAL': 0.01}), \
+                patch.object(hot_numbers, 'publish', side_effect=RuntimeError('database down')), \
+                patch.object(hot_numbers, 'prewarm', prewarm), self.assertLogs('users.heavy_hitters', 'ERROR'):
+            hot_numbers._run()
+        self.assertEqual(refreshed, [True])
+
+
+class HeavyHittersTests(SimpleTestCase):
+
+    def test_sketch_estimates_never_undercount(self):
+        sketch = CountMinSketch(64, 4)
+        counts = {919000000000 + key: key % 7 + 1 for key in range(500)}
+        for key, count in counts.items():
+            sketch.add(key, count)
+        self.assertTrue(all(sketch.estimate(key) >= count for key, count in counts.items()))
+        with self.assertRaises(ValueError):
+            CountMinSketch(64, 9)
+
+    def test_campaign_numbers_enter_the_top(self):
+        hitters = HeavyHitters(3, 256, 4)
+        campaign = [919800000000 + key for key in range(2)]
+        for batch in range(50):
+            for key in campaign:
+                hitters.add(key)
+            for key in range(20):
+                hitters.add(919000000000 + batch * 20 + key)
+        self.assertTrue(set(campaign) <= set(hitters.top))
+        self.assertEqual(min(hitters.estimate(key) for key in campaign), 50)
+
+        # counts halve with every half-life
+        hitters.decay(0.5)
+        self.assertEqual(hitters.estimate(campaign[0]), 25)
+        self.assertEqual(hitters.sketch.estimate(campaign[0]), 25)
+
+
+class SavedEntriesTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name in ['Rahul', 'Rahul K', 'Rahul Kumar', 'Mr Rahul', 'Rahul Office']:
+            PhoneNumber.objects.create(name=name, number='9812345678', spam_likelihood=1)
+
+    def pages(self, url, **params):
+        names = []
+        cursor = None
+        while True:
+            page = self.client.get(url, {**params, 'page_size': 2, **({'cursor': cursor} if cursor else {})},
+                                   HTTP_AUTHORIZATION=self.bearer()).json()
+            names += [row.get('name') for row in page['results']]
+            cursor = page['next']
+            if cursor is None:
+                return names, page
+
+    def test_saved_entries_pages(self):
+        names, last = self.pages('/search/number/9812345678/')
+        self.assertEqual(names, ['Rahul', 'Rahul K', 'Rahul Kumar', 'Mr Rahul', 'Rahul Office'])
+        self.assertEqual(len(last['results']), 1)
+
+    async def test_async_number_lookup_matches_the_sync_one(self):
+        headers = {'Authorization': self.bearer()}
+        for params in [{'page_size': 2}, {'page_size': 2, 'fields': 'name'}, {'page_size': 50, 'fields': 'phone_number,spam_likelihood'}, {}]:
+            sync = await sync_to_async(self.client.get)('/search/number/9812345678/', params)
+            response = await self.async_client.get('/async/search/number/9812345678/', params, headers=headers)
+            self.assertEqual(response.json(), sync.json(), params)
+
+        sync = await sync_to_async(lambda: self.client.get('/search/number/9812345678/', {'stream': 'ndjson', 'fields': 'name'}).getvalue())()
+        response = await self.async_client.get('/async/search/number/9812345678/', {'stream': 'ndjson', 'fields': 'name'}, headers=headers)
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), sync)
+
+        for params in [{'cursor': cursor(['x'])}, {'page_size': 2, 'fields': 'email'}]:
+            response = await self.async_client.get('/async/search/number/9812345678/', params, headers=headers)
+            self.assertEqual(response.status_code, 400, params)
+
+
+class AsyncViewTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bob = CustomUser.objects.create_user(phone_number='+912222222222', name='Bob', email='bob@example.com', password='secret')
+        UserContact.objects.create(user=self.bob, contact_name='Alice', phone_number='+911111111111')
+        for name, number in [('Asha', '9000000001'), ('Aasha', '9000000002'), ('Ravi Asha', '9000000003')]:
+            PhoneNumber.objects.create(name=name, number=number)
+
+    async def test_async_views_answer_like_the_sync_ones(self):
+        headers = {'Authorization': self.bearer()}
+        for url in ['/search/name/asha/', '/search/name/asha/?match=fuzzy', '/search/name/asha/?fields=name&page_size=1',
+                    '/search/number/+912222222222/', '/search/number/9000000001/?fields=spam', '/search/number/12/']:
+            sync = await sync_to_async(self.client.get)(url)
+            response = await self.async_client.get(f'/async{url}', headers=headers)
+            self.assertEqual((response.status_code, response.json()), (sync.status_code, sync.json()), url)
+
+        # Bob saved Alice's number, so she sees his email
+        response = await self.async_client.get('/async/search/number/2222222222/', headers=headers)
+        self.assertEqual(response.json()['result']['email'], 'bob@example.com')
+
+    async def test_async_name_search_streams(self):
+        response = await self.async_client.get('/async/search/name/asha/', {'stream': 'ndjson'}, headers={'Authorization': self.bearer()})
+        lines = b''.join([chunk async for chunk in response.streaming_content]).splitlines()
+        self.assertEqual([json.loads(line)['name'] for line in lines], ['Asha', 'Ravi Asha', 'Aasha'])
+
+    async def test_async_views_need_a_valid_token(self):
+        for headers in [{}, {'Authorization': 'Bearer nope'}, {'Authorization': 'Basic abc'}]:
+            response = await self.async_client.get('/async/search/name/asha/', headers=headers)
+            self.assertEqual(response.status_code, 401, headers)
+        response = await self.async_client.post('/async/search/name/asha/', headers={'Authorization': self.bearer()})
+        self.assertEqual(response.status_code, 405)
+
+
+class NumberCanonicalizationTests(APITestCase):
+
+    def test_equivalent_numbers_have_one_key(self):
+        formats = ['+91 98765 43210', '0091-98765-43210', '098765 43210', '9876543210', '+91 (98765) 432.10', 919876543210]
+        self.assertEqual({number_key(number) for number in formats}, {919876543210})
+        self.assertEqual(normalize('98765 43210'), '+919876543210')
+        for invalid in ['12345', '+0123456789', 'abc', '', None, '+1234567890123456']:
+            self.assertIsNone(number_key(invalid), invalid)
+
+    def test_lookups_match_any_format(self):
+        PhoneNumber.objects.create(name='Shop', number='098765 43210')
+        for query in ['9876543210', '+919876543210', '0091 98765 43210']:
+            self.assertEqual(self.client.get(f'/search/number/{query}/').json()['results'][0]['name'], 'Shop', query)
+
+    def test_a_number_registers_once_whatever_its_format(self):
+        anonymous = APIClient()
+        response = anonymous.post('/signup/', {'name': 'Bob', 'phone': '098765 43210', 'password': 'secret'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(CustomUser.objects.get(name='Bob').phone_number, '+919876543210')
+        response = anonymous.post('/signup/', {'name': 'Eve', 'phone': '+91 98765 43210', 'password': 'secret'}, format='json')
+        self.assertEqual(response.status_code, 409)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CustomUser.objects.create_user(phone_number='9876543210', name='Eve', password='secret')
+
+        response = anonymous.post('/login/', {'phone_number': '0091 98765 43210', 'password': 'secret'}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+
+class LookupCacheInvalidationTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        PhoneNumber.objects.create(name='Asha', number='9000000001')
+        PhoneNumber.objects.create(name='Ravi', number='9000000002')
+
+    def search(self, query, **params):
+        misses = lookup_cache.misses
+        response = self.client.get(f'/search/name/{query}/', params)
+        self.assertEqual(response.status_code, 200)
+        return [(row['name'], row['spam_likelihood']) for row in response.json()['results']], lookup_cache.misses > misses
+
+    def test_reports_drop_only_the_name_results_showing_the_number(self):
+        self.assertEqual(self.search('asha'), ([('Asha', 0)], True))
+        self.assertEqual(self.search('asha'), ([('Asha', 0)], False))
+        self.assertEqual(self.search('ravi'), ([('Ravi', 0)], True))
+        self.assertEqual(self.search('ravi', match='fuzzy'), ([('Ravi', 0)], True))
+
+        self.client.post('/markSpam/9000000002/')
+        self.client.post('/markSpam/9000000009/')
+        self.assertEqual(self.search('asha'), ([('Asha', 0)], False))
+        self.assertEqual(self.search('ravi'), ([('Ravi', 1)], True))
+        self.assertEqual(self.search('ravi', match='fuzzy'), ([('Ravi', 1)], True))
+        self.assertEqual(self.search('ravi'), ([('Ravi', 1)], False))
+
+    def test_reports_drop_only_the_name_results_showing_the_number_from_a_shared_cache(self):
+        with patch.object(lookup_cache, '_backend', SharedCacheBackend('default')):
+            lookup_cache.clear()
+            self.test_reports_drop_only_the_name_results_showing_the_number()
+
+    def test_new_renamed_and_deleted_names_drop_the_name_results(self):
+        self.search('asha')
+        PhoneNumber.objects.create(name='Asha Rao', number='9000000003')
+        self.assertEqual(self.search('asha'), ([('Asha', 0), ('Asha Rao', 0)], True))
+
+        phone = self.phone_numbers('9000000002').get()
+        phone.name = 'Asha Ravi'
+        phone.save()
+        self.assertEqual(self.search('asha')[0], [('Asha', 0), ('Asha Rao', 0), ('Asha Ravi', 0)])
+
+        self.phone_numbers('9000000003').delete()
+        self.assertEqual(self.search('asha'), ([('Asha', 0), ('Asha Ravi', 0)], True))
+
+    def test_reports_drop_the_number_lookup(self):
+        self.assertEqual(self.client.get('/search/number/9000000001/').json()['results'][0]['spam_likelihood'], 0)
+        self.client.post('/markSpam/9000000001/')
+        self.assertEqual(self.client.get('/search/number/9000000001/').json()['results'][0]['spam_likelihood'], 1)
+
+
+@override_settings(DATABASE_ROUTING={'REPLICAS': ['replica1'], 'STICKY_SECONDS': 10, 'STICKY_CACHE': 'default'})
+class PrimaryReplicaRouterTests(SimpleTestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.router = PrimaryReplicaRouter()
+
+    def request(self, user_id, write=False, status=200):
+        # Reads of one request for `user_id`: (search table, user table) aliases before and after an optional write
+        token = routers.start_request()
+        routers.user_authenticated(user_id)
+        reads = [self.router.db_for_read(NumberDirectory), self.router.db_for_read(CustomUser)]
+        if write:
+            self.assertEqual(self.router.db_for_write(SpamAction), 'default')
+            reads.append(self.router.db_for_read(NumberDirectory))
+        routers.finish_request(token, None, HttpResponse(status=status))
+        return reads
+
+    def test_search_reads_go_to_the_replicas(self):
+        self.assertEqual(self.request(1), ['replica1', 'default'])
+        # outside of requests (management commands, background threads) everything uses the primary
+        self.assertEqual(self.router.db_for_read(NumberDirectory), 'default')
+
+    def test_users_read_their_writes(self):
+        self.assertEqual(self.request(1, write=True), ['replica1', 'default', 'default'])
+        self.assertEqual(self.request(1), ['default', 'default'])
+        self.assertEqual(self.request(2), ['replica1', 'default'])
+
+    def test_failed_writes_do_not_pin_the_user(self):
+        self.request(1, write=True, status=400)
+        self.assertEqual(self.request(1), ['replica1', 'default'])
+
+    def test_buffered_writes_pin_the_request(self):
+        token = routers.start_request()
+        routers.user_authenticated(1)
+        routers.note_write()
+        self.assertEqual(self.router.db_for_read(NumberDirectory), 'default')
+        routers.finish_request(token, None, HttpResponse())
+        self.assertTrue(sticky_users.is_sticky(1))
+
+    def test_sticky_marks_expire(self):
+        self.request(1, write=True)
+        self.assertTrue(sticky_users.is_sticky(1))
+        with patch('django.core.cache.backends.locmem.time.time', return_value=time.time() + 11):
+            self.assertFalse(sticky_users.is_sticky(1))
+
+
+class SQLiteProfileTests(TestCase):
+
+    def pragma(self, cursor, name):
+        cursor.execute(f'PRAGMA {name}')
+        return cursor.fetchone()[0]
+
+    def test_connections_apply_the_pragmas(self):
+        with connection.cursor() as cursor:
+            self.assertEqual(self.pragma(cursor, 'synchronous'), 1)  # NORMAL
+            self.assertEqual(self.pragma(cursor, 'temp_store'), 2)  # MEMORY
+            self.assertEqual(self.pragma(cursor, 'cache_size'), settings.SQLITE_PRAGMAS['cache_size'])
+            self.assertEqual(self.pragma(cursor, 'busy_timeout'), settings.SQLITE_OPTIONS['timeout'] * 1000)
+
+    def test_file_databases_use_wal_and_immediate_transactions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'profile.sqlite3')
+            database = DatabaseWrapper({**connection.settings_dict, 'NAME': path}, alias='profile')
+            try:
+                with database.cursor() as cursor:
+                    self.assertEqual(self.pragma(cursor, 'journal_mode'), 'wal')
+                # the write lock is taken when the transaction begins, not at its first write
+                database._start_transaction_under_autocommit()
+                other = sqlite3.connect(path, timeout=0)
+                with self.assertRaisesMessage(sqlite3.OperationalError, 'locked'):
+                    other.execute('BEGIN IMMEDIATE')
+                other.close()
+                database.connection.rollback()
+            finally:
+                database.close()
+
+
+class RendererTests(SimpleTestCase):
+    DATA = {
+        'name': 'Zoë \u2028 Ünal',
+        'values': [1, 2.5, None, True, Decimal('1.10')],
+        'reported_at': datetime(2026, 1, 2, 3, 4, 5, 123456, tzinfo=dt_timezone.utc),
+        'local': datetime(2026, 1, 2, 3, 4, 5, tzinfo=dt_timezone(timedelta(hours=5, minutes=30))),
+        'day': date(2026, 1, 2),
+        'id': UUID(int=5),
+        919876543210: 'integer key',
+    }
+
+    def test_output_matches_drf(self):
+        expected = JSONRenderer().render(self.DATA)
+        self.assertEqual(FastJSONRenderer().render(self.DATA), expected)
+        self.assertEqual(json_response(self.DATA).content, expected)
+        with patch('users.renderers.orjson', None):
+            self.assertEqual(FastJSONRenderer().render(self.DATA), expected)
+
+    def test_indented_output_uses_the_standard_encoder(self):
+        rendered = FastJSONRenderer().render({'a': [1]}, 'application/json; indent=2')
+        self.assertEqual(rendered, b'{\n  "a": [\n    1\n  ]\n}')
+        self.assertEqual(FastJSONRenderer().render(None), b'')
+
+
+class LookupCacheTests(SimpleTestCase):
+
+    def test_least_recently_used_entries_are_evicted(self):
+        backend = LocalLRUBackend(max_entries=2)
+        backend.set('a', 1, 60)
+        backend.set('b', 2, 60)
+        backend.get('a')
+        backend.set('c', 3, 60)
+        self.assertEqual((backend.get('a'), backend.get('b'), backend.get('c')), (1, None, 3))
+
+    def test_entries_and_marks_expire(self):
+        backend = LocalLRUBackend(max_entries=10)
+        backend.set('a', 1, 60)
+        backend.mark(['m'], 5.0, 60)
+        with patch('users.cache.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual((backend.get('a'), backend.get_marks(['m'])), (None, {}))
+
+    def test_unknown_numbers_are_cached_and_computed_once(self):
+        cache = LookupCache(LocalLRUBackend(max_entries=10), ttl=60)
+        calls = []
+
+        def compute_many(numbers):
+            calls.append(sorted(numbers))
+            return {number: None if number == 2 else f'entry {number}' for number in numbers}
+
+        self.assertEqual(cache.get_numbers([1, 2], compute_many), {1: 'entry 1', 2: None})
+        self.assertEqual(cache.get_numbers([1, 2, 3], compute_many), {1: 'entry 1', 2: None, 3: 'entry 3'})
+        self.assertEqual(cache.get_number(2, lambda: 'computed'), None)
+        self.assertEqual(calls, [[1, 2], [3]])
+        cache.invalidate_number(1)
+        self.assertEqual(cache.get_number(1, lambda: 'computed'), 'computed')
+        self.assertEqual((cache.hits, cache.misses), (3, 4))
+
+    def test_a_zero_ttl_disables_the_cache(self):
+        cache = LookupCache(LocalLRUBackend(max_entries=10), ttl=0)
+        self.assertEqual([cache.get_number(1, lambda: value) for value in ['a', 'b']], ['a', 'b'])
+        self.assertEqual(cache.get_names('a', lambda: ['c'], set), ['c'])
+        self.assertEqual(len(cache.backend), 0)
+
+
+class TokenRevocationTests(APITestCase):
+
+    def get(self, token, url='/search/name/a/'):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        return client.get(url)
+
+    def login(self):
+        response = APIClient().post('/login/', {'phone_number': '+911111111111', 'password': 'secret'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['access_token']
+
+    def test_logout_revokes_only_its_token(self):
+        first, second = self.login(), self.login()
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {first}')
+        self.assertEqual(client.post('/logout/').status_code, 200)
+        self.assertEqual(self.get(first).status_code, 401)
+        self.assertEqual(self.get(second).status_code, 200)
+
+    def test_user_changes_revoke_the_earlier_tokens(self):
+        for change in [lambda user: user.set_password('other'), lambda user: setattr(user, 'is_staff', True),
+                       lambda user: setattr(user, 'is_active', False)]:
+            token = self.login()
+            self.assertEqual(self.get(token).status_code, 200)
+            user = CustomUser.objects.get(pk=self.user.pk)
+            change(user)
+            user.save()
+            self.assertEqual(self.get(token).status_code, 401)
+            self.assertEqual(self.get(token, '/async/search/name/a/').status_code, 401)
+            user.set_password('secret')
+            user.is_staff, user.is_active = False, True
+            user.save()
+
+    def test_revocations_are_kept_in_the_database_cache(self):
+        token = self.login()
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        client.post('/logout/')
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM auth_revocations')
+            self.assertGreater(cursor.fetchone()[0], 0)
+
+    def test_revocations_of_other_workers_are_seen_within_the_local_ttl(self):
+        token = self.login()
+        self.assertEqual(self.get(token).status_code, 200)
+        # another worker revokes the user in the shared cache
+        caches['revocations'].set(token_revocations.user_key(self.user.pk), time.time(), 60)
+        self.assertEqual(self.get(token).status_code, 200)
+        later = time.monotonic() + settings.AUTH_REVOCATION['LOCAL_TTL'] + 1
+        with patch('users.cache.time.monotonic', return_value=later):
+            self.assertEqual(self.get(token).status_code, 401)
+
+    def test_cached_lookups_of_an_active_user_run_no_query(self):
+        PhoneNumber.objects.create(name='Shop', number='9000000001')
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.login()}')
+        client.get('/search/number/9000000001/')
+        with self.assertNumQueries(0):
+            self.assertEqual(client.get('/search/number/9000000001/').json()['results'][0]['name'], 'Shop')
+
+    @override_settings(AUTH_REVOCATION={**settings.AUTH_REVOCATION, 'CACHE': 'default'})
+    def test_a_per_process_cache_revokes_in_this_process(self):
+        token_revocations._warned = False
+        token = self.login()
+        with self.assertLogs('users.authentication', 'WARNING'):
+            self.assertEqual(self.get(token).status_code, 200)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        client.post('/logout/')
+        self.assertEqual(self.get(token).status_code, 401)
+
+
+class GeneratorTests(TransactionTestCase):
+    # generate() closes the connections before forking its workers, so it cannot run in a test transaction
+    databases = {'default', *settings.DIRECTORY_SHARDS['SHARDS']}
+
+    def generate(self, users, **kwargs):
+        generator.generate(users=users, contacts_per_user=4, spam_reports_per_user=2, seed=7, workers=1, log=lambda message: None, **kwargs)
+
+    def contacts(self):
+        return sorted(UserContact.objects.values_list('user__phone_number', 'contact_name', 'phone_number'))
+
+    def test_rows_depend_on_the_seed_and_user_index_only(self):
+        whole = generator.generate_users(7, 0, 30, 4, 2)
+        parts = [generator.generate_users(7, start, start + 10, 4, 2) for start in (0, 10, 20)]
+        for position in range(3):
+            self.assertEqual(whole[position], [row for part in parts for row in part[position]])
+        self.assertNotEqual(generator.generate_users(8, 0, 30, 4, 2)[1], whole[1])
+
+    def test_resumed_run_matches_a_single_run(self):
+        self.generate(12, chunk_size=5)
+        self.generate(25, chunk_size=5)
+        resumed = self.contacts()
+        self.assertEqual(CustomUser.objects.count(), 25)
+
+        generator.clear()
+        self.assertFalse(UserContact.objects.exists())
+        self.generate(25, chunk_size=100)
+        self.assertEqual(self.contacts(), resumed)
+
+    def test_derived_tables_are_built(self):
+        self.generate(20)
+        contacts = UserContact.objects.count()
+        self.assertEqual(sum(PhoneNumber.objects.using(shard or 'default').filter(spam_likelihood=0).count() for shard in shards()), contacts)
+        self.assertEqual(NumberDirectory.objects.count(), len({*UserContact.objects.values_list('number_key', flat=True),
+                                                              *SpamAction.objects.values_list('number_key', flat=True),
+                                                              *CustomUser.objects.values_list('number_key', flat=True)}))
+        # the name index lives next to the PhoneNumber rows
+        self.assertTrue(all(NameIndexEntry.objects.using(shard or 'default').exists() for shard in shards()))
+
+        # spam likelihood of the reported numbers is their number of reports
+        key, reports = SpamAction.objects.values_list('number_key').annotate(count=Count('id')).order_by('-count')[0]
+        self.assertEqual(NumberDirectory.objects.get(number_key=key).spam_likelihood, reports)
+
+
+class SpamScoreRecomputeTests(TransactionTestCase):
+    # recompute_spam_scores() scores in a process pool, which does not see test transactions
+    databases = {'default', *settings.DIRECTORY_SHARDS['SHARDS']}
+
+    def test_scores_are_recomputed_from_the_report_timestamps(self):
+        now = timezone.now()
+        for index, age in enumerate([0, 30, 60]):
+            user = CustomUser.objects.create_user(phone_number=f'+91222222222{index}', name='Reporter', password='secret')
+            SpamAction.objects.create(user=user, phone_number='9000000001', is_marked_as_spam=True, reported_at=now - timedelta(days=age))
+        SpamAction.objects.filter(reported_at__lt=now - timedelta(days=45)).delete()
+        NumberDirectory.objects.filter(number_key=919000000001).update(spam_score=10, spam_score_at=time.time())
+
+        self.assertEqual(recompute_spam_scores(workers=1, log=lambda message: None), 1)
+        entry = NumberDirectory.objects.get(number_key=919000000001)
+        self.assertAlmostEqual(decayed_score(entry.spam_score, entry.spam_score_at, now.timestamp()), 1.5, places=3)
+
+
+class MigrationTestCase(TransactionTestCase):
+    # `migrate()` moves the test database to a migration and returns its historical models;
+    # the database is migrated forward again after every test
+    databases = {'default'}
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([target])
+        return executor.loader.project_state([target]).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+        super().tearDown()
+
+
+class DirectoryBackfillMigrationTests(MigrationTestCase):
+
+    def test_directory_is_built_in_batches(self):
+        apps = self.migrate(('users', '0002_alter_customuser_groups_and_more'))
+        HistoricalUser = apps.get_model('users', 'CustomUser')
+        HistoricalPhoneNumber = apps.get_model('users', 'PhoneNumber')
+        owner = HistoricalUser.objects.create(name='Owner', phone_number='9000000002', password='-')
+        for number, name, likelihood in [('9000000001', 'Asha', 10), ('9000000001', 'Asha', 30), ('9000000001', 'Anil', 0),
+                                         ('9000000003', 'Ravi', 5)]:
+            HistoricalPhoneNumber.objects.create(number=number, name=name, spam_likelihood=likelihood)
+        for number in ['9000000001', '9000000004', '9000000004']:
+            apps.get_model('users', 'SpamAction').objects.create(phone_number=number, is_marked_as_spam=True, user_id=owner.id)
+
+        backfill = importlib.import_module('users.migrations.0003_number_directory')
+        with patch.object(backfill, 'BATCH_SIZE', 2):
+            apps = self.migrate(('users', '0003_number_directory'))
+        rows = {row.number: row for row in apps.get_model('users', 'NumberDirectory').objects.all()}
+        self.assertEqual(sorted(rows), ['9000000001', '9000000002', '9000000003', '9000000004'])
+        self.assertEqual(rows['9000000001'].top_names, [{'name': 'Asha', 'count': 2}, {'name': 'Anil', 'count': 1}])
+        self.assertEqual((rows['9000000001'].spam_likelihood, rows['9000000001'].spam_reports), (30, 1))
+        self.assertEqual((rows['9000000002'].user_id, rows['9000000002'].top_names), (owner.id, []))
+        self.assertEqual((rows['9000000004'].spam_likelihood, rows['9000000004'].spam_reports), (None, 2))
+
+
+class NameIndexBackfillMigrationTests(MigrationTestCase):
+
+    def test_name_index_is_built_in_id_ranges(self):
+        apps = self.migrate(('users', '0003_number_directory'))
+        HistoricalPhoneNumber = apps.get_model('users', 'PhoneNumber')
+        phones = [HistoricalPhoneNumber.objects.create(number=f'900000000{i}', name=name) for i, name in enumerate(['Asha', 'Ravi  Kumar', '', 'Om'])]
+
+        backfill = importlib.import_module('users.migrations.0004_name_index')
+        with patch.object(backfill, 'BATCH_SIZE', 3):
+            apps = self.migrate(('users', '0004_name_index'))
+        entries = apps.get_model('users', 'NameIndexEntry').objects
+        self.assertEqual(sorted(entries.filter(phone_number_id=phones[1].id).values_list('rank', 'key')),
+                         [(0, 'ravi kumar'), (1, 'kumar'), (2, 'ar'), (2, 'avi kumar'), (2, 'i kumar'),
+                          (2, 'mar'), (2, 'r'), (2, 'umar'), (2, 'vi kumar')])
+        self.assertEqual([entries.filter(phone_number_id=phone.id).count() for phone in phones], [4, 9, 0, 2])
+
+
+class NumberKeyMigrationTests(MigrationTestCase):
+
+    def test_numbers_are_keyed_without_the_app_code(self):
+        apps = self.migrate(('users', '0007_spam_scores'))
+        HistoricalUser = apps.get_model('users', 'CustomUser')
+        HistoricalDirectory = apps.get_model('users', 'NumberDirectory')
+        user = HistoricalUser.objects.create(name='Bob', phone_number='098765 43210', password='-')
+        phone = apps.get_model('users', 'PhoneNumber').objects.create(number='0091-98765-43210', name='Bob')
+        HistoricalDirectory.objects.create(number='9876543210', spam_reports=1, spam_score=1, top_names=[{'name': 'Bob', 'count': 1}])
+        HistoricalDirectory.objects.create(number='+919876543210', user_id=user.id, top_names=[{'name': 'Bob', 'count': 2}])
+        HistoricalDirectory.objects.create(number='12', top_names=[])
+
+        # the migration keeps its own copy of the canonicalization
+        with patch('users.numbers.normalize', side_effect=AssertionError):
+            apps = self.migrate(('users', '0008_number_keys'))
+        self.assertEqual(apps.get_model('users', 'CustomUser').objects.get(id=user.id).number_key, 919876543210)
+        self.assertEqual(apps.get_model('users', 'PhoneNumber').objects.get(id=phone.id).number_key, 919876543210)
+        row = apps.get_model('users', 'NumberDirectory').objects.get()
+        self.assertEqual((row.number, row.user_id, row.spam_reports, row.top_names), ('+919876543210', user.id, 0, [{'name': 'Bob', 'count': 3}]))
+
+
+class PhoneticKeyMigrationTests(MigrationTestCase):
+
+    def test_phonetic_keys_are_indexed_without_the_app_code(self):
+        apps = self.migrate(('users', '0010_name_counts'))
+        phone = apps.get_model('users', 'PhoneNumber').objects.create(number='+919876543210', number_key=919876543210, name='José Kumar K')
+
+        with patch('users.phonetic.phonetic_key', side_effect=AssertionError):
+            apps = self.migrate(('users', '0011_name_index_phonetic_keys'))
+        entries = apps.get_model('users', 'NameIndexEntry').objects.filter(phone_number_id=phone.id, rank=3)
+        self.assertEqual(list(entries.order_by('id').values_list('key', flat=True)), ['2', '256'])
+
+
+class UniqueUserNumberMigrationTests(MigrationTestCase):
+
+    def test_duplicate_user_numbers_are_released(self):
+        apps = self.migrate(('users', '0014_shard_prefixes'))
+        HistoricalUser = apps.get_model('users', 'CustomUser')
+        first = HistoricalUser.objects.create(name='First', phone_number='+919876543210', number_key=919876543210, password='-')
+        second = HistoricalUser.objects.create(name='Second', phone_number='09876543210', number_key=919876543210, password='-')
+        other = HistoricalUser.objects.create(name='Other', phone_number='+919876543211', number_key=919876543211, password='-')
+        apps.get_model('users', 'NumberDirectory').objects.create(number='+919876543210', number_key=919876543210, user_id=second.id)
+
+        with redirect_stdout(io.StringIO()) as report:
+            self.migrate(('users', '0015_unique_user_number_keys'))
+        self.assertIn('+919876543210: kept by user', report.getvalue())
+        self.assertEqual(CustomUser.objects.get(number_key=919876543210).id, first.id)
+        self.assertEqual(CustomUser.objects.filter(id=second.id, number_key=None, is_active=False).count(), 1)
+        self.assertEqual(CustomUser.objects.get(id=other.id).number_key, 919876543211)
+        self.assertEqual(NumberDirectory.objects.get(number_key=919876543210).user_id, first.id)
@@ -1,11 +1,33 @@
+import gzip
+import hmac
 from django.contrib.auth import authenticate, login, logout
-from users.models import CustomUser, PhoneNumber, SpamAction, UserContact
-from rest_framework.decorators import api_view
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.http import require_GET
+from users.authentication import CachedClaimsJWTAuthentication, issue_tokens, token_revocations
+from users.cache import lookup_cache
+from users.directory import iter_saved_entries, lookup_number, lookup_numbers, saved_entries
+from users.heavy_hitters import hot_numbers
+from users.imports import ImportFormatError, import_contacts, iter_upload_rows
+from users.membership import membership_index
+from users.metrics import request_metrics
+from users.models import CustomUser
+from users.name_index import decode_name_cursor, fuzzy_search_names, iter_name_matches, search_names
+from users.numbers import format_key, number_key
+from users.pagination import InvalidCursor, decode_cursor, encode_cursor, get_page_size, stream_ndjson, wants_stream
+from users.results import ID, InvalidFields, format_results, parse_fields, result_formatter, row_numbers
+from users.spam import report_spam
+from users.spam_feed import changes_since, spam_feed_baseline
+from users.spam_scores import spam_score
+from users.spam_snapshot import spam_snapshot
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from django.conf import settings
-from django.db.models import Q
   
 @api_view(['POST'])
 def signUpUser(request):
@@ -19,19 +41,27 @@ def signUpUser(request):
     if not name or not phone or not password:
         return Response({"error": "Name, phone number, and password are required."}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Check if the phone number already exists
-    number_exist = CustomUser.objects.filter(phone_number=phone).first()
+    key = number_key(phone)
+    if key is None:
+        return Response({"error": "Invalid phone number format."}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Check if the phone number already exists, in whatever format it was registered
+    number_exist = CustomUser.objects.filter(number_key=key).exists()
     if number_exist:
         return Response({"error": "User with the same phone number already exists."}, status=status.HTTP_409_CONFLICT)
     
-    # Create the user
-    user = CustomUser.objects.create_user(
-        name=name,
-        phone_number=phone,
-        email=email,
-        password=password
-    )
-    user.save()
+    # Create the user, with the number in its E.164 form (the number key is unique, a concurrent
+    # sign-up with the same number fails here)
+    try:
+        with transaction.atomic():
+            CustomUser.objects.create_user(
+                name=name,
+                phone_number=format_key(key),
+                email=email,
+                password=password
+            )
+    except IntegrityError:
+        return Response({"error": "User with the same phone number already exists."}, status=status.HTTP_409_CONFLICT)
 
     # Return success message
     return Response({"message": "User successfully created. Please sign in."}, status=status.HTTP_201_CREATED)
@@ -49,8 +79,9 @@ def loginUser(request):
     user = authenticate(phone_number=phone_number, password=password)
 
     if user is not None:
-        # Generate JWT tokens (access and refresh)
-        refresh = RefreshToken.for_user(user)
+        # Generate JWT tokens (access and refresh) carrying the user claims, so that authenticated
+        # requests do not need to load the user row
+        refresh = issue_tokens(user)
         # Access token instance
         access_token = refresh.access_token
         access_token.set_exp(lifetime=settings.AUTH_TOKEN_VALIDITY)
@@ -67,7 +98,9 @@ def loginUser(request):
 
 @api_view(['POST'])
 def logoutUser(request):
-    # Log out the user (this clears the session data)
+    # Log out the user (this clears the session data) and revoke the access token of the request
+    if request.auth is not None:
+        token_revocations.revoke_token(request.auth)
     logout(request)
     return Response({"message": "You have been logged out successfully."}, status=200)
 
@@ -75,111 +108,321 @@ def logoutUser(request):
 @api_view(['POST'])
 def mark_as_spam(request, query):
     if request.user.is_authenticated:
-        try:
-            # Check if the user has already performed the action
-            user = request.user
-            # Create PhoneNumber instance if it does not exist
-            phone_number_instance, created = PhoneNumber.objects.get_or_create(number=query)
-
-            # Create or get the SpamAction instance for the user and phone number
-            spam_action, created = SpamAction.objects.get_or_create(user=user, phone_number=phone_number_instance)
-            
-            if not spam_action.is_marked_as_spam:
-                # Mark the action as performed by the user
-                spam_action.is_marked_as_spam = True
-                spam_action.save()
-
-            # Get the PhoneNumber instance
-            number_object = PhoneNumber.objects.get(number=query)
-
-            # Update the spam likelihood
-            number_object.spam_likelihood += 1
-            number_object.save()
-
-            return Response({"message": "Phone number is marked as spam!"}, status=status.HTTP_200_OK)
-        
-        # Handle case where multiple phone number entries are returned
-        except PhoneNumber.MultipleObjectsReturned:
-            most_spammed_number = PhoneNumber.objects.filter(number=query).order_by('-spam_likelihood').first()
-            most_spammed_number.spam_likelihood += 1
-            most_spammed_number.save()
+        key = number_key(query)
+        if key is None:
+            return Response({'error': 'Invalid phone number format'}, status=status.HTTP_400_BAD_REQUEST)
+        hot_numbers.record_report(key)
+
+        # The report is buffered and written in the background: repeat marks by the same user are
+        # ignored and the spam likelihood of the number is increased with one atomic batched update
+        report_spam(request.user, key)
 
-            return Response({"message": "Found multiple phone number entries. Marked most-spammed one as spam."}, status=status.HTTP_200_OK)
+        return Response({"message": "Phone number is marked as spam!"}, status=status.HTTP_200_OK)
         
     else:
         return Response({"error": "User not authenticated, please login."}, status=status.HTTP_401_UNAUTHORIZED)
     
+@api_view(['POST'])
+def import_contacts_view(request):
+    if not request.user.is_authenticated:
+        return Response({"error": "User not authenticated, please login."}, status=status.HTTP_401_UNAUTHORIZED)
+
+    # The body is read as a stream (a multipart upload is read from its "file" part), never through request.data
+    content_type = request.content_type or ''
+    if content_type.startswith('multipart/form-data'):
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({"error": "Missing 'file' part in the upload."}, status=status.HTTP_400_BAD_REQUEST)
+        stream = upload
+        content_type = upload.content_type or ('text/csv' if upload.name.lower().endswith('.csv') else 'application/x-ndjson')
+    else:
+        stream = request.stream
+    if stream is None:
+        return Response({"error": "Empty upload."}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        rows = iter_upload_rows(stream, content_type)
+        summary = import_contacts(request.user, rows)
+    except ImportFormatError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response(summary, status=status.HTTP_201_CREATED)
+
+
+def find_people_by_name(query, page_size=None, after=None):
+    # One page of the ranked name index lookup: names starting with the query come first,
+    # followed by names containing it. Returns the result rows and the cursor of the next page.
+    rows, next_position = search_names(query, page_size, after)
+    return rows, encode_cursor(next_position)
+
+
 @api_view(['GET'])
 def search_person_by_name(request, query):
     try:
-        print("search_person_by_name query=",query)
-        # Fetch results that start with the query
-        starts_with_results = PhoneNumber.objects.filter(Q(name__startswith=query)).values()
-        
-        # Fetch results that contain the query but do not start with it
-        contains_with_results = PhoneNumber.objects.filter(Q(name__icontains=query)).values().exclude(name__istartswith=query)
-        
-        print(starts_with_results)
-        print(contains_with_results)
+        # optional ?fields=name,phone_number to return only some fields of every result
+        fields = parse_fields(request.query_params.get('fields'))
 
-        # Combine both querysets
-        results = list(starts_with_results) + list(contains_with_results)
-        
-        search_results = []
-        for result in results:
-            result_info = {
-                'name': result['name'],
-                'phone_number': result['number'],
-                'spam_likelihood': result['spam_likelihood'],
-            }
-            search_results.append(result_info)
+        if request.query_params.get('match') == 'fuzzy':
+            # typo-tolerant search: a single ranked page of the names that sound like the query
+            page_size = get_page_size(request.query_params)
+            if page_size == settings.SEARCH_MAX_PAGE_SIZE:
+                rows = lookup_cache.get_names(query, lambda: fuzzy_search_names(query), row_numbers, mode='fuzzy')
+            else:
+                rows = fuzzy_search_names(query, page_size)
+            return Response({'results': format_results(rows, fields), 'next': None}, status=status.HTTP_200_OK)
+
+        if wants_stream(request):
+            # opt-in NDJSON export of every match, streamed chunk by chunk
+            return stream_ndjson(map(result_formatter(fields), (row for position, row in iter_name_matches(query))))
 
-        return Response({'results': search_results}, status=status.HTTP_200_OK)
+        page_size = get_page_size(request.query_params)
+        after = decode_name_cursor(request.query_params.get('cursor'))
+        if after is None and page_size == settings.SEARCH_MAX_PAGE_SIZE:
+            # the default first page is what clients request on every keystroke
+            rows, next_cursor = lookup_cache.get_names(query, lambda: find_people_by_name(query), lambda page: row_numbers(page[0]))
+        else:
+            rows, next_cursor = find_people_by_name(query, page_size, after)
+        return Response({'results': format_results(rows, fields), 'next': next_cursor}, status=status.HTTP_200_OK)
+
+    except (InvalidCursor, InvalidFields) as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
     except Exception as e:
         return Response({'error': f'An unexpected error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
+def format_number_lookup(entry, is_contact):
+    # Response payload of a number lookup from its directory snapshot
+    if entry is None: # number is unknown to both the registered users and the global database
+        return {'results': []}
+
+    # time-decayed score from the materialized reporter count, decayed to now
+    score = spam_score(entry.get('spam_score'), entry.get('spam_score_at'))
+
+    # check if the number is registered as user
+    registered_user = entry['user']
+    if registered_user is not None:
+        result_info = {
+            'name': registered_user['name'],
+            'phone_number': registered_user['phone_number'],
+            # I (registered user) will get the email information of the person for which I am searching for only when the person has my number saved in his/her contact list
+            'email': registered_user['email'] if is_contact else None,
+            # spam likelihood of the most spammed entry of this number in the global database
+            'spam_likelihood': entry['spam_likelihood'],
+            'spam_score': score,
+        }
+        return {'result': result_info}
+
+    # searched phone number by me(registered user) does not belongs to any registered user,
+    # return the most common names saved for it in the global database
+    search_results = []
+    for saved_name in entry['top_names']:
+        result_info = {
+            'name': saved_name['name'],
+            'phone_number': entry['number'],
+            'spam_likelihood': entry['spam_likelihood'],
+            'spam_score': score,
+        }
+        search_results.append(result_info)
+    return {'results': search_results}
+
+
+def spam_signals(entry):
+    # (spam_likelihood, spam score) of a directory snapshot, 0 for numbers without spam signals like in the spam snapshot
+    if entry is None:
+        return 0, 0
+    return entry['spam_likelihood'] or 0, spam_score(entry.get('spam_score'), entry.get('spam_score_at'))
+
+
+def format_spam_lookup(key, spam_likelihood, score):
+    return {'phone_number': format_key(key), 'spam_likelihood': spam_likelihood, 'spam_score': score}
+
+
+def find_spam_signals(key):
+    # Score part of a number lookup, from the memory-mapped spam snapshot when one is configured
+    signals = spam_snapshot.lookup(key)
+    if signals is None:
+        signals = spam_signals(lookup_cache.get_number(key, lambda: lookup_number(key)))
+    return format_spam_lookup(key, *signals)
+
+
+def wants_saved_entries(query_params):
+    # A cursor or a page size asks for the listing of every entry saved for a number, instead of the
+    # directory summary
+    return 'cursor' in query_params or 'page_size' in query_params
+
+
+def saved_entries_page(query_params):
+    # (page size, id of the last row of the previous page) of a saved entries listing
+    after = decode_cursor(query_params.get('cursor'), (int,))
+    return get_page_size(query_params), after[0] if after else None
+
+
+def format_saved_entries(rows, page_size, fields=None):
+    next_position = [rows[-1][ID]] if len(rows) == page_size else None
+    return {'results': format_results(rows, fields), 'next': encode_cursor(next_position)}
+
+
+def find_saved_entries(key, query_params, fields=None):
+    # One keyset page of the PhoneNumber rows of a number key, ordered by id
+    page_size, after_id = saved_entries_page(query_params)
+    return format_saved_entries(list(saved_entries(key, after_id, page_size)), page_size, fields)
+
+
 @api_view(['GET'])
 def search_person_by_number(request, query):
-    print(query)
+    # the contact visibility of a registered number depends on who is asking
+    if not request.user.is_authenticated:
+        return Response({"error": "User not authenticated, please login."}, status=status.HTTP_401_UNAUTHORIZED)
+
     try:
-        if query.isdigit() and len(query) >= 10:
-            # check if the number is registered as user
-            registered_user = CustomUser.objects.get(phone_number=query)
-            print(registered_user)
+        # any written format of the number is looked up by its integer key
+        key = number_key(query)
+        if key is None:
+            return Response({'error': 'Invalid phone number format'}, status=400)
+        # counted for the heavy hitters, whose lookups are pinned in the cache
+        hot_numbers.record_lookup(key)
 
-            # find person's contact list and then check if the request.user exists in the person's contact list
-            is_contact = UserContact.objects.filter(user=registered_user, phone_number=request.user.phone_number).exists()
+        if request.query_params.get('fields') == 'spam':
+            # call screening: only the spam signals, without a database query when the snapshot is loaded
+            return Response(find_spam_signals(key))
 
-            # find that particular phone number in the global database which is mostly spammed.
-            most_spammed = PhoneNumber.objects.filter(number=query).order_by('-spam_likelihood').first()
+        if wants_stream(request):
+            # opt-in NDJSON export of every entry saved for the number in the global database
+            fields = parse_fields(request.query_params.get('fields'))
+            return stream_ndjson(map(result_formatter(fields), iter_saved_entries(key)))
 
-            result_info = {
-                'name': registered_user.name,
-                'phone_number': registered_user.phone_number,
-                # I (registered user) will get the email information of the person for which I am searching for only when the person has my number saved in his/her contact list
-                'email': registered_user.email if is_contact else None,
-                'spam_likelihood': most_spammed.spam_likelihood if most_spammed else None
-            }
+        if wants_saved_entries(request.query_params):
+            # paginated listing of every entry saved for the number, instead of the directory summary
+            fields = parse_fields(request.query_params.get('fields'))
+            return Response(find_saved_entries(key, request.query_params, fields))
 
-            return Response({'result': result_info})
+        # single indexed point lookup on the canonical number directory, served from the lookup cache when hot
+        entry = lookup_cache.get_number(key, lambda: lookup_number(key))
 
-        else:
-            return Response({'error': 'Invalid phone number format'}, status=400)
+        # find person's contact list and then check if the request.user exists in the person's contact list
+        is_contact = False
+        if entry is not None and entry['user'] is not None:
+            is_contact = membership_index.has_saved(entry['user']['id'], number_key(request.user.phone_number))
+
+        return Response(format_number_lookup(entry, is_contact))
+
+    except (InvalidCursor, InvalidFields) as e:
+        return Response({'error': str(e)}, status=400)
+
+    except Exception as e:
+        return Response({'error': f'An unexpected error occurred: {str(e)}'}, status=500)
 
-    except CustomUser.DoesNotExist: # searched phone number by me(registered user) does not belongs to any registered user
-        results = PhoneNumber.objects.filter(number=query) # return all names associated with searched phone number
 
-        search_results = []
-        for result in results:
-            result_info = {
-                'name': result.name,
-                'phone_number': result.number,
-                'spam_likelihood': result.spam_likelihood,
-            }
-            search_results.append(result_info)
+@api_view(['POST'])
+def search_people_by_numbers(request):
+    # Batch lookup for call logs: {"numbers": [...]} -> one result per number, in input order
+    if not request.user.is_authenticated:
+        return Response({"error": "User not authenticated, please login."}, status=status.HTTP_401_UNAUTHORIZED)
+    numbers = request.data.get("numbers") if isinstance(request.data, dict) else None
+    if not isinstance(numbers, list) or not numbers:
+        return Response({"error": "A non-empty list of numbers is required."}, status=status.HTTP_400_BAD_REQUEST)
+    if len(numbers) > settings.BATCH_LOOKUP_MAX_NUMBERS:
+        return Response({"error": f"At most {settings.BATCH_LOOKUP_MAX_NUMBERS} numbers can be looked up at once."}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        numbers = [str(number) for number in numbers]
+        keys = {number: number_key(number) for number in numbers}
+
+        # directory rows of every number (cached ones first, the rest with set-based queries)
+        entries = lookup_cache.get_numbers({key for key in keys.values() if key is not None}, lookup_numbers)
 
-        return Response({'results': search_results})
+        # registered users that have the requesting user in their contact list, in at most one query
+        registered_ids = {entry['user']['id'] for entry in entries.values() if entry is not None and entry['user'] is not None}
+        contact_owner_ids = membership_index.owners_with_number(registered_ids, number_key(request.user.phone_number))
+
+        lookups = []
+        for number in numbers:
+            if keys[number] is None:
+                lookups.append({'number': number, 'error': 'Invalid phone number format'})
+                continue
+            entry = entries.get(keys[number])
+            is_contact = entry is not None and entry['user'] is not None and entry['user']['id'] in contact_owner_ids
+            lookups.append({'number': number, **format_number_lookup(entry, is_contact)})
+
+        return Response({'lookups': lookups}, status=status.HTTP_200_OK)
 
     except Exception as e:
-        return Response({'error': f'An unexpected error occurred: {str(e)}'}, status=500)
\ No newline at end of file
+        return Response({'error': f'An unexpected error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+def spam_changes(request):
+    # Changes of the spam list since the version the client holds (?since=, 0 for everything), for
+    # clients screening calls from a local copy; ask again with the returned version while "more" is true
+    if not request.user.is_authenticated:
+        return Response({"error": "User not authenticated, please login."}, status=status.HTTP_401_UNAUTHORIZED)
+    try:
+        since = int(request.query_params.get('since', 0))
+    except ValueError:
+        since = -1
+    if since < 0:
+        return Response({'error': 'since must be a feed version (a non-negative integer).'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(changes_since(since), status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def spam_baseline(request):
+    # Every reported number in the format of the changes, gzip-compressed, to start a local copy
+    if not request.user.is_authenticated:
+        return Response({"error": "User not authenticated, please login."}, status=status.HTTP_401_UNAUTHORIZED)
+    version, body = spam_feed_baseline.get()
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = HttpResponse(body, content_type='application/json')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(gzip.decompress(body), content_type='application/json')
+    response['X-Spam-Feed-Version'] = str(version)
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def hot_numbers_stats(request):
+    # Hottest numbers of all the worker processes (?limit=, TOP_K by default), with their decayed
+    # lookup and report counts, and the pinned lookups of this process
+    try:
+        limit = int(request.query_params.get('limit', 0))
+    except ValueError:
+        limit = -1
+    if limit < 0:
+        return Response({'error': 'limit must be a positive integer.'}, status=status.HTTP_400_BAD_REQUEST)
+    hottest = [{'phone_number': format_key(row['number_key']), 'lookups': round(row['lookups'], 1),
+                'reports': round(row['reports'], 1)} for row in hot_numbers.hottest(limit)]
+    return Response({'hottest': hottest, **hot_numbers.stats()})
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def lookup_cache_stats(request):
+    # Hit/miss counters of this process' lookup cache and contact Bloom filters, used to tune
+    # LOOKUP_CACHE and CONTACT_BLOOM_FILTERS, and the spam snapshot and feed baseline it has loaded
+    return Response({**lookup_cache.stats(), 'contact_bloom_filters': membership_index.stats(),
+                     'spam_snapshot': spam_snapshot.stats(), 'spam_feed_baseline': spam_feed_baseline.stats()})
+
+
+def can_scrape_metrics(request):
+    # The configured scrape token, or the access token of a staff user
+    token = settings.REQUEST_METRICS['TOKEN']
+    header = request.headers.get('Authorization', '')
+    if token:
+        return hmac.compare_digest(header.encode(), f'Bearer {token}'.encode())
+    try:
+        result = CachedClaimsJWTAuthentication().authenticate(request)
+    except (AuthenticationFailed, InvalidToken, TokenError):
+        return False
+    return result is not None and result[0].is_staff
+
+
+@require_GET
+def metrics(request):
+    # Prometheus scrape endpoint with the request metrics of this process (plain Django view, so that
+    # the text format is not subject to DRF content negotiation)
+    if not can_scrape_metrics(request):
+        return HttpResponse('Forbidden\n', status=status.HTTP_403_FORBIDDEN, content_type='text/plain')
+    return HttpResponse(request_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')